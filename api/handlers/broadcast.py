@@ -5,7 +5,6 @@ import sys
 from loguru import logger
 from aiogram import Bot
 import asyncio
-import aiosqlite
 
 from pathlib import Path
 root_path = Path(__file__).parent.parent.parent
@@ -35,7 +34,7 @@ async def get_bot_token(db: Database) -> str:
     """
     async def _operation():
         try:
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire() as conn:
                 cursor = await conn.execute("SELECT bot_token FROM bot_settings WHERE is_enable = 1")
                 result = await cursor.fetchone()
                 if not result:
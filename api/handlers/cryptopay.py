@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional
 import sys
@@ -9,6 +9,7 @@ root_path = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(root_path))
 
 from handlers.database import Database
+from handlers.pagination import DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT, next_cursor
 
 router = APIRouter(
     prefix="/cryptopay",
@@ -172,16 +173,28 @@ async def get_user_payments(
         raise HTTPException(status_code=500, detail=str(e)) 
 
 @router.get("/payments", response_model=Dict)
-async def get_all_crypto_payments(db: Database = Depends(get_db)):
+async def get_all_crypto_payments(
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT, description="Максимальное количество возвращаемых записей"),
+    after: Optional[str] = Query(None, description="Курсор следующей страницы (next_cursor из предыдущего ответа)"),
+    skip: int = Query(0, ge=0, description="Количество пропускаемых записей (устарело, используйте after)"),
+    db: Database = Depends(get_db)
+):
     """
     Получение списка всех успешных платежей через Crypto Bot
+    
+    - **limit**: Максимальное количество возвращаемых записей
+    - **after**: Курсор следующей страницы
+    - **skip**: Количество пропускаемых записей (для старых клиентов)
     """
     try:
-        payments = await db.get_all_crypto_payments()  
+        payments = await db.get_all_crypto_payments(limit=limit, after=after, skip=skip)
         return {
             "payments": payments,
+            "next_cursor": next_cursor(payments, limit),
             "success": True
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при получении списка платежей: {e}")
         raise HTTPException(status_code=500, detail=str(e))
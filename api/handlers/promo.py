@@ -1,10 +1,11 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional
 import sys
 from loguru import logger
 from datetime import datetime, timedelta
 import aiosqlite
+import asyncio
 from aiogram import Bot
 
 from pathlib import Path
@@ -33,6 +34,41 @@ class PromoTariffSend(BaseModel):
     promo_id: int = Field(..., description="ID промо-тарифа")
     telegram_id: int = Field(..., description="Telegram ID пользователя")
 
+class PromoTariffSendBatch(BaseModel):
+    promo_id: int = Field(..., description="ID промо-тарифа")
+    telegram_ids: List[int] = Field(..., description="Telegram ID пользователей")
+
+# Сколько Telegram ID подставляется в один запрос IN (...)
+USERS_QUERY_CHUNK = 500
+
+async def notify_promo_users(bot: Bot, tariff: Dict, deliveries: List[Dict]):
+    """
+    Фоновая рассылка выданных промо-конфигураций
+    """
+    success_count = 0
+    try:
+        for delivery in deliveries:
+            try:
+                await bot.send_message(
+                    chat_id=delivery['telegram_id'],
+                    text=(
+                        f"🎁 Вам предоставлен промо-тариф!\n\n"
+                        f"Тариф: {tariff['name']}\n"
+                        f"Срок действия: {tariff['left_day']} дней\n"
+                        f"Дата окончания: {delivery['end_date']}\n\n"
+                        f"Ваша конфигурация:\n<code>{delivery['vless_link']}</code>"
+                    ),
+                    parse_mode="HTML"
+                )
+                success_count += 1
+            except Exception as e:
+                logger.error(f"Ошибка при отправке уведомления пользователю {delivery['telegram_id']}: {e}")
+            await asyncio.sleep(0.05)
+    finally:
+        await bot.session.close()
+
+    logger.info(f"Уведомления о промо-тарифе {tariff['id']} отправлены: {success_count} из {len(deliveries)}")
+
 @router.get("/", response_model=List[Dict])
 async def get_promo_tariffs(db: Database = Depends(get_db)):
     """
@@ -157,7 +193,7 @@ async def send_promo_tariff_with_server(
     """
     try:
         async def get_promo_tariff(promo_id: int):
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 cursor = await conn.execute("""
                     SELECT *
@@ -168,7 +204,7 @@ async def send_promo_tariff_with_server(
                 return dict(tariff) if tariff else None
         
         async def get_user(telegram_id: int):
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 cursor = await conn.execute("""
                     SELECT *
@@ -179,7 +215,7 @@ async def send_promo_tariff_with_server(
                 return dict(user) if user else None
         
         async def get_server(server_id: int):
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 cursor = await conn.execute("""
                     SELECT *
@@ -190,7 +226,7 @@ async def send_promo_tariff_with_server(
                 return dict(server) if server else None
         
         async def get_bot_token():
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire() as conn:
                 cursor = await conn.execute("SELECT bot_token FROM bot_settings WHERE is_enable = 1")
                 result = await cursor.fetchone()
                 if not result:
@@ -215,7 +251,7 @@ async def send_promo_tariff_with_server(
         if not vless_link:
             raise HTTPException(status_code=500, detail="Ошибка при создании конфигурации на сервере")
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute("""
                 INSERT INTO user_subscription 
                 (user_id, tariff_id, server_id, end_date, vless, is_active)
@@ -259,4 +295,94 @@ async def send_promo_tariff_with_server(
         raise
     except Exception as e:
         logger.error(f"Ошибка при отправке промо-тарифа {promo.promo_id} пользователю {promo.telegram_id} с созданием на сервере: {e}")
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e)) 
+
+@router.post("/send-with-server/batch", response_model=Dict)
+async def send_promo_tariff_with_server_batch(
+    promo: PromoTariffSendBatch,
+    background_tasks: BackgroundTasks,
+    db: Database = Depends(get_db)
+):
+    """
+    Массовая выдача промо-тарифа с созданием пользователей на сервере XUI.
+
+    Клиенты добавляются в панель пачками, подписки записываются одной
+    транзакцией, уведомления пользователям отправляются в фоне.
+
+    - **promo_id**: ID промо-тарифа
+    - **telegram_ids**: Telegram ID пользователей
+    """
+    try:
+        async with db.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            cursor = await conn.execute(
+                "SELECT * FROM tariff_promo WHERE id = ? AND is_enable = 1",
+                (promo.promo_id,)
+            )
+            tariff = await cursor.fetchone()
+            if not tariff:
+                raise HTTPException(status_code=404, detail="Промо-тариф не найден или неактивен")
+            tariff = dict(tariff)
+
+            cursor = await conn.execute("SELECT * FROM server_settings WHERE id = ?", (tariff['server_id'],))
+            server = await cursor.fetchone()
+            if not server:
+                raise HTTPException(status_code=404, detail="Сервер не найден")
+            server = dict(server)
+
+            cursor = await conn.execute("SELECT bot_token FROM bot_settings WHERE is_enable = 1")
+            bot_token = await cursor.fetchone()
+            if not bot_token:
+                raise HTTPException(status_code=500, detail="Токен бота не найден")
+
+            telegram_ids = list(dict.fromkeys(promo.telegram_ids))
+            active_ids = set()
+            for start in range(0, len(telegram_ids), USERS_QUERY_CHUNK):
+                chunk = telegram_ids[start:start + USERS_QUERY_CHUNK]
+                cursor = await conn.execute(
+                    f"SELECT telegram_id FROM user WHERE is_enable = 1 AND telegram_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                active_ids.update(row[0] for row in await cursor.fetchall())
+
+        recipients = [telegram_id for telegram_id in telegram_ids if telegram_id in active_ids]
+        results = await xui_manager.provision_batch([
+            {'server_settings': server, 'telegram_id': telegram_id, 'left_day': tariff['left_day']}
+            for telegram_id in recipients
+        ])
+
+        deliveries = [
+            {
+                'telegram_id': result['telegram_id'],
+                'end_date': result['end_date'].strftime('%Y-%m-%d %H:%M:%S'),
+                'vless_link': result['link']
+            }
+            for result in results if result['link']
+        ]
+        await db.add_user_subscriptions([
+            {
+                'user_id': delivery['telegram_id'],
+                'tariff_id': tariff['id'],
+                'server_id': tariff['server_id'],
+                'end_date': delivery['end_date'],
+                'vless': delivery['vless_link']
+            }
+            for delivery in deliveries
+        ])
+
+        if deliveries:
+            background_tasks.add_task(notify_promo_users, Bot(token=bot_token[0]), tariff, deliveries)
+
+        return {
+            "message": "Промо-тариф выдан пользователям",
+            "success": True,
+            "promo_id": promo.promo_id,
+            "sent": len(deliveries),
+            "failed": [result['telegram_id'] for result in results if not result['link']],
+            "not_found": [telegram_id for telegram_id in telegram_ids if telegram_id not in active_ids]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при массовой выдаче промо-тарифа {promo.promo_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
@@ -37,7 +37,7 @@ async def get_pspayments_settings(db: Database = Depends(get_db)):
     Получение активных настроек PSPayments
     """
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             cursor = await conn.execute("""
                 SELECT id, name, shop_id, description, is_enable 
@@ -79,7 +79,7 @@ async def create_pspayments_settings(
     - **description**: Описание настройки (опционально)
     """
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute(
                 "UPDATE yookassa_settings SET is_enable = 0 WHERE is_enable = 1"
             )
@@ -113,7 +113,7 @@ async def delete_pspayments_settings(
     - **shop_id**: ID магазина pspayments для удаления
     """
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             conn.row_factory = aiosqlite.Row
 
             cursor = await conn.execute(
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional
 import sys
@@ -9,6 +9,7 @@ root_path = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(root_path))
 
 from handlers.database import Database
+from handlers.pagination import DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT, next_cursor
 
 router = APIRouter(
     prefix="/referral",
@@ -115,9 +116,11 @@ async def toggle_referral_condition(
 
 @router.get("/rewards/history", response_model=List[Dict])
 async def get_referral_rewards_history(
+    response: Response,
     user_id: Optional[int] = None,
-    limit: int = 100,
-    offset: int = 0,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    offset: int = Query(0, ge=0),
+    after: Optional[str] = Query(None, description="Курсор следующей страницы из заголовка X-Next-Cursor"),
     db: Database = Depends(get_db)
 ):
     """
@@ -125,15 +128,22 @@ async def get_referral_rewards_history(
     
     - **user_id**: ID пользователя для фильтрации (опционально)
     - **limit**: Максимальное количество записей (по умолчанию 100)
-    - **offset**: Смещение для пагинации (по умолчанию 0)
+    - **offset**: Смещение для пагинации (для старых клиентов, игнорируется вместе с after)
+    - **after**: Курсор следующей страницы, возвращается в заголовке X-Next-Cursor
     """
     try:
         history = await db.get_referral_rewards_history(
             user_id=user_id,
             limit=limit,
-            offset=offset
+            offset=offset,
+            after=after
         )
+        cursor = next_cursor(history, limit)
+        if cursor:
+            response.headers["X-Next-Cursor"] = cursor
         return history
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при получении истории реферальных вознаграждений: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -3,6 +3,7 @@ from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import sys
 import os
+import time
 from loguru import logger
 
 from pathlib import Path
@@ -10,6 +11,8 @@ root_path = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(root_path))
 
 from handlers.database import Database
+from handlers.reconcile import reconcile_servers
+from handlers.evacuation import start_evacuation
 
 router = APIRouter(
     prefix="/servers",
@@ -31,6 +34,9 @@ class ServerBase(BaseModel):
     inbound_id: Optional[int] = None
     protocol: Optional[str] = "vless"
     is_enable: Optional[bool] = True
+    region: Optional[str] = None
+    capacity: Optional[int] = 0
+    weight: Optional[float] = 1.0
 
 class ServerCreate(BaseModel):
     name: str
@@ -42,9 +48,13 @@ class ServerCreate(BaseModel):
     inbound_id: int
     protocol: Optional[str] = "vless"
     ip: Optional[str] = None
+    region: Optional[str] = None
+    capacity: int = 0
+    weight: float = 1.0
 
 class Server(ServerBase):
     id: int
+    health: Optional[Dict[str, Any]] = None
     
     class Config:
         orm_mode = True
@@ -56,6 +66,13 @@ class ServerUpdate(BaseModel):
     inbound_id: Optional[int] = None
     is_enable: Optional[bool] = None
     inbound_id_promo: Optional[int] = None
+    region: Optional[str] = None
+    capacity: Optional[int] = None
+    weight: Optional[float] = None
+
+class ServerEvacuate(BaseModel):
+    target_server_ids: Optional[List[int]] = None
+    delete_source: bool = False
 
 class ServerTotalEarningsStats(BaseModel):
     server_name: str
@@ -74,6 +91,7 @@ async def get_servers(
 ):
     """
     Получение списка серверов.
+    Поле health — результат последней проверки мониторинга и доступность за сутки.
     
     - **is_active**: Фильтр по статусу активности
     """
@@ -82,6 +100,9 @@ async def get_servers(
             servers = await db.get_active_servers()
         else:
             servers = await db.get_all_servers()
+        health = await db.get_server_health_summary(int(time.time()) - 86400)
+        for server in servers:
+            server['health'] = health.get(server['id'])
         return servers
     except Exception as e:
         logger.error(f"Ошибка при получении серверов: {e}")
@@ -119,6 +140,9 @@ async def add_server(server: ServerCreate, db: Database = Depends(get_db)):
     - **inbound_id**: ID входящего соединения
     - **protocol**: Протокол (по умолчанию vless)
     - **ip**: IP-адрес сервера (опционально)
+    - **region**: Регион: новые подписки распределяются между серверами одного региона (опционально)
+    - **capacity**: Максимум активных подписок, 0 — без ограничения
+    - **weight**: Относительная доля новых подписок среди серверов региона
     """
     try:
         success = await db.add_server(
@@ -130,7 +154,10 @@ async def add_server(server: ServerCreate, db: Database = Depends(get_db)):
             name=server.name,
             inbound_id=server.inbound_id,
             protocol=server.protocol,
-            ip=server.ip
+            ip=server.ip,
+            region=server.region,
+            capacity=server.capacity,
+            weight=server.weight
         )
         
         if not success:
@@ -154,6 +181,8 @@ async def add_server(server: ServerCreate, db: Database = Depends(get_db)):
 async def delete_server(server_id: int, db: Database = Depends(get_db)):
     """
     Удаление сервера и отключение всех связанных тарифов.
+    Активные подписки остаются на сервере; чтобы перенести их на другие
+    серверы, используйте POST /servers/{server_id}/evacuate.
     
     - **server_id**: ID сервера для удаления
     
@@ -187,6 +216,61 @@ async def delete_server(server_id: int, db: Database = Depends(get_db)):
         logger.error(f"Ошибка при удалении сервера {server_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/{server_id}/evacuate", response_model=Dict)
+async def evacuate_server(
+    server_id: int,
+    evacuation: ServerEvacuate,
+    db: Database = Depends(get_db)
+):
+    """
+    Перенос всех активных подписок с сервера на другие серверы.
+
+    Сервер и его тарифы сразу отключаются. Подписки переносятся пачками
+    воркером бота: на целевых серверах создаются клиенты с той же датой
+    окончания, у подписок меняются сервер и ключ, старые клиенты удаляются,
+    пользователи получают новые ключи. Прерванный перенос продолжается
+    после перезапуска бота. Повторный вызов во время переноса возвращает
+    текущее задание.
+
+    - **server_id**: ID сервера-источника
+    - **target_server_ids**: Серверы для переноса; по умолчанию включенные серверы
+      того же протокола из региона источника (или все, если в регионе их нет)
+    - **delete_source**: Удалить сервер после переноса, если на нем не останется подписок
+    """
+    try:
+        if evacuation.target_server_ids is not None:
+            if server_id in evacuation.target_server_ids:
+                raise HTTPException(status_code=400, detail="Сервер-источник не может быть целевым")
+            servers = {server['id']: server for server in await db.get_all_servers()}
+            unavailable = [
+                target_id for target_id in evacuation.target_server_ids
+                if not servers.get(target_id, {}).get('is_enable')
+            ]
+            if unavailable:
+                raise HTTPException(status_code=400, detail=f"Серверы не найдены или отключены: {unavailable}")
+
+        job = await start_evacuation(server_id, evacuation.target_server_ids, evacuation.delete_source)
+        if not job:
+            raise HTTPException(status_code=404, detail="Сервер не найден")
+        return job
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при запуске переноса подписок с сервера {server_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/{server_id}/evacuations", response_model=List[Dict])
+async def get_server_evacuations(server_id: int, db: Database = Depends(get_db)):
+    """
+    Переносы подписок с сервера, последние первыми: статус, позиция
+    (after_id) и счетчики перенесенных, неудачных, удаленных ключей и уведомлений.
+    """
+    try:
+        return await db.get_server_evacuations(server_id)
+    except Exception as e:
+        logger.error(f"Ошибка при получении переносов сервера {server_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.put("/{server_id}", response_model=Dict)
 async def update_server(
     server_id: int, 
@@ -203,6 +287,9 @@ async def update_server(
     - **inbound_id**: Новый ID входящего соединения (опционально)
     - **is_enable**: Новый статус активности сервера (опционально)
     - **inbound_id_promo**: Новый ID входящего соединения для промо (опционально)
+    - **region**: Регион для распределения подписок, пустая строка — без региона (опционально)
+    - **capacity**: Максимум активных подписок, 0 — без ограничения (опционально)
+    - **weight**: Относительная доля новых подписок (опционально)
     """
     try:
         server = await db.get_server_settings(server_id)
@@ -216,7 +303,10 @@ async def update_server(
             port=server_data.port,
             inbound_id=server_data.inbound_id,
             is_enable=server_data.is_enable,
-            inbound_id_promo=server_data.inbound_id_promo
+            inbound_id_promo=server_data.inbound_id_promo,
+            region=server_data.region,
+            capacity=server_data.capacity,
+            weight=server_data.weight
         )
         
         if not success:
@@ -263,4 +353,22 @@ async def get_servers_total_earnings(db: Database = Depends(get_db)):
         return stats
     except Exception as e:
         logger.error(f"Ошибка при получении статистики общей суммы заработка на серверах: {e}")
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e)) 
+
+@router.post("/reconcile", response_model=List[Dict])
+async def reconcile_servers_clients(
+    server_id: Optional[List[int]] = Query(None, description="ID серверов, по умолчанию все включенные"),
+    fix: bool = Query(False, description="Удалить клиентов-сирот и восстановить потерянных клиентов")
+):
+    """
+    Сверка активных подписок с клиентами inbound на панелях 3x-ui.
+
+    Возвращает по каждому серверу число потерянных подписок (клиента нет в панели)
+    и клиентов-сирот (клиент бота без активной подписки). С fix=true сироты
+    удаляются, а потерянные vless клиенты создаются заново с прежним UUID.
+    """
+    try:
+        return await reconcile_servers(server_id, fix=fix)
+    except Exception as e:
+        logger.error(f"Ошибка при сверке серверов: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
@@ -8,6 +8,7 @@ root_path = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(root_path))
 
 from handlers.database import Database
+from handlers.pagination import DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT
 
 router = APIRouter(
     prefix="/statistics",
@@ -108,25 +109,27 @@ async def get_statistics_summary(db: Database = Depends(get_db)):
     Получение общей статистики
     """
     try:
-        total_users = await db.get_total_users_count()
-        total_subscriptions = await db.get_total_subscriptions_count()
-        popular_tariff = await db.get_most_popular_tariff()
-        last_payment = await db.get_last_payment()
-        total_amount = await db.get_total_payments_amount()
-        top_buyer = await db.get_top_buyer()
-        
-        return {
-            "total_users": total_users,
-            "total_subscriptions": total_subscriptions,
-            "popular_tariff": popular_tariff,
-            "last_payment": last_payment,
-            "total_amount": total_amount,
-            "top_buyer": top_buyer
-        }
+        return await db.get_statistics_summary()
     except Exception as e:
         logger.error(f"Ошибка при получении общей статистики: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/rebuild", response_model=Dict)
+async def rebuild_statistics(db: Database = Depends(get_db)):
+    """
+    Пересчет снимка статистики с нуля
+    """
+    try:
+        success = await db.rebuild_statistics()
+        if not success:
+            raise HTTPException(status_code=500, detail="Не удалось пересчитать статистику")
+        return {"message": "Статистика пересчитана", "success": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при пересчете статистики: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/user-balance", response_model=Dict)
 async def get_user_balance_info(db: Database = Depends(get_db)):
     """
@@ -147,32 +150,60 @@ async def get_user_balance_info(db: Database = Depends(get_db)):
 
 @router.get("/balance-transactions", response_model=Dict)
 async def get_all_balance_transactions(
-    skip: int = Query(0, ge=0, description="Количество пропускаемых записей (для пагинации)"),
-    limit: int = Query(100, ge=1, le=1000, description="Максимальное количество возвращаемых записей (для пагинации)"),
+    skip: int = Query(0, ge=0, description="Количество пропускаемых записей (устарело, используйте after)"),
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT, description="Максимальное количество возвращаемых записей (для пагинации)"),
     type_filter: Optional[str] = Query(None, description="Фильтр по типу транзакции"),
+    after: Optional[str] = Query(None, description="Курсор следующей страницы (next_cursor из предыдущего ответа)"),
     db: Database = Depends(get_db)
 ):
     """
     Получение всех транзакций баланса с пагинацией.
     
-    - **skip**: Количество пропускаемых записей (для пагинации)
+    - **skip**: Количество пропускаемых записей (для старых клиентов, игнорируется вместе с after)
     - **limit**: Максимальное количество возвращаемых записей (для пагинации)
     - **type_filter**: Фильтр по типу транзакции (опционально)
+    - **after**: Курсор следующей страницы
+    
+    total_count считается только для первой страницы (без after).
     
     Returns:
         Dict: Словарь со списком транзакций и информацией о пагинации
     """
     try:
-        result = await db.get_all_balance_transactions(skip=skip, limit=limit, type_filter=type_filter)
+        result = await db.get_all_balance_transactions(skip=skip, limit=limit, type_filter=type_filter, after=after)
         if not result:
             return {
                 "transactions": [],
                 "total_count": 0,
                 "limit": limit,
-                "offset": skip
+                "offset": skip,
+                "next_cursor": None
             }
         
         return result
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при получении всех транзакций баланса: {e}")
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e)) 
+@router.get("/db-pool", response_model=Dict)
+async def get_db_pool_stats(db: Database = Depends(get_db)):
+    """
+    Получение метрик пула соединений с базой данных
+    """
+    try:
+        return db.pool_stats()
+    except Exception as e:
+        logger.error(f"Ошибка при получении метрик пула соединений: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/settings-cache", response_model=Dict)
+async def get_settings_cache_stats(db: Database = Depends(get_db)):
+    """
+    Получение метрик кэша настроек
+    """
+    try:
+        return db.settings_cache_stats()
+    except Exception as e:
+        logger.error(f"Ошибка при получении метрик кэша настроек: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
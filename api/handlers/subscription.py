@@ -0,0 +1,54 @@
+from fastapi import APIRouter, HTTPException, Header
+from fastapi.responses import Response
+from typing import Optional
+import sys
+from loguru import logger
+
+from pathlib import Path
+root_path = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(root_path))
+
+from handlers.subscription_feed import subscription_feeds, etag_matches, SUBSCRIPTION_UPDATE_INTERVAL
+
+router = APIRouter(
+    prefix="/sub",
+    tags=["subscription"],
+    responses={404: {"description": "Подписка не найдена"}},
+)
+
+@router.get("/{token}")
+async def get_subscription_feed(
+    token: str,
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Подписка для VPN-приложений: ключи всех активных подписок пользователя
+    в base64, по одному в строке. Доступна без API ключа по токену пользователя.
+
+    Тело кэшируется до изменения подписок пользователя. Ответ содержит
+    ETag; на запрос с совпадающим If-None-Match возвращается 304 без тела.
+    Заголовок Subscription-Userinfo содержит расход трафика и дату окончания.
+
+    - **token**: Токен ссылки на подписку пользователя
+    """
+    try:
+        feed = await subscription_feeds.get(token)
+        if not feed:
+            raise HTTPException(status_code=404, detail="Подписка не найдена")
+
+        headers = {
+            "ETag": feed['etag'],
+            "Cache-Control": "no-cache",
+            "Subscription-Userinfo": feed['userinfo'],
+            "Profile-Update-Interval": str(SUBSCRIPTION_UPDATE_INTERVAL)
+        }
+        if if_none_match and etag_matches(if_none_match, feed['etag']):
+            return Response(status_code=304, headers=headers)
+
+        return Response(content=feed['body'], media_type="text/plain; charset=utf-8", headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        # Маршрут доступен без API ключа: текст исключения остается только в логе
+        logger.error(f"Ошибка при получении подписки по токену: {e}")
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
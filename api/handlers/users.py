@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
@@ -16,8 +16,11 @@ root_path = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(root_path))
 
 from handlers.database import Database
+from handlers.pagination import DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT, next_cursor
 
 from handlers.x_ui import xui_manager
+from handlers.subscription_feed import subscription_url
+from handlers.buy_subscribe import subscription_manager
 
 router = APIRouter(
     prefix="/users",
@@ -59,6 +62,9 @@ class BalanceUpdate(BaseModel):
     type: str
     description: Optional[str] = None
 
+class BalanceCreditBatch(BaseModel):
+    credits: List[BalanceUpdate] = Field(..., description="Зачисления, выполняются одной транзакцией")
+
 class Transaction(BaseModel):
     id: int
     user_id: int
@@ -76,6 +82,11 @@ class Subscription(BaseModel):
     vless_link: Optional[str] = None
     is_active: bool
 
+class SubscriptionExtend(BaseModel):
+    days: Optional[int] = Field(None, gt=0, description="На сколько дней продлить")
+    tariff_id: Optional[int] = Field(None, description="Продлить на срок тарифа (если days не указан)")
+    payment_id: Optional[str] = Field(None, description="ID платежа за продление (опционально)")
+
 class SubscriptionDueInNext10Days(BaseModel):
     telegram_id: int
     server_name: str
@@ -100,21 +111,35 @@ class CreateUserPayload(BaseModel):
     telegram_id: Optional[int] = Field(None, description="Telegram ID пользователя (опционально)")
     username: Optional[str] = Field(None, description="Username пользователя (опционально)")
 
+class CreateUserBatchPayload(BaseModel):
+    users: List[CreateUserPayload] = Field(
+        ..., min_length=1, max_length=MAX_PAGE_LIMIT,
+        description=f"Пользователи для создания на серверах (не больше {MAX_PAGE_LIMIT})"
+    )
+
 @router.get("/all", response_model=List[Optional[Dict]])
 async def get_all_users(
-    skip: int = 0,
-    limit: int = 100,
+    response: Response,
+    skip: int = Query(0, ge=0, description="Количество пропускаемых записей (устарело, используйте after)"),
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT, description="Максимальное количество возвращаемых записей"),
+    after: Optional[str] = Query(None, description="Курсор следующей страницы из заголовка X-Next-Cursor"),
     db: Database = Depends(get_db)
 ):
     """
     Получение списка всех пользователей с пагинацией.
     
-    - **skip**: Количество пропускаемых записей (для пагинации)
+    - **skip**: Количество пропускаемых записей (для старых клиентов, игнорируется вместе с after)
     - **limit**: Максимальное количество возвращаемых записей (для пагинации)
+    - **after**: Курсор следующей страницы, возвращается в заголовке X-Next-Cursor
     """
     try:
-        users = await db.get_all_users()
-        return users[skip:skip+limit]
+        users = await db.get_users_page(limit=limit, after=after, skip=skip)
+        cursor = next_cursor(users, limit)
+        if cursor:
+            response.headers["X-Next-Cursor"] = cursor
+        return users
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при получении всех пользователей: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -232,18 +257,42 @@ async def update_balance(update: BalanceUpdate, db: Database = Depends(get_db)):
         logger.error(f"Ошибка при обновлении баланса: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/balance/credit-batch")
+async def credit_balance_batch(batch: BalanceCreditBatch, db: Database = Depends(get_db)):
+    """
+    Зачисление на балансы нескольких пользователей одной транзакцией.
+    Либо зачисляются все суммы, либо ни одна.
+    """
+    try:
+        success = await db.credit_many([credit.dict() for credit in batch.credits])
+        if not success:
+            raise HTTPException(status_code=400, detail="Не удалось выполнить зачисления")
+        return {"message": "Зачисления выполнены", "count": len(batch.credits), "success": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при пакетном зачислении на балансы: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/{telegram_id}/transactions")
 async def get_user_transactions(
     telegram_id: int,
-    limit: int = 50,
+    response: Response,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_LIMIT),
+    after: Optional[str] = Query(None, description="Курсор следующей страницы из заголовка X-Next-Cursor"),
     db: Database = Depends(get_db)
 ):
     """
     Получение транзакций пользователя.
     """
     try:
-        transactions = await db.get_balance_transactions(telegram_id, limit)
+        transactions = await db.get_balance_transactions(telegram_id, limit, after=after)
+        cursor = next_cursor(transactions, limit)
+        if cursor:
+            response.headers["X-Next-Cursor"] = cursor
         return transactions
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при получении транзакций пользователя {telegram_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -253,6 +302,7 @@ async def get_user_transactions(
 async def get_user_subscriptions(telegram_id: int, db: Database = Depends(get_db)):
     """
     Получение всех подписок пользователя.
+    Для каждой подписки возвращается расход трафика в байтах (traffic_up, traffic_down).
     
     - **telegram_id**: Telegram ID пользователя
     """
@@ -262,6 +312,10 @@ async def get_user_subscriptions(telegram_id: int, db: Database = Depends(get_db
             raise HTTPException(status_code=404, detail="Пользователь не найден")
             
         subscriptions = await db.get_user_subscriptions(telegram_id)
+        traffic = await db.get_traffic_usage([sub['id'] for sub in subscriptions])
+        for sub in subscriptions:
+            sub['traffic_up'] = traffic[sub['id']]['up']
+            sub['traffic_down'] = traffic[sub['id']]['down']
         return subscriptions
     except HTTPException:
         raise
@@ -269,6 +323,102 @@ async def get_user_subscriptions(telegram_id: int, db: Database = Depends(get_db
         logger.error(f"Ошибка при получении подписок пользователя {telegram_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/{telegram_id}/subscriptions/{subscription_id}/extend", response_model=Dict)
+async def extend_user_subscription(
+    telegram_id: int,
+    subscription_id: int,
+    payload: SubscriptionExtend,
+    db: Database = Depends(get_db)
+):
+    """
+    Продление подписки без смены ключа: дата окончания меняется у той же
+    подписки и у того же клиента в панели, пользователю не нужно обновлять
+    ключ в приложении. Срок добавляется к текущей дате окончания
+    (к текущему моменту, если подписка уже истекла).
+    
+    - **telegram_id**: Telegram ID пользователя
+    - **subscription_id**: ID подписки
+    - **days**: На сколько дней продлить
+    - **tariff_id**: Продлить на срок тарифа, если days не указан; продление
+      с тарифом учитывается в статистике как покупка
+    """
+    try:
+        subscription = await db.get_subscription_with_server(subscription_id)
+        if not subscription or subscription['user_id'] != telegram_id:
+            raise HTTPException(status_code=404, detail="Подписка не найдена")
+        if not subscription['is_active']:
+            raise HTTPException(status_code=400, detail="Подписка не активна")
+
+        days = payload.days
+        if days is None:
+            if payload.tariff_id is None:
+                raise HTTPException(status_code=400, detail="Укажите days или tariff_id")
+            tariff = await db.get_tariff(payload.tariff_id)
+            if not tariff:
+                raise HTTPException(status_code=404, detail="Тариф не найден")
+            days = tariff['left_day']
+
+        extended = await subscription_manager.extend_subscription(
+            subscription_id, days, payload.payment_id, payload.tariff_id
+        )
+        if not extended:
+            raise HTTPException(status_code=500, detail="Не удалось продлить подписку на сервере")
+
+        return {
+            "success": True,
+            "subscription_id": subscription_id,
+            "days": days,
+            "end_date": extended['end_date'].strftime('%Y-%m-%d %H:%M:%S'),
+            "vless": extended['vless']
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при продлении подписки {subscription_id} пользователя {telegram_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/{telegram_id}/subscription-link", response_model=Dict)
+async def get_subscription_link(telegram_id: int, db: Database = Depends(get_db)):
+    """
+    Ссылка на подписку для VPN-приложений (GET /sub/{token}).
+    Токен создается при первом запросе; url заполняется, если задан SUBSCRIPTION_BASE_URL.
+    
+    - **telegram_id**: Telegram ID пользователя
+    """
+    try:
+        user = await db.get_user(telegram_id)
+        if not user:
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
+
+        token = await db.get_subscription_token(telegram_id)
+        return {"telegram_id": telegram_id, "token": token, "url": subscription_url(token)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при получении ссылки на подписку пользователя {telegram_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/{telegram_id}/subscription-link/reset", response_model=Dict)
+async def reset_subscription_link(telegram_id: int, db: Database = Depends(get_db)):
+    """
+    Замена токена ссылки на подписку (например, если ссылка попала к посторонним).
+    Старая ссылка перестает работать сразу.
+    
+    - **telegram_id**: Telegram ID пользователя
+    """
+    try:
+        user = await db.get_user(telegram_id)
+        if not user:
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
+
+        token = await db.reset_subscription_token(telegram_id)
+        return {"telegram_id": telegram_id, "token": token, "url": subscription_url(token)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при замене ссылки на подписку пользователя {telegram_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.delete("/{telegram_id}")
 async def disable_user(telegram_id: int, db: Database = Depends(get_db)):
     """
@@ -457,6 +607,108 @@ async def create_user_on_server(
         logger.error(f"Ошибка при создании пользователя на сервере: {e}")
         raise HTTPException(status_code=500, detail=str(e)) 
 
+@router.post("/create/batch", response_model=Dict)
+async def create_users_on_server_batch(
+    payload: CreateUserBatchPayload,
+    db: Database = Depends(get_db)
+):
+    """
+    Массовое создание пользователей на серверах 3xui.
+
+    Пользователи добавляются в базу одной транзакцией, затем клиенты
+    группируются по серверу и inbound и добавляются в панель пачками,
+    подписки созданных клиентов записываются одной транзакцией.
+    В одном запросе не больше MAX_PAGE_LIMIT пользователей.
+    Пользователи, которых не удалось создать, возвращаются с connect_link = null.
+    """
+    try:
+        tariffs = {}
+        for tariff_id in {user.tariff_id for user in payload.users}:
+            tariff = await db.get_tariff(tariff_id)
+            if not tariff:
+                raise HTTPException(status_code=404, detail=f"Тариф с ID {tariff_id} не найден")
+            if not tariff["is_enable"]:
+                raise HTTPException(status_code=400, detail=f"Тариф с ID {tariff_id} неактивен")
+            tariffs[tariff_id] = tariff
+
+        servers = {}
+        for server_id in {user.server_id for user in payload.users}:
+            server = await db.get_server_settings(server_id)
+            if not server:
+                raise HTTPException(status_code=404, detail=f"Сервер с ID {server_id} не найден")
+            if not server["is_enable"]:
+                raise HTTPException(status_code=400, detail=f"Сервер с ID {server_id} неактивен")
+            servers[server_id] = server
+
+        new_users = {}
+        for user in payload.users:
+            if user.telegram_id and user.telegram_id > 0:
+                new_users.setdefault(user.telegram_id, user.username or "")
+        known_users = await db.ensure_users(list(new_users.items()))
+        for telegram_id in new_users.keys() - known_users:
+            logger.warning(f"Не удалось создать пользователя в базе: {telegram_id}")
+
+        results = await xui_manager.provision_batch([
+            {
+                'server_settings': servers[user.server_id],
+                'telegram_id': user.telegram_id or random.randint(10000, 99999),
+                'left_day': tariffs[user.tariff_id]['left_day']
+            }
+            for user in payload.users
+        ])
+
+        created = []
+        for user, result in zip(payload.users, results):
+            vless_link = result['link']
+            if vless_link and "#" in vless_link:
+                base_link, _ = vless_link.split("#", 1)
+                vless_link = f"{base_link}#{user.email}@api_create"
+            created.append((user, result, vless_link))
+
+        subscriptions = [
+            (index, {
+                'user_id': user.telegram_id,
+                'tariff_id': user.tariff_id,
+                'server_id': user.server_id,
+                'end_date': result['end_date'].strftime("%Y-%m-%d %H:%M:%S"),
+                'vless': vless_link
+            })
+            for index, (user, result, vless_link) in enumerate(created)
+            if vless_link and user.telegram_id in known_users
+        ]
+        subscription_ids = dict(zip(
+            [index for index, _ in subscriptions],
+            await db.add_user_subscriptions([sub for _, sub in subscriptions])
+        ))
+
+        users_data = [
+            {
+                "email": user.email,
+                "telegram_id": user.telegram_id,
+                "server_id": user.server_id,
+                "tariff_id": user.tariff_id,
+                "expiry_date": result['end_date'].strftime("%Y-%m-%d %H:%M:%S"),
+                "subscription_id": subscription_ids.get(index),
+                "connect_link": vless_link
+            }
+            for index, (user, result, vless_link) in enumerate(created)
+        ]
+        created_count = sum(1 for item in users_data if item["connect_link"])
+        logger.info(f"Массовое создание пользователей: создано {created_count} из {len(users_data)}")
+
+        return {
+            "success": True,
+            "created": created_count,
+            "failed": len(users_data) - created_count,
+            "users": users_data
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при массовом создании пользователей на сервере: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/subscriptions/due-in-next-10-days", response_model=List[SubscriptionDueInNext10Days])
 async def get_subscriptions_due_in_next_10_days(db: Database = Depends(get_db)):
     """
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional
 import sys
@@ -10,6 +10,7 @@ root_path = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(root_path))
 
 from handlers.database import Database
+from handlers.pagination import DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT, next_cursor
 
 router = APIRouter(
     prefix="/yookassa",
@@ -35,7 +36,7 @@ async def get_yookassa_settings(db: Database = Depends(get_db)):
     Получение активных настроек YooKassa
     """
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             cursor = await conn.execute("""
                 SELECT id, name, shop_id, description, is_enable 
@@ -76,7 +77,7 @@ async def create_yookassa_settings(
     - **description**: Описание настройки (опционально)
     """
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute(
                 "UPDATE yookassa_settings SET is_enable = 0 WHERE is_enable = 1"
             )
@@ -109,7 +110,7 @@ async def delete_yookassa_settings(
     - **shop_id**: ID магазина YooKassa для удаления
     """
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             conn.row_factory = aiosqlite.Row
             
             cursor = await conn.execute(
@@ -139,17 +140,29 @@ async def delete_yookassa_settings(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/payments", response_model=Dict)
-async def get_all_payments(db: Database = Depends(get_db)):
+async def get_all_payments(
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT, description="Максимальное количество возвращаемых записей"),
+    after: Optional[str] = Query(None, description="Курсор следующей страницы (next_cursor из предыдущего ответа)"),
+    skip: int = Query(0, ge=0, description="Количество пропускаемых записей (устарело, используйте after)"),
+    db: Database = Depends(get_db)
+):
     """
     Получение списка всех платежей через
+    
+    - **limit**: Максимальное количество возвращаемых записей
+    - **after**: Курсор следующей страницы
+    - **skip**: Количество пропускаемых записей (для старых клиентов)
     """
     try:
-        payments = await db.get_all_payments()
+        payments = await db.get_all_payments(limit=limit, after=after, skip=skip)
         return {
             "payments": payments,
             "total_count": len(payments),
+            "next_cursor": next_cursor(payments, limit),
             "success": True
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при получении списка платежей: {e}")
         raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
@@ -13,9 +13,11 @@ from api.handlers import (
     users, servers, tariffs, api_keys, trial, pay_code,
     promocode, statistic, broadcast, promo, yookassa,
     raffle, bot_message, cryptopay, referral, bot_settings,
-    pspayments
+    pspayments, subscription
 )
 from api.middleware.auth import get_api_key
+from handlers.database import Database
+from handlers.xui_session import panel_sessions
 
 app = FastAPI(
     title="SlickUX API",
@@ -31,12 +33,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("shutdown")
+async def close_database():
+    await panel_sessions.close()
+    await Database().close()
+
 @app.get("/api/health")
 async def health_check():
     return {"status": "OK"}
 
 app.include_router(api_keys.router, prefix="/api/v1")
 
+# Подписка для VPN-приложений: доступ по токену пользователя, без API ключа
+app.include_router(subscription.router)
+
 app.include_router(
     users.router, 
     prefix="/api/v1", 
@@ -1,22 +1,34 @@
+"""
+Резервное копирование базы данных без остановки бота.
+
+Запуск: python backup_db.py [путь к базе] [--compress] [--keep N]
+Копия снимается через sqlite3 backup API небольшими шагами, проверяется
+PRAGMA integrity_check и сохраняется в instance/backup, старые копии
+сверх --keep удаляются. Тот же механизм работает по расписанию в
+процессе бота (handlers/backup.py, BACKUP_INTERVAL_HOURS).
+"""
 import os
-import sqlite3
-from datetime import datetime
+import sys
+import argparse
+from loguru import logger
 
-source_db = 'instance/database.db'
-backup_dir = 'instance/backup'
+from handlers.backup import create_backup, DEFAULT_DB_PATH, BACKUP_DIR, BACKUP_KEEP, BACKUP_COMPRESS
 
-if not os.path.exists(backup_dir):
-    os.makedirs(backup_dir)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Резервное копирование базы данных")
+    parser.add_argument('db_path', nargs='?', default=DEFAULT_DB_PATH)
+    parser.add_argument('--dir', default=BACKUP_DIR, help="каталог для копий")
+    parser.add_argument('--keep', type=int, default=BACKUP_KEEP, help="сколько последних копий хранить")
+    parser.add_argument('--compress', action='store_true', default=BACKUP_COMPRESS, help="сжимать копию в gzip")
+    args = parser.parse_args()
 
-timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-backup_db = os.path.join(backup_dir, f'database-{timestamp}.db')
+    os.makedirs('logs', exist_ok=True)
+    logger.add("logs/backup_db.log", rotation="1 day", compression="zip",
+               encoding="utf-8", format="{time} | {level} | {message}")
 
-try:
-    conn = sqlite3.connect(source_db)
-    cursor = conn.cursor()
-    cursor.execute(f"VACUUM INTO '{backup_db}'")
-    conn.close()
-    print(f'Резервная копия создана (VACUUM): {backup_db}')
-except sqlite3.OperationalError:
-    print("VACUUM INTO не поддерживается, используем метод с копированием файлов.")
+    if not os.path.exists(args.db_path):
+        logger.error(f"База данных не найдена: {args.db_path}")
+        sys.exit(1)
 
+    path = create_backup(args.db_path, backup_dir=args.dir, keep=args.keep, compress=args.compress)
+    sys.exit(0 if path else 1)
@@ -44,6 +44,14 @@ from handlers.user.user_pay_code import router as user_pay_code_router
 from handlers.user.user_cryptopay import router as user_cryptopay_router
 from handlers.admin.admin_answer import router as admin_answer_router
 from handlers.sub_scheduler import start_scheduler
+from handlers.backup import start_backup_scheduler
+from handlers.expiry_sweeper import start_expiry_sweeper
+from handlers.traffic_collector import start_traffic_collector
+from handlers.health_monitor import health_monitor, start_health_monitor
+from handlers.provisioning import start_provisioning_workers
+from handlers.key_pool import start_key_pool
+from handlers.evacuation import start_evacuation_worker
+from handlers.xui_session import panel_sessions
 from handlers.crypto_pay import crypto_pay_manager
 from handlers.admin.admin_pay_menu import router as admin_pay_menu_router
 from handlers.user.user_raffle import router as user_raffle_router
@@ -147,6 +155,13 @@ async def bot_start():
     
     
     asyncio.create_task(start_scheduler(bot))
+    asyncio.create_task(start_backup_scheduler())
+    asyncio.create_task(start_expiry_sweeper())
+    asyncio.create_task(start_traffic_collector())
+    asyncio.create_task(start_health_monitor())
+    asyncio.create_task(start_provisioning_workers(bot))
+    asyncio.create_task(start_key_pool())
+    asyncio.create_task(start_evacuation_worker(bot))
     
     try:
         logger.info("Бот запущен")
@@ -155,4 +170,7 @@ async def bot_start():
         logger.error(f"Ошибка при работе бота: {e}")
     finally:
         await bot.session.close()
+        await panel_sessions.close()
+        await health_monitor.close()
+        await db.close()
         logger.info("Бот остановлен")
@@ -0,0 +1,240 @@
+"""
+Проверка планов частых запросов (EXPLAIN QUERY PLAN).
+
+Запуск: python check_query_plan.py [путь к базе]
+Завершается с кодом 1, если хотя бы один запрос читает большую таблицу
+полным сканированием или не выполняется на схеме базы (переименованная
+колонка, опечатка). Индексы создаются в Database.create_indexes().
+
+HOT_QUERIES — копии SQL из методов Database, сами по себе они с кодом
+не связаны: при изменении запроса в Database или добавлении нового
+частого запроса к большой таблице его нужно поправить или добавить здесь
+в том же изменении. Базу для проверки нужно предварительно обновить до
+текущей схемы (init_db), иначе запросы к новым колонкам не выполнятся.
+"""
+import re
+import sys
+import sqlite3
+
+DEFAULT_DB_PATH = 'instance/database.db'
+
+# Таблицы, которые растут вместе с числом пользователей.
+# Справочники (tariff, server_settings и т.п.) можно сканировать.
+HOT_TABLES = {
+    'user', 'user_subscription', 'payments', 'promocodes', 'raffle_tickets',
+    'user_balance', 'balance_transactions', 'referral_progress',
+    'referral_rewards_history', 'crypto_payments', 'provisioning_jobs',
+    'subscription_tokens', 'subscription_renewals',
+}
+
+HOT_QUERIES = (
+    ('get_user', "SELECT * FROM user WHERE telegram_id = ?"),
+    ('find_user_by_name', "SELECT * FROM user WHERE username = ?"),
+    ('transfer_recipient',
+     "SELECT telegram_id, username FROM user WHERE telegram_id = ? OR LOWER(username) = LOWER(?)"),
+    ('admin_users_page',
+     "SELECT id, username, date, trial_period, is_enable FROM user WHERE id < ? ORDER BY id DESC LIMIT ?"),
+    ('users_page', "SELECT * FROM user WHERE id > ? ORDER BY id LIMIT ?"),
+    ('user_active_subscriptions', """
+        SELECT us.*, s.name as server_name FROM user_subscription us
+        JOIN server_settings s ON us.server_id = s.id
+        WHERE us.user_id = ? AND us.is_active = 1 ORDER BY us.end_date DESC
+    """),
+    ('user_last_vless',
+     "SELECT vless FROM user_subscription WHERE user_id = ? AND is_active = 1 ORDER BY end_date DESC LIMIT 1"),
+    ('user_subscriptions', """
+        SELECT us.*, t.name as tariff_name, s.name as server_name FROM user_subscription us
+        JOIN tariff t ON us.tariff_id = t.id
+        JOIN server_settings s ON us.server_id = s.id
+        WHERE us.user_id = ? ORDER BY us.end_date DESC
+    """),
+    ('expiring_subscriptions', """
+        SELECT * FROM user_subscription WHERE is_active = 1 AND end_ts BETWEEN ? AND ?
+    """),
+    ('expired_subscriptions_sweep', """
+        SELECT us.id, us.vless, ss.url, COALESCE(us.inbound_id, ss.inbound_id) FROM user_subscription us
+        LEFT JOIN server_settings ss ON ss.id = us.server_id
+        WHERE us.is_active = 1 AND us.end_ts < ? AND us.end_ts >= ? AND (us.end_ts > ? OR us.id > ?)
+        ORDER BY us.end_ts, us.id LIMIT ?
+    """),
+    ('server_subscriptions_page', """
+        SELECT id, user_id, vless, end_ts FROM user_subscription
+        WHERE server_id = ? AND is_active = 1 AND id > ? ORDER BY id LIMIT ?
+    """),
+    ('subscriptions_due_in_10_days', """
+        SELECT us.user_id, ss.name, t.name, us.end_date FROM user_subscription us
+        LEFT JOIN server_settings ss ON us.server_id = ss.id
+        LEFT JOIN tariff t ON us.tariff_id = t.id
+        WHERE us.is_active = 1
+        AND us.end_ts BETWEEN CAST(strftime('%s', 'now') AS INTEGER)
+            AND CAST(strftime('%s', 'now', '+10 days') AS INTEGER)
+        ORDER BY us.end_ts ASC
+    """),
+    ('subscription_by_payment', """
+        SELECT id, user_id, vless, end_date FROM user_subscription WHERE payment_id = ?
+        UNION ALL
+        SELECT us.id, us.user_id, us.vless, us.end_date FROM subscription_renewals r
+        JOIN user_subscription us ON us.id = r.subscription_id
+        WHERE r.payment_id = ? LIMIT 1
+    """),
+    ('renewable_subscription', """
+        SELECT us.id FROM user_subscription us
+        JOIN server_settings s ON s.id = us.server_id
+        WHERE us.user_id = ? AND us.is_active = 1 AND us.tariff_id = ?
+        AND us.end_ts > ? AND s.is_enable = 1
+        ORDER BY us.end_ts LIMIT 1
+    """),
+    ('provisioning_claim', """
+        SELECT id FROM provisioning_jobs
+        WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT 1
+    """),
+    ('provisioning_job', "SELECT * FROM provisioning_jobs WHERE payment_id = ?"),
+    ('subscription_token_version', "SELECT user_id, version FROM subscription_tokens WHERE token = ?"),
+    ('subscription_feed_links', """
+        SELECT id, vless, end_ts FROM user_subscription
+        WHERE user_id = ? AND is_active = 1 ORDER BY end_date DESC
+    """),
+    ('server_active_subscriptions',
+     "SELECT COUNT(*) FROM user_subscription WHERE server_id = ? AND is_active = 1"),
+    ('user_payments_total', "SELECT SUM(price) as total FROM payments WHERE user_id = ?"),
+    ('user_payments', """
+        SELECT p.*, t.name as tariff_name FROM payments p
+        JOIN tariff t ON p.tariff_id = t.id
+        WHERE p.user_id = ? ORDER BY p.date DESC
+    """),
+    ('last_payment', """
+        SELECT p.price, p.date as payment_date, u.username, u.telegram_id FROM payments p
+        JOIN user u ON p.user_id = u.telegram_id
+        ORDER BY p.date DESC LIMIT 1
+    """),
+    ('promocode', "SELECT * FROM promocodes WHERE promocod = ?"),
+    ('promocode_activate', "UPDATE promocodes SET activation_total = activation_total + 1 WHERE promocod = ?"),
+    ('user_raffle_tickets',
+     "SELECT ticket_number FROM raffle_tickets WHERE telegram_id = ? AND raffle_id = ? ORDER BY created_at"),
+    ('raffle_participants_count',
+     "SELECT COUNT(DISTINCT telegram_id) as total_participants FROM raffle_tickets WHERE raffle_id = ?"),
+    ('user_balance', "SELECT balance FROM user_balance WHERE user_id = ?"),
+    ('user_balance_transactions', """
+        SELECT amount, type, description, created_at FROM balance_transactions
+        WHERE user_id = ? ORDER BY created_at DESC LIMIT 5
+    """),
+    ('all_balance_transactions', """
+        SELECT bt.*, u.username FROM balance_transactions bt
+        LEFT JOIN user u ON bt.user_id = u.telegram_id
+        WHERE bt.id < ? ORDER BY bt.id DESC LIMIT ? OFFSET ?
+    """),
+    ('user_balance_transactions_page', """
+        SELECT * FROM balance_transactions WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?
+    """),
+    ('all_payments_page', """
+        SELECT p.id, u.username, t.name FROM payments p
+        LEFT JOIN user u ON p.user_id = u.telegram_id
+        LEFT JOIN tariff t ON p.tariff_id = t.id
+        WHERE p.id < ? ORDER BY p.id DESC LIMIT ? OFFSET ?
+    """),
+    ('referral_progress', "SELECT total_invites FROM referral_progress WHERE user_id = ?"),
+    ('referral_reward_given',
+     "SELECT id FROM referral_rewards_history WHERE user_id = ? AND condition_id = ?"),
+    ('crypto_payment', "SELECT * FROM crypto_payments WHERE invoice_id = ?"),
+)
+
+# Колонка пользователя в таблицах с записями пользователей. Если запрос
+# фильтрует по ней, поиск по таблице должен идти по индексу, который ее
+# ограничивает: индекс по другим колонкам (is_active, end_ts) читает
+# диапазон строк всех пользователей, хотя план и не содержит SCAN.
+USER_KEYS = {
+    'user_subscription': 'user_id',
+    'payments': 'user_id',
+    'balance_transactions': 'user_id',
+}
+
+SCAN_PATTERN = re.compile(r'^SCAN (\w+)(?: AS (\w+))?(.*)$')
+SEARCH_INDEX_PATTERN = re.compile(r'^SEARCH (\w+) USING (?:COVERING )?INDEX \S+ \((.*)\)')
+TABLE_REF_PATTERN = re.compile(r'\b(?:FROM|JOIN|UPDATE)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+SQL_KEYWORDS = {'WHERE', 'JOIN', 'LEFT', 'INNER', 'CROSS', 'ON', 'SET', 'ORDER', 'GROUP', 'LIMIT', 'UNION', 'USING'}
+
+
+def table_names(sql: str) -> dict:
+    """Имя в плане запроса (таблица или псевдоним) -> таблица"""
+    names = {}
+    for table, alias in TABLE_REF_PATTERN.findall(sql):
+        names[table] = table
+        if alias and alias.upper() not in SQL_KEYWORDS:
+            names[alias] = table
+    return names
+
+
+def full_scans(plan_details, tables, names=None):
+    """Таблицы из tables, которые читаются без индекса"""
+    names = names or {}
+    result = []
+    for detail in plan_details:
+        match = SCAN_PATTERN.match(detail)
+        if not match or 'INDEX' in match.group(3):
+            continue
+        table = names.get(match.group(1), match.group(1))
+        if table in tables:
+            result.append(table)
+    return result
+
+
+def unscoped_searches(sql: str, plan_details, names: dict):
+    """
+    Таблицы из USER_KEYS, которые запрос фильтрует по пользователю,
+    а план ищет по индексу без колонки пользователя
+    """
+    result = []
+    for detail in plan_details:
+        match = SEARCH_INDEX_PATTERN.match(detail)
+        if not match:
+            continue
+        name, constraint = match.groups()
+        table = names.get(name, name)
+        key = USER_KEYS.get(table)
+        if not key or f'{key}=' in constraint.replace(' ', ''):
+            continue
+        qualifiers = {alias for alias, target in names.items() if target == table}
+        filters = re.findall(rf'\b(?:(\w+)\.)?{key}\s*=\s*\?', sql)
+        if any(not qualifier or qualifier in qualifiers for qualifier in filters):
+            result.append(table)
+    return result
+
+
+def check_query_plans(db_path: str = DEFAULT_DB_PATH) -> bool:
+    """Проверка всех HOT_QUERIES, True если все запросы выполняются без полных сканирований"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    failed = 0
+    try:
+        for name, query in HOT_QUERIES:
+            sql = ' '.join(query.split())
+            try:
+                rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", (None,) * sql.count('?')).fetchall()
+            except sqlite3.OperationalError as e:
+                failed += 1
+                print(f"[FAIL] {name}: запрос не выполняется: {e}")
+                continue
+
+            details = [row[3] for row in rows]
+            names = table_names(sql)
+            scans = full_scans(details, HOT_TABLES, names)
+            unscoped = unscoped_searches(sql, details, names)
+            if scans or unscoped:
+                failed += 1
+                if scans:
+                    print(f"[FAIL] {name}: полное сканирование {', '.join(scans)}")
+                if unscoped:
+                    print(f"[FAIL] {name}: поиск без индекса по пользователю {', '.join(unscoped)}")
+                for detail in details:
+                    print(f"       {detail}")
+            else:
+                print(f"[ OK ] {name}: {'; '.join(details)}")
+    finally:
+        conn.close()
+
+    print(f"Проверено запросов: {len(HOT_QUERIES)}, с ошибкой или полным сканированием: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DB_PATH
+    sys.exit(0 if check_query_plans(path) else 1)
@@ -7,6 +7,7 @@ import aiosqlite
 from handlers.database import db
 from handlers.admin.admin_kb import get_admin_keyboard, get_servers_keyboard
 from handlers.admin.check_server import check_all_servers
+from handlers.circuit_breaker import circuit_breakers
 from handlers.commands import start_command
 
 router = Router()
@@ -44,11 +45,15 @@ async def format_server_list(servers: list) -> str:
         result += f"<b>Наименование:</b> {server['name']}\n"
         result += f"<b>IP:</b> {server['ip'] if server['ip'] else 'Не указан'}\n"
         result += f"<b>Статус:</b> {'Доступен для регистрации' if server['is_enable'] else 'Временно недоступен'}\n"
-        if server.get('available'):
+        if server.get('available') and server.get('delay') is not None:
             result += f"<b>Задержка:</b> {server['delay']}ms\n"
             result += f"<b>Код ответа:</b> {'ОК' if server.get('status_code') == 404 else server.get('status_code', 'Неизвестно')}\n"
         else:
             result += "<b>Сервер недоступен (нет ответа)</b>\n"
+        if server.get('probes'):
+            result += f"<b>Доступность:</b> {server['uptime']}% (проверок: {server['probes']})\n"
+        if not circuit_breakers.available(server['id']):
+            result += "<b>Панель:</b> запросы приостановлены после ошибок\n"
         result += "</blockquote>\n"
     
     return result   
@@ -125,7 +130,7 @@ async def process_show_payments(callback: CallbackQuery):
     try:
         await callback.message.delete()
 
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             
             async with conn.execute(
@@ -226,7 +231,7 @@ async def update_servers_list(callback: CallbackQuery):
             await callback.answer("Серверы не найдены в базе данных")
             return
         
-        servers = await check_all_servers(servers)
+        servers = await check_all_servers(servers, refresh=True)
         
         message_text = await format_server_list(servers)
         
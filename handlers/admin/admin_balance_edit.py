@@ -4,7 +4,6 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from handlers.database import Database
 from handlers.admin.admin_kb import get_admin_add_users_balance_keyboard, get_admin_balance_back_edit_keyboard
 from handlers.user.user_kb import get_user_balance_keyboard, get_user_edit_balance_keyboard
-import aiosqlite
 from loguru import logger
 from datetime import datetime
 import re
@@ -45,7 +44,7 @@ async def show_add_balance_menu(callback: CallbackQuery):
             username_match = re.search(r'<b>(.*?)</b>', message_text)
             if username_match:
                 username = username_match.group(1)
-                async with aiosqlite.connect(db.db_path) as conn:
+                async with db.acquire() as conn:
                     async with conn.execute(
                         "SELECT telegram_id FROM user WHERE username = ?",
                         (username,)
@@ -57,7 +56,7 @@ async def show_add_balance_menu(callback: CallbackQuery):
             await callback.answer("Ошибка: пользователь не найден")
             return
             
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             async with conn.execute(
                 "SELECT username FROM user WHERE telegram_id = ?",
                 (user_id,)
@@ -93,73 +92,44 @@ async def process_balance_add(callback: CallbackQuery):
         db = Database()
         logger.info(f"Начало пополнения баланса администратором для пользователя {user_id} на сумму {amount} руб.")
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             async with conn.execute(
                 "SELECT username FROM user WHERE telegram_id = ?",
                 (user_id,)
             ) as cursor:
                 user = await cursor.fetchone()
                 username = user[0] if user else f"ID: {user_id}"
-            
-            async with conn.execute(
-                "SELECT balance FROM user_balance WHERE user_id = ?",
-                (user_id,)
-            ) as cursor:
-                current_balance = await cursor.fetchone()
-            
-            if current_balance:
-                logger.info(f"Обновление существующего баланса пользователя {user_id}. "
-                          f"Текущий баланс: {current_balance[0]}, сумма пополнения: {amount}")
-                await conn.execute(
-                    """
-                    UPDATE user_balance 
-                    SET balance = balance + ?, last_update = CURRENT_TIMESTAMP 
-                    WHERE user_id = ?
-                    """,
-                    (amount, user_id)
-                )
-            else:
-                logger.info(f"Создание нового баланса для пользователя {user_id} с суммой {amount}")
-                await conn.execute(
-                    """
-                    INSERT INTO user_balance (user_id, balance) 
-                    VALUES (?, ?)
-                    """,
-                    (user_id, amount)
-                )
-            
-            await conn.execute(
-                """
-                INSERT INTO balance_transactions 
-                (user_id, amount, type, description) 
-                VALUES (?, ?, 'deposit', 'Пополнение баланса администратором')
-                """,
-                (user_id, amount)
-            )
-            
-            await conn.commit()
-            logger.info(f"Баланс пользователя {user_id} успешно пополнен на {amount} руб.")
-            
-            try:
-                await callback.bot.send_message(
-                    chat_id=user_id,
-                    text="💰 Ваш баланс пополнен администратором!\n\n"
-                         f"Сумма пополнения: <b>{amount:.2f}</b> руб.",
-                    parse_mode="HTML",
-                    reply_markup=get_user_edit_balance_keyboard()
-                )
-                logger.info(f"Уведомление о пополнении баланса отправлено пользователю {user_id}")
-            except Exception as e:
-                logger.error(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
-            
-            await callback.message.edit_text(
-                "✅ Баланс успешно пополнен!\n\n"
-                f"Пользователь: <b>{username}</b>\n"
-                f"Сумма: <b>{amount:.2f}</b> руб.",
+
+        new_balance = await db.credit(
+            user_id=user_id,
+            amount=amount,
+            type='deposit',
+            description='Пополнение баланса администратором'
+        )
+        if new_balance is None:
+            raise RuntimeError("не удалось зачислить средства")
+        logger.info(f"Баланс пользователя {user_id} успешно пополнен на {amount} руб., новый баланс: {new_balance}")
+        
+        try:
+            await callback.bot.send_message(
+                chat_id=user_id,
+                text="💰 Ваш баланс пополнен администратором!\n\n"
+                     f"Сумма пополнения: <b>{amount:.2f}</b> руб.",
                 parse_mode="HTML",
-                reply_markup=get_admin_balance_back_edit_keyboard()
+                reply_markup=get_user_edit_balance_keyboard()
             )
-            
+            logger.info(f"Уведомление о пополнении баланса отправлено пользователю {user_id}")
+        except Exception as e:
+            logger.error(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
+        
+        await callback.message.edit_text(
+            "✅ Баланс успешно пополнен!\n\n"
+            f"Пользователь: <b>{username}</b>\n"
+            f"Сумма: <b>{amount:.2f}</b> руб.",
+            parse_mode="HTML",
+            reply_markup=get_admin_balance_back_edit_keyboard()
+        )
+        
     except Exception as e:
         logger.error(f"Ошибка при пополнении баланса пользователя {user_id}: {e}")
         await callback.message.edit_text(
@@ -183,7 +153,7 @@ async def start_reset_balance(callback: CallbackQuery, state: FSMContext):
             username_match = re.search(r'<b>(.*?)</b>', message_text)
             if username_match:
                 username = username_match.group(1)
-                async with aiosqlite.connect(db.db_path) as conn:
+                async with db.acquire() as conn:
                     async with conn.execute(
                         "SELECT telegram_id FROM user WHERE username = ?",
                         (username,)
@@ -226,7 +196,7 @@ async def process_reset_balance(message: Message, state: FSMContext):
         db = Database()
         logger.info(f"Проверка баланса пользователя {user_id} для обнуления")
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             async with conn.execute(
                 """
                 SELECT ub.balance, u.username 
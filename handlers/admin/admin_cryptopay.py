@@ -37,7 +37,7 @@ async def show_crypto_settings(callback: CallbackQuery):
             await callback.answer("У вас нет прав для выполнения этого действия")
             return
 
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute('SELECT * FROM crypto_settings LIMIT 1') as cursor:
                 settings = await cursor.fetchone()
@@ -139,7 +139,7 @@ async def process_assets(message: Message, state: FSMContext):
             await state.clear()
             return
 
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute("""
                 INSERT OR REPLACE INTO crypto_settings 
                 (api_token, min_amount, supported_assets, is_enable)
@@ -167,7 +167,7 @@ async def process_assets(message: Message, state: FSMContext):
 async def delete_settings(callback: CallbackQuery):
     """Удаление настроек Crypto Pay"""
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute('DELETE FROM crypto_settings')
             await conn.commit()
 
@@ -190,7 +190,7 @@ async def update_assets(callback: CallbackQuery):
         currencies = await crypto_pay_manager.api.get_currencies()
         assets = [curr['code'] for curr in currencies]
 
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute(
                 'UPDATE crypto_settings SET supported_assets = ?',
                 (json.dumps(assets),)
@@ -14,7 +14,7 @@ async def show_notifications_settings(callback: CallbackQuery):
     try:
         await callback.message.delete()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT reg_notify, pay_notify
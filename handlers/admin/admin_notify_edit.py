@@ -3,7 +3,6 @@ from aiogram.types import CallbackQuery, Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-import aiosqlite
 from loguru import logger
 
 from handlers.database import db
@@ -78,7 +77,7 @@ async def process_pay_notify(message: Message, state: FSMContext):
         data = await state.get_data()
         reg_notify = data.get('reg_notify')
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute("""
                 UPDATE bot_settings 
                 SET reg_notify = ?, pay_notify = ?
@@ -130,7 +129,7 @@ async def turn_off_notifications(callback: CallbackQuery):
     try:
         await callback.message.delete()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute("""
                 UPDATE bot_settings 
                 SET reg_notify = 0, pay_notify = 0
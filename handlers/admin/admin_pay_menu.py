@@ -16,7 +16,7 @@ async def show_payment_settings(callback: CallbackQuery):
             await callback.answer("У вас нет прав для выполнения этого действия")
             return
 
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             
             yookassa = await conn.execute(
@@ -26,7 +26,7 @@ async def get_promo_tariffs_keyboard():
     """Создание клавиатуры с промо-тарифами"""
     keyboard = InlineKeyboardBuilder()
     
-    async with aiosqlite.connect(db.db_path) as conn:
+    async with db.acquire() as conn:
         conn.row_factory = aiosqlite.Row
         async with conn.execute("""
             SELECT tp.*, s.name as server_name 
@@ -68,7 +68,7 @@ async def process_tariff_selection(callback: CallbackQuery, state: FSMContext):
     try:
         tariff_id = int(callback.data.split(":")[1])
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT tp.*, s.name as server_name, s.* 
@@ -121,7 +121,7 @@ async def process_username(message: Message, state: FSMContext):
         data = await state.get_data()
         tariff = data['tariff']
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute(
                 "SELECT * FROM user WHERE username = ? AND is_enable = 1",
@@ -155,7 +155,7 @@ async def process_username(message: Message, state: FSMContext):
             await state.clear()
             return
 
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute("""
                 INSERT INTO user_subscription 
                 (user_id, tariff_id, server_id, end_date, vless, is_active)
@@ -25,7 +25,7 @@ async def show_promo_tariffs(callback: CallbackQuery):
     try:
         await callback.message.delete()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT tp.*, s.name as server_name
@@ -98,7 +98,7 @@ async def process_delete_promo_tariff(message: Message, state: FSMContext):
     try:
         tariff_id = int(message.text.strip())
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             conn.row_factory = aiosqlite.Row
             
             async with conn.execute("""
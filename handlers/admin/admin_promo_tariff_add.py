@@ -27,7 +27,7 @@ async def get_servers_keyboard():
     """Создание клавиатуры с серверами"""
     keyboard = InlineKeyboardBuilder()
     
-    async with aiosqlite.connect(db.db_path) as conn:
+    async with db.acquire() as conn:
         conn.row_factory = aiosqlite.Row
         async with conn.execute("""
             SELECT id, name 
@@ -106,7 +106,7 @@ async def process_server_selection(callback: CallbackQuery, state: FSMContext):
         server_id = int(callback.data.split(":")[1])
         data = await state.get_data()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute("""
                 INSERT INTO tariff_promo (name, description, left_day, server_id, is_enable)
                 VALUES (?, ?, ?, ?, 1)
@@ -30,7 +30,7 @@ async def process_show_promocodes(callback: CallbackQuery):
     try:
         await callback.message.delete()
 
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT promocod, activation_limit, activation_total, percentage
@@ -142,7 +142,7 @@ async def process_percentage(message: Message, state: FSMContext):
         
         promocode = generate_promocode()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute("""
                 INSERT INTO promocodes (promocod, activation_limit, percentage, is_enable)
                 VALUES (?, ?, ?, 1)
@@ -201,7 +201,7 @@ async def process_delete_promocode(callback: CallbackQuery, state: FSMContext):
 async def process_delete_promo_code(message: Message, state: FSMContext):
     """Обработчик ввода промокода для удаления"""
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             async with conn.execute(
                 "SELECT promocod FROM promocodes WHERE promocod = ? AND is_enable = 1",
                 (message.text,)
@@ -34,7 +34,7 @@ async def show_referral_menu(event):
         else:
             message_text += "\n❌ Нет настроенных условий"
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             cursor = await conn.execute("""
                 SELECT 
@@ -121,7 +121,7 @@ async def add_condition_reward(message: Message, state: FSMContext):
         
         data = await state.get_data()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute("""
                 INSERT INTO referral_condition (name, description, invitations, reward_sum)
                 VALUES (?, ?, ?, ?)
@@ -248,7 +248,7 @@ async def confirm_delete_condition(callback: CallbackQuery):
     """Удалить выбранное условие"""
     condition_id = int(callback.data.split('_')[2])
     
-    async with aiosqlite.connect(db.db_path) as conn:
+    async with db.acquire(write=True) as conn:
         await conn.execute(
             "DELETE FROM referral_condition WHERE id = ?",
             (condition_id,)
@@ -290,7 +290,7 @@ async def process_edit_value(message: Message, state: FSMContext):
         else:
             raise ValueError("Неизвестное поле")
 
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute(f"""
                 UPDATE referral_condition 
                 SET {db_field} = ?
@@ -323,7 +323,7 @@ async def update_condition_status(callback: CallbackQuery, state: FSMContext):
         condition_id = data['condition_id']
         new_status = int(callback.data.split('_')[2])  # 0 или 1
 
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute("""
                 UPDATE referral_condition 
                 SET is_enable = ?
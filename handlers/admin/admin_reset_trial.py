@@ -41,7 +41,7 @@ async def process_reset_trial(callback: CallbackQuery, state: FSMContext):
 async def process_username_input(message: Message, state: FSMContext):
     """Обработчик ввода имени пользователя"""
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute(
                 "SELECT * FROM user WHERE username = ?",
@@ -3,7 +3,6 @@ from aiogram.types import CallbackQuery, Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-import aiosqlite
 from loguru import logger
 
 from handlers.database import db
@@ -26,7 +25,7 @@ async def start_notification(callback: CallbackQuery, state: FSMContext):
     try:
         await callback.message.delete()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             async with conn.execute("""
                 SELECT COUNT(*) as count 
                 FROM user 
@@ -64,7 +63,7 @@ async def process_notification(message: Message, state: FSMContext):
         success_count = 0
         error_count = 0
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             async with conn.execute("""
                 SELECT telegram_id 
                 FROM user 
@@ -4,7 +4,6 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from loguru import logger
-import aiosqlite
 
 from handlers.database import db
 from handlers.admin.admin_kb import get_servers_keyboard
@@ -168,7 +167,7 @@ async def process_name(message: Message, state: FSMContext):
         name = message.text.strip()
         data = await state.get_data()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute("""
                 INSERT INTO server_settings 
                 (url, port, secret_path, username, password, name, inbound_id, protocol, is_enable)
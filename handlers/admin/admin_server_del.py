@@ -8,6 +8,7 @@ import aiosqlite
 
 from handlers.database import db
 from handlers.admin.admin_kb import get_servers_keyboard
+from handlers.evacuation import start_evacuation
 
 router = Router()
 
@@ -18,7 +19,7 @@ async def get_server_list_keyboard():
     """Создание клавиатуры со списком серверов"""
     keyboard = InlineKeyboardBuilder()
     
-    async with aiosqlite.connect(db.db_path) as conn:
+    async with db.acquire() as conn:
         conn.row_factory = aiosqlite.Row
         cursor = await conn.execute(
             "SELECT id, name FROM server_settings WHERE is_enable = 1"
@@ -35,9 +36,14 @@ async def get_server_list_keyboard():
     keyboard.adjust(1)
     return keyboard.as_markup()
 
-def get_confirmation_keyboard(server_id: int):
+def get_confirmation_keyboard(server_id: int, active_subscriptions: int = 0):
     """Создание клавиатуры подтверждения удаления"""
     keyboard = InlineKeyboardBuilder()
+    if active_subscriptions:
+        keyboard.button(
+            text="🚚 Перенести подписки и удалить",
+            callback_data=f"evacuate_server:{server_id}"
+        )
     keyboard.button(
         text="✅ Подтвердить",
         callback_data=f"confirm_delete_server:{server_id}"
@@ -46,9 +52,44 @@ def get_confirmation_keyboard(server_id: int):
         text="❌ Отмена",
         callback_data="cancel_delete_server"
     )
-    keyboard.adjust(2)
+    if active_subscriptions:
+        keyboard.adjust(1, 2)
+    else:
+        keyboard.adjust(2)
+    return keyboard.as_markup()
+
+def get_evacuation_keyboard(job_id: int):
+    """Клавиатура прогресса переноса"""
+    keyboard = InlineKeyboardBuilder()
+    keyboard.button(text="🔄 Обновить", callback_data=f"evacuation_status:{job_id}")
+    keyboard.button(text="🔙 Назад", callback_data="servers_back_to_admin")
+    keyboard.adjust(1)
     return keyboard.as_markup()
 
+def format_evacuation(job: dict) -> str:
+    """Текст прогресса переноса подписок"""
+    status = {
+        'pending': "⏳ Ожидает запуска",
+        'running': "🚚 Выполняется",
+        'done': "✅ Завершен",
+        'failed': "❌ Ошибка"
+    }.get(job['status'], job['status'])
+    text = (
+        f"<b>Перенос подписок с сервера #{job['source_server_id']}</b>\n"
+        f"<blockquote>"
+        f"Статус: {status}\n"
+        f"Перенесено: {job['moved']} из {job['total']}\n"
+        f"Не удалось перенести: {job['failed']}\n"
+        f"Удалено старых ключей: {job['old_deleted']}\n"
+        f"Уведомлено пользователей: {job['notified']}\n"
+        f"</blockquote>"
+    )
+    if job['delete_source']:
+        text += "Сервер будет удален, когда на нем не останется подписок.\n"
+    if job['error']:
+        text += f"⚠️ {job['error']}\n"
+    return text
+
 @router.callback_query(F.data == "delete_server")
 async def start_server_delete(callback: CallbackQuery):
     """Начало процесса удаления сервера"""
@@ -75,7 +116,7 @@ async def confirm_server_delete(callback: CallbackQuery, state: FSMContext):
     try:
         server_id = int(callback.data.split(':')[1])
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             cursor = await conn.execute(
                 "SELECT name FROM server_settings WHERE id = ?",
@@ -87,13 +128,25 @@ async def confirm_server_delete(callback: CallbackQuery, state: FSMContext):
                 await callback.answer("Сервер не найден", show_alert=True)
                 return
             
+            cursor = await conn.execute(
+                "SELECT COUNT(*) FROM user_subscription WHERE server_id = ? AND is_active = 1",
+                (server_id,)
+            )
+            active_subscriptions = (await cursor.fetchone())[0]
+            
             await state.update_data(server_id=server_id, server_name=server['name'])
             
             await callback.message.edit_text(
                 f"❗️ Вы выбрали сервер «{server['name']}» для удаления\n"
                 "⚠️ Это действие нельзя отменить!\n"
-                "Все связанные тарифы будут отключены.",
-                reply_markup=get_confirmation_keyboard(server_id)
+                "Все связанные тарифы будут отключены.\n"
+                + (
+                    f"\n👥 Активных подписок на сервере: {active_subscriptions}\n"
+                    "Их можно перенести на другие серверы того же протокола — "
+                    "пользователи получат новые ключи, сервер удалится после переноса."
+                    if active_subscriptions else ""
+                ),
+                reply_markup=get_confirmation_keyboard(server_id, active_subscriptions)
             )
             
             await state.set_state(ServerDeleteStates.waiting_for_confirmation)
@@ -110,7 +163,7 @@ async def process_delete_server(callback: CallbackQuery, state: FSMContext):
         server_id = data.get('server_id')
         server_name = data.get('server_name')
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute(
                 "UPDATE tariff SET is_enable = 0 WHERE server_id = ?",
                 (server_id,)
@@ -149,6 +202,59 @@ async def process_delete_server(callback: CallbackQuery, state: FSMContext):
     finally:
         await state.clear()
 
+@router.callback_query(F.data.startswith("evacuate_server:"))
+async def process_evacuate_server(callback: CallbackQuery, state: FSMContext):
+    """Перенос подписок с сервера с последующим удалением"""
+    try:
+        if not await db.is_admin(callback.from_user.id):
+            await callback.answer("У вас нет прав для выполнения этого действия")
+            return
+
+        server_id = int(callback.data.split(':')[1])
+        job = await start_evacuation(server_id, delete_source=True)
+        if not job:
+            await callback.answer("Сервер не найден", show_alert=True)
+            return
+
+        await callback.message.edit_text(
+            format_evacuation(job),
+            reply_markup=get_evacuation_keyboard(job['id']),
+            parse_mode="HTML"
+        )
+        logger.info(f"Администратор {callback.from_user.id} запустил перенос подписок с сервера {server_id}")
+
+    except Exception as e:
+        logger.error(f"Ошибка при запуске переноса подписок: {e}")
+        await callback.message.edit_text(
+            "❌ Произошла ошибка при запуске переноса подписок",
+            reply_markup=get_servers_keyboard()
+        )
+    finally:
+        await state.clear()
+
+@router.callback_query(F.data.startswith("evacuation_status:"))
+async def show_evacuation_status(callback: CallbackQuery):
+    """Обновление прогресса переноса"""
+    try:
+        job = await db.get_server_evacuation(int(callback.data.split(':')[1]))
+        if not job:
+            await callback.answer("Перенос не найден", show_alert=True)
+            return
+
+        text = format_evacuation(job)
+        if text == callback.message.html_text:
+            await callback.answer("Без изменений")
+            return
+
+        await callback.message.edit_text(
+            text,
+            reply_markup=get_evacuation_keyboard(job['id']),
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при получении прогресса переноса: {e}")
+        await callback.answer("Произошла ошибка", show_alert=True)
+
 @router.callback_query(F.data == "cancel_delete_server")
 async def cancel_delete_server(callback: CallbackQuery, state: FSMContext):
     """Отмена удаления сервера"""
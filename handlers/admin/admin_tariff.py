@@ -29,7 +29,7 @@ async def show_tariffs(callback: CallbackQuery):
     try:
         await callback.message.delete()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT t.*, s.name as server_name 
@@ -121,7 +121,7 @@ async def process_delete_tariff(message: Message, state: FSMContext):
     try:
         tariff_name = message.text.strip()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             async with conn.execute(
                 "SELECT name FROM tariff WHERE name = ? AND is_enable = 1",
                 (tariff_name,)
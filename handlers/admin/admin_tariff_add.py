@@ -30,7 +30,7 @@ async def start_add_tariff(callback: CallbackQuery):
     try:
         await callback.message.delete()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT id, name FROM server_settings 
@@ -144,7 +144,7 @@ async def process_days(message: Message, state: FSMContext):
         days = int(message.text.strip())
         data = await state.get_data()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute(
                 "SELECT name FROM server_settings WHERE id = ?",
@@ -27,7 +27,7 @@ async def start_add_trial(callback: CallbackQuery):
     try:
         await callback.message.delete()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT id, name 
@@ -70,7 +70,7 @@ async def process_server_selection(callback: CallbackQuery, state: FSMContext):
     try:
         server_id = int(callback.data.split('_')[-1])
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute(
                 "SELECT name FROM server_settings WHERE id = ?",
@@ -139,7 +139,7 @@ async def process_days_input(message: Message, state: FSMContext):
 
         data = await state.get_data()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute(
                 "UPDATE trial_settings SET is_enable = 0 WHERE is_enable = 1"
             )
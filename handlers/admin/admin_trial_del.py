@@ -49,7 +49,7 @@ async def process_delete_trial(message: Message, state: FSMContext):
     try:
         trial_id = int(message.text.strip())
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             conn.row_factory = aiosqlite.Row
             
             async with conn.execute(
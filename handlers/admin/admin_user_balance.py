@@ -18,7 +18,7 @@ async def show_users_balance(callback: CallbackQuery):
     try:
         db = Database()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             async with conn.execute(
                 "SELECT COUNT(DISTINCT user_id) as users_count FROM user_balance"
             ) as cursor:
@@ -59,7 +59,7 @@ async def get_all_transactions(callback: CallbackQuery):
         
         buffer = io.StringIO()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             query = """
                 SELECT 
@@ -147,7 +147,7 @@ async def process_user_search(message: Message, state: FSMContext):
         db = Database()
         search_query = message.text.strip()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             
             query = """
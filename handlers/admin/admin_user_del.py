@@ -6,9 +6,9 @@ from aiogram.fsm.context import FSMContext
 import aiosqlite
 import re
 from loguru import logger
-import py3xui
 
 from handlers.database import db
+from handlers.x_ui import xui_manager
 from handlers.admin.admin_kb import get_admin_users_keyboard, get_admin_users_keyboard_cancel
 
 router = Router()
@@ -52,7 +52,7 @@ async def process_ban_user(callback: CallbackQuery, state: FSMContext):
 async def process_username_input(message: Message, state: FSMContext):
     """Обработчик ввода имени пользователя"""
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute(
                 "SELECT * FROM user WHERE username = ?",
@@ -94,7 +94,7 @@ async def process_confirm_ban(callback: CallbackQuery, state: FSMContext):
         user_data = (await state.get_data())['user_data']
         logger.info(f"Начало процесса блокировки пользователя: {user_data['username']}")
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT us.*, ss.url, ss.port, ss.username, ss.password, ss.inbound_id, ss.secret_path
@@ -116,29 +116,15 @@ async def process_confirm_ban(callback: CallbackQuery, state: FSMContext):
                 client_uuid = uuid_match.group(1)
                 logger.info(f"Извлечен UUID: {client_uuid}")
 
-                api_url = f"{sub['url']}:{sub['port']}/{sub['secret_path']}"
-                
-                api = py3xui.AsyncApi(
-                    host=api_url,
-                    username=sub['username'],
-                    password=sub['password'],
-                    use_tls_verify=False
-                )
-                logger.info(f"Подключаемся к API: {api_url}")
-                await api.login()
-                logger.info("Успешно подключились к API")
-
                 logger.info(f"Попытка удаления пользователя. inbound_id: {sub['inbound_id']}, uuid: {client_uuid}")
-                await api.client.delete(sub['inbound_id'], client_uuid)
-                logger.info(f"Пользователь успешно удален с сервера {api_url} (inbound_id: {sub['inbound_id']})")
+                if await xui_manager.delete_client(dict(sub), sub['inbound_id'], client_uuid):
+                    logger.info(f"Пользователь успешно удален с сервера {sub['server_id']} (inbound_id: {sub['inbound_id']})")
 
             except Exception as e:
-                logger.error(f"Ошибка при удалении с сервера {api_url}: {e}")
-                logger.error(f"Детали ошибки: {str(e)}")
-                logger.error(f"Параметры подключения: URL={api_url}, inbound_id={sub['inbound_id']}, uuid={client_uuid}")
+                logger.error(f"Ошибка при удалении с сервера {sub['server_id']}: {e}")
 
         try:
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire(write=True) as conn:
                 await conn.execute(
                     "UPDATE user_subscription SET is_active = 0 WHERE user_id = ?",
                     (user_data['telegram_id'],)
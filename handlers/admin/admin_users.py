@@ -8,25 +8,53 @@ from handlers.admin.admin_kb import get_admin_keyboard, get_admin_users_keyboard
 
 router = Router()
 
+USERS_PAGE_SIZE = 5
+# id больше любого реального, страница "next" от него — первая
+FIRST_PAGE_ANCHOR = 2 ** 63 - 1
+
+async def fetch_users_page(direction: str, anchor_id: int):
+    """
+    Страница пользователей по ключу id (новые сверху).
+
+    direction "next" — пользователи с id меньше anchor_id,
+    "prev" — с id больше anchor_id. Запрашивается на одну запись больше,
+    чтобы понять, есть ли еще страница в том же направлении.
+    """
+    async with db.acquire() as conn:
+        conn.row_factory = aiosqlite.Row
+        if direction == "prev":
+            query = """
+                SELECT id, username, date, trial_period, is_enable
+                FROM user
+                WHERE id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            """
+        else:
+            query = """
+                SELECT id, username, date, trial_period, is_enable
+                FROM user
+                WHERE id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            """
+        async with conn.execute(query, (anchor_id, USERS_PAGE_SIZE + 1)) as cursor:
+            rows = await cursor.fetchall()
+
+    has_more = len(rows) > USERS_PAGE_SIZE
+    rows = rows[:USERS_PAGE_SIZE]
+    if direction == "prev":
+        rows.reverse()
+    return rows, has_more
+
 @router.callback_query(F.data == "admin_show_users")
 async def process_show_users(callback: CallbackQuery):
     """Обработчик просмотра списка пользователей"""
     try:
         await callback.message.delete()
 
-        async with aiosqlite.connect(db.db_path) as conn:
-            conn.row_factory = aiosqlite.Row
-            
-            async with conn.execute("SELECT COUNT(*) as count FROM user") as cursor:
-                total_users = (await cursor.fetchone())['count']
-            
-            async with conn.execute("""
-                SELECT username, date, trial_period, is_enable
-                FROM user 
-                ORDER BY date DESC
-                LIMIT 5
-            """) as cursor:
-                users = await cursor.fetchall()
+        total_users = await db.get_total_users_count()
+        users, has_next = await fetch_users_page("next", FIRST_PAGE_ANCHOR)
 
         if not users:
             message_text = "👥 Список пользователей\n\nПользователей пока нет"
@@ -52,9 +80,9 @@ async def process_show_users(callback: CallbackQuery):
 
         keyboard = get_admin_users_keyboard()
         
-        if total_users > 5:
+        if has_next:
             keyboard.inline_keyboard.append([
-                InlineKeyboardButton(text="Далее 🔜", callback_data="users_page:1")
+                InlineKeyboardButton(text="Далее 🔜", callback_data=f"users_page:next:{users[-1]['id']}:{total_users}")
             ])
 
         await callback.message.answer(
@@ -73,22 +101,20 @@ async def process_show_users(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("users_page:"))
 async def process_users_page(callback: CallbackQuery):
     try:
-        page = int(callback.data.split(':')[1])
-        offset = page * 5
-
-        async with aiosqlite.connect(db.db_path) as conn:
-            conn.row_factory = aiosqlite.Row
-            
-            async with conn.execute("SELECT COUNT(*) as count FROM user") as cursor:
-                total_users = (await cursor.fetchone())['count']
-            
-            async with conn.execute("""
-                SELECT username, date, trial_period, is_enable
-                FROM user 
-                ORDER BY date DESC
-                LIMIT 5 OFFSET ?
-            """, (offset,)) as cursor:
-                users = await cursor.fetchall()
+        parts = callback.data.split(':')
+        if len(parts) != 4:
+            # Кнопки из старых сообщений (users_page:<номер>) ведут на первую страницу
+            parts = ["users_page", "next", str(FIRST_PAGE_ANCHOR), "0"]
+        direction, anchor_id, total_users = parts[1], int(parts[2]), int(parts[3])
+
+        users, has_more = await fetch_users_page(direction, anchor_id)
+        if not total_users:
+            total_users = await db.get_total_users_count()
+
+        if direction == "prev":
+            has_prev, has_next = has_more, True
+        else:
+            has_prev, has_next = anchor_id != FIRST_PAGE_ANCHOR, has_more
 
         message_text = "👥 <b>Список зарегистрированных пользователей:</b>\n\n"
         for user in users:
@@ -110,14 +136,14 @@ async def process_users_page(callback: CallbackQuery):
         keyboard = get_admin_users_keyboard()
         nav_buttons = []
 
-        if page > 0:
+        if users and has_prev:
             nav_buttons.append(
-                InlineKeyboardButton(text="🔙 Назад", callback_data=f"users_page:{page-1}")
+                InlineKeyboardButton(text="🔙 Назад", callback_data=f"users_page:prev:{users[0]['id']}:{total_users}")
             )
 
-        if (offset + 5) < total_users:
+        if users and has_next:
             nav_buttons.append(
-                InlineKeyboardButton(text="Далее 🔜", callback_data=f"users_page:{page+1}")
+                InlineKeyboardButton(text="Далее 🔜", callback_data=f"users_page:next:{users[-1]['id']}:{total_users}")
             )
 
         if nav_buttons:
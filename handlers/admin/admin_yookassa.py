@@ -24,7 +24,7 @@ async def show_yokassa_settings(callback: CallbackQuery):
     try:
         await callback.message.delete()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT * FROM yookassa_settings 
@@ -137,7 +137,7 @@ async def process_api_key(message: Message, state: FSMContext):
         data = await state.get_data()
         api_key = message.text.strip()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             await conn.execute(
                 "UPDATE yookassa_settings SET is_enable = 0 WHERE is_enable = 1"
             )
@@ -202,7 +202,7 @@ async def process_delete_shop_id(message: Message, state: FSMContext):
     try:
         shop_id = message.text.strip()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire(write=True) as conn:
             conn.row_factory = aiosqlite.Row
             
             async with conn.execute(
@@ -0,0 +1,158 @@
+import os
+import gzip
+import time
+import shutil
+import sqlite3
+import asyncio
+from datetime import datetime
+from typing import Optional, List
+
+from loguru import logger
+
+DEFAULT_DB_PATH = 'instance/database.db'
+BACKUP_DIR = os.environ.get("BACKUP_DIR", 'instance/backup')
+# Интервал между копиями в часах, 0 — не делать копии из процесса бота
+BACKUP_INTERVAL_HOURS = float(os.environ.get("BACKUP_INTERVAL_HOURS", 24))
+# Сколько последних копий хранить
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", 7))
+# Страниц за один шаг backup API и пауза между шагами:
+# между шагами блокировок нет, запись в базу не ждет копирования
+BACKUP_PAGES_PER_STEP = int(os.environ.get("BACKUP_PAGES_PER_STEP", 256))
+BACKUP_STEP_SLEEP = float(os.environ.get("BACKUP_STEP_SLEEP_MS", 10)) / 1000
+BACKUP_COMPRESS = os.environ.get("BACKUP_COMPRESS", "0") == "1"
+
+BACKUP_PREFIX = 'database-'
+
+
+def _copy_database(source_path: str, target_path: str, pages: int, step_sleep: float):
+    """
+    Копирование базы через sqlite3 backup API.
+
+    Источник открывается только на чтение, и на все время копирования
+    в нем держится одна читающая транзакция: в режиме WAL она не мешает
+    записи, а копия получается согласованной и не начинается заново
+    после каждого коммита других процессов.
+    """
+    source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True, isolation_level=None)
+    target = sqlite3.connect(target_path)
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+        def _progress(status, remaining, total):
+            if remaining and step_sleep:
+                time.sleep(step_sleep)
+
+        source.backup(target, pages=pages, progress=_progress)
+        source.execute("COMMIT")
+        # Копия наследует режим WAL источника; без перевода в DELETE проверка
+        # и любое чтение копии оставляли бы рядом файлы -wal и -shm
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        source.close()
+
+
+def _check_integrity(path: str) -> bool:
+    """PRAGMA integrity_check для файла копии"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchall()
+        return result == [('ok',)]
+    finally:
+        conn.close()
+
+
+def _compress(path: str) -> str:
+    """Сжатие файла копии в gzip, исходный файл удаляется"""
+    compressed_path = f"{path}.gz"
+    with open(path, 'rb') as source, gzip.open(compressed_path, 'wb') as target:
+        shutil.copyfileobj(source, target, length=1024 * 1024)
+    os.remove(path)
+    return compressed_path
+
+
+def list_backups(backup_dir: str = BACKUP_DIR) -> List[str]:
+    """Файлы резервных копий, от новых к старым"""
+    if not os.path.isdir(backup_dir):
+        return []
+    names = [
+        name for name in os.listdir(backup_dir)
+        if name.startswith(BACKUP_PREFIX) and (name.endswith('.db') or name.endswith('.db.gz'))
+    ]
+    return [os.path.join(backup_dir, name) for name in sorted(names, reverse=True)]
+
+
+def rotate_backups(backup_dir: str = BACKUP_DIR, keep: int = BACKUP_KEEP) -> List[str]:
+    """
+    Удаление старых копий сверх keep последних
+
+    :return: Список удаленных файлов
+    """
+    if keep <= 0:
+        return []
+    removed = []
+    for path in list_backups(backup_dir)[keep:]:
+        try:
+            os.remove(path)
+            removed.append(path)
+        except OSError as e:
+            logger.error(f"Не удалось удалить старую копию {path}: {e}")
+    return removed
+
+
+def create_backup(source_path: str = DEFAULT_DB_PATH, backup_dir: str = BACKUP_DIR,
+                  keep: int = BACKUP_KEEP, compress: bool = BACKUP_COMPRESS,
+                  pages: int = BACKUP_PAGES_PER_STEP, step_sleep: float = BACKUP_STEP_SLEEP) -> Optional[str]:
+    """
+    Создание проверенной резервной копии базы (блокирующий вызов)
+
+    :return: Путь к копии или None при ошибке
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    target_path = os.path.join(backup_dir, f'{BACKUP_PREFIX}{timestamp}.db')
+    partial_path = f"{target_path}.partial"
+
+    started = time.monotonic()
+    try:
+        _copy_database(source_path, partial_path, pages, step_sleep)
+        if not _check_integrity(partial_path):
+            raise RuntimeError("копия не прошла PRAGMA integrity_check")
+        os.replace(partial_path, target_path)
+        if compress:
+            target_path = _compress(target_path)
+    except Exception as e:
+        logger.error(f"Ошибка при создании резервной копии: {e}")
+        for path in (partial_path, target_path):
+            for suffix in ('', '-wal', '-shm', '-journal'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        return None
+
+    size_mb = os.path.getsize(target_path) / (1024 * 1024)
+    logger.info(f"Резервная копия создана за {time.monotonic() - started:.1f}с: {target_path} ({size_mb:.1f} МБ)")
+
+    for path in rotate_backups(backup_dir, keep):
+        logger.info(f"Удалена старая резервная копия: {path}")
+    return target_path
+
+
+async def run_backup(source_path: str = DEFAULT_DB_PATH, **kwargs) -> Optional[str]:
+    """Создание резервной копии в отдельном потоке, не блокируя event loop"""
+    return await asyncio.to_thread(create_backup, source_path, **kwargs)
+
+
+async def start_backup_scheduler(source_path: str = DEFAULT_DB_PATH, interval_hours: float = BACKUP_INTERVAL_HOURS):
+    """Периодическое создание резервных копий из процесса бота"""
+    if interval_hours <= 0:
+        logger.info("Резервное копирование по расписанию отключено")
+        return
+
+    logger.info(f"Запуск резервного копирования каждые {interval_hours:g} ч.")
+    while True:
+        await asyncio.sleep(interval_hours * 3600)
+        try:
+            await run_backup(source_path)
+        except Exception as e:
+            logger.error(f"Ошибка в планировщике резервного копирования: {e}")
@@ -1,3 +1,4 @@
+import os
 import random
 import aiosqlite
 from loguru import logger
@@ -5,11 +6,24 @@ from typing import Optional, Dict
 from handlers.x_ui import xui_manager
 from handlers.x_ui_ss import xui_ss_manager
 from handlers.database import db
+from handlers.placement import placement, PANEL_FIELDS
+from handlers.circuit_breaker import circuit_breakers
+from handlers.key_pool import claim_key
+from handlers.expiry_sweeper import EXPIRY_SWEEP_GRACE_HOURS
 from datetime import datetime, timedelta
 from handlers.admin.admin_kb import get_admin_keyboard
 from aiogram.types import Message
 from handlers.user.user_kb import get_allocation_tickets_keyboard
 
+# На скольких серверах региона пробовать создать подписку, если панели недоступны
+PROVISION_MAX_SERVERS = 3
+# Покупка тарифа, подписка на который у пользователя уже есть, продлевает
+# ее (тот же ключ) вместо создания новой
+SUBSCRIPTION_RENEW_IN_PLACE = os.environ.get("SUBSCRIPTION_RENEW_IN_PLACE", "1") == "1"
+# Истекшая подписка продлевается, пока очистка не удалила ее клиента из панели;
+# час запаса — чтобы продление не совпало с проходом очистки
+RENEW_EXPIRED_WITHIN = max(0.0, EXPIRY_SWEEP_GRACE_HOURS - 1) * 3600
+
 class SubscriptionManager:
     @staticmethod
     def generate_user_id() -> str:
@@ -19,7 +33,7 @@ class SubscriptionManager:
     async def create_subscription(self, user_id: int, tariff_id: int, is_trial: bool = False, bot = None, payment_id: str = None) -> Optional[Dict]:
         """Создание подписки для пользователя"""
         try:
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 if is_trial:
                     async with conn.execute("""
@@ -45,102 +59,79 @@ class SubscriptionManager:
                 logger.error(f"Тариф {tariff_id} не найден")
                 return None
 
+            if not is_trial and SUBSCRIPTION_RENEW_IN_PLACE:
+                renewable = await db.get_renewable_subscription(user_id, tariff_id, RENEW_EXPIRED_WITHIN)
+                if renewable:
+                    renewed = await self.extend_subscription(renewable['id'], tariff_data['left_day'], payment_id,
+                                                             tariff_id)
+                    if renewed:
+                        await self._after_purchase(user_id, tariff_data, is_trial, bot, renewed=True)
+                        return {**renewed, 'tariff': tariff_data}
+                    logger.warning(f"Подписку {renewable['id']} пользователя {user_id} не удалось продлить, "
+                                   f"создаем новую")
+
             end_date = datetime.now() + timedelta(days=tariff_data['left_day'])
 
-            if tariff_data.get('protocol') == 'shadowsocks':
-                vless_link = await xui_ss_manager.create_ss_user(
-                    server_settings=tariff_data,
-                    trial_settings=tariff_data,
-                    telegram_id=user_id
-                )
-            else:
-                vless_link = await xui_manager.create_trial_user(
-                    server_settings=tariff_data,
-                    trial_settings=tariff_data,
-                    telegram_id=user_id
-                )
+            home_server_id = tariff_data['server_id']
+            tried = set()
+            vless_link = None
+            # Если панель выбранного сервера оказалась недоступна (предохранитель
+            # разомкнулся), подписка создается на другом сервере региона
+            while True:
+                server = await placement.acquire(home_server_id)
+                if server:
+                    tariff_data.update({field: server.get(field) for field in PANEL_FIELDS})
+                    tariff_data['server_id'] = server['id']
+
+                if tariff_data.get('protocol') == 'shadowsocks':
+                    vless_link = await xui_ss_manager.create_ss_user(
+                        server_settings=tariff_data,
+                        trial_settings=tariff_data,
+                        telegram_id=user_id
+                    )
+                else:
+                    vless_link = await claim_key(tariff_data, user_id, end_date) \
+                        or await xui_manager.create_trial_user(
+                            server_settings=tariff_data,
+                            trial_settings=tariff_data,
+                            telegram_id=user_id
+                        )
+
+                if vless_link or not server:
+                    break
+                placement.release(server['id'])
+                tried.add(server['id'])
+                if circuit_breakers.available(server['id']) or len(tried) >= PROVISION_MAX_SERVERS:
+                    break
+                alternatives = [
+                    candidate for candidate in await placement.candidates(home_server_id)
+                    if candidate['id'] not in tried and placement.score(candidate) is not None
+                ]
+                if not alternatives:
+                    break
+                logger.warning(f"Панель сервера {server['id']} недоступна, пробуем другой сервер региона")
 
             if not vless_link:
                 logger.error(f"Ошибка при создании пользователя в X-UI для {user_id}")
                 return None
 
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire(write=True) as conn:
                 await conn.execute("""
                     INSERT INTO user_subscription 
-                    (user_id, tariff_id, server_id, end_date, vless, is_active, payment_id)
-                    VALUES (?, ?, ?, ?, ?, 1, ?)
+                    (user_id, tariff_id, server_id, inbound_id, end_date, vless, is_active, payment_id)
+                    VALUES (?, ?, ?, ?, ?, ?, 1, ?)
                 """, (
                     user_id, 
                     tariff_id, 
                     tariff_data['server_id'], 
+                    tariff_data.get('inbound_id') or 1,
                     end_date, 
                     vless_link,
                     payment_id
                 ))
                 await conn.commit()
 
-                if bot:
-                    async with conn.execute(
-                        'SELECT pay_notify FROM bot_settings LIMIT 1'
-                    ) as cursor:
-                        notify_settings = await cursor.fetchone()
-
-                    if notify_settings and notify_settings[0] != 0:
-                        async with conn.execute(
-                            'SELECT username FROM user WHERE telegram_id = ?',
-                            (user_id,)
-                        ) as cursor:
-                            user_data = await cursor.fetchone()
-                            username = user_data[0] if user_data else f"ID: {user_id}"
-
-                        message_text = (
-                            "🎉 Новая подписка! 🏆\n"
-                            "<blockquote>"
-                            f"👤 Пользователь: {username}\n"
-                            f"💳 Тариф: {tariff_data['name']}\n"
-                            f"📅 Дата активации: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                            "🚀 Подписка успешно оформлена!</blockquote>"
-                        )
-
-                        try:
-                            await bot.send_message(
-                                chat_id=notify_settings[0],
-                                text=message_text,
-                                parse_mode="HTML"
-                                #reply_markup=get_admin_keyboard()
-                            )
-                        except Exception as e:
-                            logger.error(f"Ошибка при отправке уведомления о подписке: {e}")
-
-            if not is_trial:
-                tickets_count = self._calculate_tickets(tariff_data['left_day'])
-                if tickets_count > 0:
-                    active_raffle = await self._get_active_raffle()
-                    if active_raffle:
-                        if await db.add_raffle_tickets(
-                            user_id=user_id,
-                            telegram_id=user_id,
-                            tickets_count=tickets_count,
-                            raffle_id=active_raffle['id']
-                        ):
-                            logger.info(f"Начислено {tickets_count} билетов пользователю {user_id}")
-                            
-                            if bot:
-                                try:
-                                    await bot.send_message(
-                                        chat_id=user_id,
-                                        text=(
-                                            f"✨ Поздравляем! Вам начислено <b>{tickets_count}</b> "
-                                            f"{'билет' if tickets_count == 1 else 'билета' if 2 <= tickets_count <= 4 else 'билетов'} "
-                                            "за покупку подписки! \n\n"
-                                            "Спасибо за участие в розыгрыше! 🍀🎲\n"
-                                            "Посмотреть все ваши билеты можно, нажав на кнопку <b>Розыгрыша</b> в меню ниже. 🔖"
-                                        ),
-                                        parse_mode="HTML",
-                                        reply_markup= await get_allocation_tickets_keyboard()
-                                    )
-                                except Exception as e:
-                                    logger.error(f"Ошибка при отправке уведомления о билетах пользователю: {e}")
+            await self._after_purchase(user_id, tariff_data, is_trial, bot)
 
             return {
                 'vless': vless_link,
@@ -152,6 +143,124 @@ class SubscriptionManager:
             logger.error(f"Ошибка при создании подписки: {e}")
             return None
 
+    async def extend_subscription(self, subscription_id: int, days: int, payment_id: str = None,
+                                  tariff_id: int = None) -> Optional[Dict]:
+        """
+        Продление подписки на days дней без нового ключа: дата окончания
+        меняется у клиента панели (один запрос updateClient, см.
+        XUIManager.extend_client) и у той же строки user_subscription.
+        Срок добавляется к текущей дате окончания, а если она уже прошла —
+        к текущему моменту. Продление с tariff_id учитывается в статистике
+        как покупка тарифа.
+
+        :return: {'id', 'vless', 'end_date', 'renewed'} или None, если подписка
+            не активна, сервер недоступен, клиента нет в inbound подписки
+            или панель не приняла изменение
+        """
+        subscription = await db.get_subscription_with_server(subscription_id)
+        if not subscription or not subscription['is_active']:
+            return None
+        if not subscription['server_enabled'] or not circuit_breakers.available(subscription['server_id']):
+            logger.warning(f"Сервер {subscription['server_id']} подписки {subscription_id} недоступен для продления")
+            return None
+
+        now = datetime.now()
+        current_end = datetime.fromtimestamp(subscription['end_ts']) if subscription['end_ts'] else now
+        end_date = max(current_end, now) + timedelta(days=days)
+
+        # Клиент, которого нет в панели, не создается заново: на другом inbound
+        # получились бы два клиента с одним ключом
+        if not await xui_manager.extend_client(
+            subscription,
+            subscription['inbound_id'],
+            subscription['vless'],
+            subscription['user_id'],
+            end_date
+        ):
+            return None
+
+        if not await db.extend_subscription(subscription_id, subscription['server_id'], end_date, days,
+                                          payment_id, tariff_id):
+            # Подписку отключили или перенесли, пока продлевался клиент:
+            # новой дате в панели не соответствует ни одна строка
+            logger.warning(f"Подписка {subscription_id} изменилась во время продления")
+            return None
+
+        logger.info(f"Подписка {subscription_id} пользователя {subscription['user_id']} продлена "
+                    f"на {days} дн. до {end_date.strftime('%Y-%m-%d %H:%M:%S')}")
+        return {
+            'id': subscription_id,
+            'vless': subscription['vless'],
+            'end_date': end_date,
+            'renewed': True
+        }
+
+    async def _after_purchase(self, user_id: int, tariff_data: Dict, is_trial: bool, bot, renewed: bool = False):
+        """Уведомление администратора и билеты розыгрыша за покупку"""
+        if bot:
+            async with db.acquire() as conn:
+                async with conn.execute(
+                    'SELECT pay_notify FROM bot_settings LIMIT 1'
+                ) as cursor:
+                    notify_settings = await cursor.fetchone()
+
+                async with conn.execute(
+                    'SELECT username FROM user WHERE telegram_id = ?',
+                    (user_id,)
+                ) as cursor:
+                    user_data = await cursor.fetchone()
+                    username = user_data[0] if user_data else f"ID: {user_id}"
+
+            if notify_settings and notify_settings[0] != 0:
+                message_text = (
+                    f"{'🔄 Продление подписки' if renewed else '🎉 Новая подписка'}! 🏆\n"
+                    "<blockquote>"
+                    f"👤 Пользователь: {username}\n"
+                    f"💳 Тариф: {tariff_data['name']}\n"
+                    f"📅 Дата активации: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+                    f"🚀 Подписка успешно {'продлена' if renewed else 'оформлена'}!</blockquote>"
+                )
+
+                try:
+                    await bot.send_message(
+                        chat_id=notify_settings[0],
+                        text=message_text,
+                        parse_mode="HTML"
+                        #reply_markup=get_admin_keyboard()
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка при отправке уведомления о подписке: {e}")
+
+        if not is_trial:
+            tickets_count = self._calculate_tickets(tariff_data['left_day'])
+            if tickets_count > 0:
+                active_raffle = await self._get_active_raffle()
+                if active_raffle:
+                    if await db.add_raffle_tickets(
+                        user_id=user_id,
+                        telegram_id=user_id,
+                        tickets_count=tickets_count,
+                        raffle_id=active_raffle['id']
+                    ):
+                        logger.info(f"Начислено {tickets_count} билетов пользователю {user_id}")
+                        
+                        if bot:
+                            try:
+                                await bot.send_message(
+                                    chat_id=user_id,
+                                    text=(
+                                        f"✨ Поздравляем! Вам начислено <b>{tickets_count}</b> "
+                                        f"{'билет' if tickets_count == 1 else 'билета' if 2 <= tickets_count <= 4 else 'билетов'} "
+                                        "за покупку подписки! \n\n"
+                                        "Спасибо за участие в розыгрыше! 🍀🎲\n"
+                                        "Посмотреть все ваши билеты можно, нажав на кнопку <b>Розыгрыша</b> в меню ниже. 🔖"
+                                    ),
+                                    parse_mode="HTML",
+                                    reply_markup= await get_allocation_tickets_keyboard()
+                                )
+                            except Exception as e:
+                                logger.error(f"Ошибка при отправке уведомления о билетах пользователю: {e}")
+
     def _calculate_tickets(self, days: int) -> int:
         """Расчет количества билетов в зависимости от срока подписки"""
         if days <= 31:
@@ -0,0 +1,127 @@
+import os
+import time
+from typing import Any, Dict
+
+from loguru import logger
+
+# После скольких ошибок подряд запросы к панели перестают отправляться
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 3))
+# Через сколько секунд после размыкания пропускается пробный запрос
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", 30))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Предохранитель запросов к одной панели.
+
+    closed — запросы проходят, ошибки подряд считаются; после
+    CIRCUIT_FAILURE_THRESHOLD ошибок предохранитель размыкается (open) и
+    запросы сразу завершаются ошибкой, не дожидаясь таймаутов. Через
+    CIRCUIT_RESET_TIMEOUT секунд (или после успешной проверки мониторинга)
+    пропускается один пробный запрос (half_open): успех замыкает цепь,
+    ошибка снова размыкает.
+    """
+
+    def __init__(self, server_id: Any):
+        self.server_id = server_id
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.rejected = 0
+
+    def _expired(self) -> bool:
+        return time.monotonic() - self.opened_at >= CIRCUIT_RESET_TIMEOUT
+
+    def available(self) -> bool:
+        """Можно ли направлять на сервер новые запросы (без учета пробного запроса)"""
+        if self.state == OPEN:
+            return self._expired()
+        if self.state == HALF_OPEN:
+            return not self.trial_in_flight
+        return True
+
+    def allow(self) -> bool:
+        """Разрешение на запрос; в half_open разрешается только один запрос одновременно"""
+        if self.state == OPEN and self._expired():
+            self.state = HALF_OPEN
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info(f"Панель сервера {self.server_id} снова доступна")
+        self.state = CLOSED
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.trial_in_flight = False
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.trip()
+
+    def release(self):
+        """Пробный запрос отменен, не дав результата"""
+        self.trial_in_flight = False
+
+    def trip(self):
+        """Размыкание: запросы к панели завершаются ошибкой до CIRCUIT_RESET_TIMEOUT"""
+        if self.state != OPEN:
+            logger.warning(f"Панель сервера {self.server_id} недоступна, запросы приостановлены "
+                           f"на {CIRCUIT_RESET_TIMEOUT:g}с")
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.trial_in_flight = False
+
+    def snapshot(self) -> Dict:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'open_for': round(time.monotonic() - self.opened_at, 1) if self.state == OPEN else None
+        }
+
+
+class CircuitBreakerRegistry:
+    """Предохранители панелей по ID сервера, общие для VLESS, Shadowsocks и смены сервера"""
+
+    def __init__(self):
+        self.breakers: Dict[Any, CircuitBreaker] = {}
+
+    def get(self, server_id: Any) -> CircuitBreaker:
+        breaker = self.breakers.get(server_id)
+        if breaker is None:
+            breaker = self.breakers[server_id] = CircuitBreaker(server_id)
+        return breaker
+
+    def available(self, server_id: Any) -> bool:
+        breaker = self.breakers.get(server_id)
+        return breaker is None or breaker.available()
+
+    def report_probe(self, server_id: Any, available: bool):
+        """
+        Результат мониторинга: недоступный сервер размыкается сразу, а после
+        успешной проверки разомкнутый сервер получает пробный запрос без ожидания
+        """
+        breaker = self.get(server_id)
+        if not available:
+            breaker.trip()
+        elif breaker.state == OPEN:
+            breaker.state = HALF_OPEN
+            breaker.trial_in_flight = False
+
+    def stats(self) -> Dict[Any, Dict]:
+        return {server_id: breaker.snapshot() for server_id, breaker in self.breakers.items()}
+
+
+circuit_breakers = CircuitBreakerRegistry()
@@ -35,37 +35,37 @@ async def process_lk_button(callback: CallbackQuery):
 async def start_command(message: Message):
     """Обработчик команды /start"""
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute(
                 "SELECT is_enable FROM user WHERE telegram_id = ?",
                 (message.from_user.id,)
             ) as cursor:
                 user = await cursor.fetchone()
-                
-                if user and user['is_enable'] == 0:
-                    ban_message = await db.get_bot_message("ban_user")
-                    if ban_message:
-                        if ban_message['image_path'] and os.path.exists(ban_message['image_path']):
-                            photo = FSInputFile(ban_message['image_path'])
-                            await message.answer_photo(
-                                photo=photo,
-                                caption=ban_message['text'],
-                                parse_mode="HTML",
-                                reply_markup=ReplyKeyboardRemove()
-                            )
-                        else:
-                            await message.answer(
-                                ban_message['text'],
-                                parse_mode="HTML",
-                                reply_markup=ReplyKeyboardRemove()
-                            )
-                    else:
-                        await message.answer(
-                            "Ваш аккаунт заблокирован.",
-                            reply_markup=ReplyKeyboardRemove()
-                        )
-                    return
+        
+        if user and user['is_enable'] == 0:
+            ban_message = await db.get_bot_message("ban_user")
+            if ban_message:
+                if ban_message['image_path'] and os.path.exists(ban_message['image_path']):
+                    photo = FSInputFile(ban_message['image_path'])
+                    await message.answer_photo(
+                        photo=photo,
+                        caption=ban_message['text'],
+                        parse_mode="HTML",
+                        reply_markup=ReplyKeyboardRemove()
+                    )
+                else:
+                    await message.answer(
+                        ban_message['text'],
+                        parse_mode="HTML",
+                        reply_markup=ReplyKeyboardRemove()
+                    )
+            else:
+                await message.answer(
+                    "Ваш аккаунт заблокирован.",
+                    reply_markup=ReplyKeyboardRemove()
+                )
+            return
 
         start_message = await db.get_bot_message("start")
         if not start_message:
@@ -96,7 +96,7 @@ async def start_command(message: Message):
             referral_code = args[1]
             referrer = await db.get_user_by_referral_code(referral_code)
             if referrer:
-                async with aiosqlite.connect(db.db_path) as conn:
+                async with db.acquire(write=True) as conn:
                     await conn.execute("""
                         UPDATE user 
                         SET referral_count = referral_count + 1 
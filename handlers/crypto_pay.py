@@ -140,7 +140,7 @@ class CryptoPayManager:
     async def init_api(self) -> bool:
         """Инициализация API"""
         try:
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 async with conn.execute(
                     'SELECT * FROM crypto_settings WHERE is_enable = 1 LIMIT 1'
@@ -163,7 +163,7 @@ class CryptoPayManager:
                 if not await self.init_api():
                     return None
                     
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 async with conn.execute(
                     'SELECT supported_assets FROM crypto_settings WHERE is_enable = 1'
@@ -1,20 +1,537 @@
 import os
 import aiosqlite
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, List, Union
+from typing import Optional, Dict, List, Tuple, Union
 from loguru import logger
 from aiogram import Bot
 from handlers.admin.admin_kb import get_admin_keyboard
 import random
 import string
+import time
 import asyncio
+import secrets
+from handlers.db_pool import ConnectionPool, DEFAULT_POOL_SIZE, DEFAULT_POOL_TIMEOUT
+from handlers.settings_cache import SettingsCache, SETTINGS_TABLES
+from handlers.pagination import decode_cursor, next_cursor, DEFAULT_PAGE_LIMIT
 
 os.makedirs('instance', exist_ok=True)
 os.makedirs('handlers', exist_ok=True)
 
+# Миграции схемы: (версия, описание, метод Database). Текущая версия хранится
+# в PRAGMA user_version, init_db применяет только шаги с большей версией.
+# Шаги идемпотентны — базы без user_version (до появления миграций) проходят все.
+# Новое изменение схемы — новый шаг в конце списка, старые шаги не меняются.
+MIGRATIONS = (
+    (1, "Основные таблицы", "create_base_tables"),
+    (2, "Колонки из update_db.py", "add_legacy_columns"),
+    (3, "Реферальные колонки таблицы user", "migrate_user_referral_columns"),
+    (4, "Начальные записи настроек", "seed_defaults"),
+    (5, "Колонка end_ts в user_subscription", "migrate_subscription_end_ts"),
+    (6, "Уникальный баланс пользователя", "migrate_user_balance_unique"),
+    (7, "Индексы для частых запросов", "create_indexes"),
+    (8, "Версия настроек для кэша", "create_settings_version"),
+    (9, "Снимок статистики", "create_statistics_snapshot"),
+    (10, "Версия настроек при изменении серверов", "create_settings_version"),
+    (11, "Таблицы расхода трафика", "create_traffic_usage"),
+    (12, "Колонки размещения подписок по серверам", "add_placement_columns"),
+    (13, "Почасовая доступность серверов", "create_server_health"),
+    (14, "Очередь создания оплаченных подписок", "create_provisioning_jobs"),
+    (15, "Пул заранее созданных ключей", "create_key_pool"),
+    (16, "Переносы подписок с сервера", "create_server_evacuations"),
+    (17, "Ссылки на подписку по токену", "create_subscription_tokens"),
+    (18, "Продления подписок и inbound клиента подписки", "create_subscription_renewals"),
+    (19, "Индекс подписок пользователя по тарифу", "create_indexes"),
+    (20, "Продления в статистике", "create_renewal_statistics"),
+)
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Случайных байт в токене ссылки на подписку
+SUBSCRIPTION_TOKEN_BYTES = 24
+
+# Сколько строк копируется за одну запись при пересборке больших таблиц
+MIGRATION_BATCH_SIZE = int(os.environ.get("DB_MIGRATION_BATCH_SIZE", 5000))
+
+USER_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT,
+        telegram_id INTEGER UNIQUE NOT NULL,
+        trial_period BOOLEAN DEFAULT 0,
+        is_enable BOOLEAN NOT NULL DEFAULT 1,
+        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        referral_code TEXT UNIQUE,
+        referral_count INTEGER DEFAULT 0,
+        referred_by TEXT
+    )
+'''
+
+# (таблица, колонка, описание) — колонки, которых может не быть в старых базах
+LEGACY_COLUMNS = (
+    ('server_settings', 'inbound_id', 'INTEGER DEFAULT 1 NOT NULL'),
+    ('server_settings', 'inbound_id_promo', 'INTEGER DEFAULT 2'),
+    ('server_settings', 'protocol', "TEXT DEFAULT 'vless'"),
+    ('tariff', 'server_id', 'INTEGER REFERENCES server_settings(id)'),
+    ('user_subscription', 'vless', 'TEXT'),
+    ('user_subscription', 'payment_id', 'TEXT'),
+    ('payments', 'provider', "TEXT DEFAULT 'default'"),
+    ('bot_settings', 'reg_notify', 'INTEGER DEFAULT 0'),
+    ('bot_settings', 'pay_notify', 'INTEGER DEFAULT 0'),
+)
+
+# Колонки server_settings для выбора сервера при создании подписки (handlers/placement.py):
+# region — группа взаимозаменяемых серверов, capacity — максимум активных подписок
+# (0 — без ограничения), weight — относительная доля новых подписок
+PLACEMENT_COLUMNS = (
+    ('server_settings', 'region', 'TEXT'),
+    ('server_settings', 'capacity', 'INTEGER NOT NULL DEFAULT 0'),
+    ('server_settings', 'weight', 'REAL NOT NULL DEFAULT 1'),
+)
+
+# inbound, на котором создан клиент подписки. У подписок, созданных до
+# появления колонки, NULL — для них берется текущий inbound сервера
+SUBSCRIPTION_INBOUND_COLUMN = ('user_subscription', 'inbound_id', 'INTEGER')
+
+# (таблица, колонки, строки) — добавляются, только если таблица пуста
+DEFAULT_ROWS = (
+    ('yookassa_settings', ('name', 'shop_id', 'api_key', 'description', 'is_enable'), (
+        ('Test Shop', 'test_shop_id', 'test_api_key', 'Тестовые настройки YooKassa', 0),
+    )),
+    ('pspayments_settings', ('name', 'shop_id', 'api_key', 'api_secret_key', 'description', 'is_enable'), (
+        ('Test Shop', 'test_shop_id', 'test_api_key', 'test_secret_key', 'Тестовые настройки PS Payments', 0),
+    )),
+    ('support_info', ('message', 'bot_version', 'support_url'), (
+        ('Подробное описание бота и прием заявок Вы можете найти на сайте', '1.2.0', 'https://t.me/slickkilla'),
+    )),
+    ('referral_condition', ('name', 'description', 'invitations', 'reward_sum'), (
+        ('Начальный уровень', 'Пригласите 5 друзей и получите награду', 5, 50.00),
+        ('Продвинутый уровень', 'Пригласите 10 друзей и получите награду', 10, 150.00),
+        ('Профессионал', 'Пригласите 25 друзей и получите награду', 25, 500.00),
+    )),
+)
+
+# Индексы под частые запросы: (имя, таблица, колонки).
+# Индекс на отсутствующую таблицу или колонку пропускается.
+SCHEMA_INDEXES = (
+    ('idx_user_subscription_user_active', 'user_subscription', 'user_id, is_active, end_date'),
+    ('idx_user_subscription_user_tariff', 'user_subscription', 'user_id, tariff_id, is_active, end_ts'),
+    ('idx_user_subscription_active_end_ts', 'user_subscription', 'is_active, end_ts'),
+    ('idx_user_subscription_server_active', 'user_subscription', 'server_id, is_active'),
+    ('idx_user_subscription_payment_id', 'user_subscription', 'payment_id'),
+    ('idx_user_username', 'user', 'username'),
+    ('idx_user_username_lower', 'user', 'LOWER(username)'),
+    ('idx_user_date', 'user', 'date'),
+    ('idx_payments_user_date', 'payments', 'user_id, date'),
+    ('idx_payments_date', 'payments', 'date'),
+    ('idx_promocodes_promocod', 'promocodes', 'promocod'),
+    ('idx_raffle_tickets_raffle_user', 'raffle_tickets', 'raffle_id, telegram_id'),
+    ('idx_raffle_tickets_user_raffle', 'raffle_tickets', 'telegram_id, raffle_id, created_at'),
+    ('idx_balance_transactions_user_created', 'balance_transactions', 'user_id, created_at'),
+    ('idx_balance_transactions_created', 'balance_transactions', 'created_at'),
+    ('idx_referral_rewards_user_condition', 'referral_rewards_history', 'user_id, condition_id'),
+    ('idx_crypto_payments_invoice', 'crypto_payments', 'invoice_id'),
+    ('idx_crypto_payments_user_created', 'crypto_payments', 'user_id, created_at'),
+)
+
+# Индексы, которые перекрываются более широкими из SCHEMA_INDEXES
+OBSOLETE_INDEXES = (
+    'idx_balance_transactions_user_id',
+    'idx_user_balance_user_id',
+    'idx_user_subscription_active_end',
+)
+
+# end_ts — время окончания подписки в секундах UTC, вычисляется из end_date.
+# Даты без часового пояса считаются локальным временем (datetime.now()),
+# даты с суффиксом (+00:00, Z) переводятся в UTC.
+SUBSCRIPTION_END_TS_SQL = "CAST(strftime('%s', {column}, 'utc') AS INTEGER)"
+
+SUBSCRIPTION_END_TS_TRIGGERS = (
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_user_subscription_end_ts_insert
+    AFTER INSERT ON user_subscription
+    FOR EACH ROW WHEN NEW.end_ts IS NULL
+    BEGIN
+        UPDATE user_subscription
+        SET end_ts = {SUBSCRIPTION_END_TS_SQL.format(column='NEW.end_date')}
+        WHERE id = NEW.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_user_subscription_end_ts_update
+    AFTER UPDATE OF end_date ON user_subscription
+    FOR EACH ROW
+    BEGIN
+        UPDATE user_subscription
+        SET end_ts = {SUBSCRIPTION_END_TS_SQL.format(column='NEW.end_date')}
+        WHERE id = NEW.id;
+    END
+    """,
+)
+
+# Операции с балансом: одна строка user_balance на пользователя
+# (уникальный индекс idx_user_balance_user_unique, см. migrate_user_balance_unique).
+BALANCE_CREDIT_SQL = """
+    INSERT INTO user_balance (user_id, balance) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE
+    SET balance = balance + excluded.balance, last_update = CURRENT_TIMESTAMP
+    RETURNING balance
+"""
+
+BALANCE_DEBIT_SQL = """
+    UPDATE user_balance
+    SET balance = balance - ?, last_update = CURRENT_TIMESTAMP
+    WHERE user_id = ? AND balance >= ?
+    RETURNING balance
+"""
+
+BALANCE_TRANSACTION_SQL = """
+    INSERT INTO balance_transactions (user_id, amount, type, description, payment_id)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# Снимок статистики обновляется триггерами при каждой записи в user,
+# payments и user_subscription — из любого процесса (бот, API, админка).
+# stats_subscriptions хранит счетчики в разрезе (сервер, тариф): по ним
+# считаются общее число подписок, популярный тариф и заработок серверов
+# с текущими ценами тарифов. Пересчет с нуля — Database.rebuild_statistics().
+STATS_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS stats_snapshot (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        users_count INTEGER NOT NULL DEFAULT 0,
+        payments_amount REAL NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS stats_subscriptions (
+        server_id INTEGER NOT NULL,
+        tariff_id INTEGER NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        active INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (server_id, tariff_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS stats_buyers (
+        user_id INTEGER PRIMARY KEY,
+        purchase_count INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_stats_buyers_count ON stats_buyers(purchase_count)",
+)
+
+_STATS_SUBSCRIPTION_ADD = """
+        INSERT OR IGNORE INTO stats_subscriptions (server_id, tariff_id) VALUES (NEW.server_id, NEW.tariff_id);
+        UPDATE stats_subscriptions
+        SET total = total + 1, active = active + (NEW.is_active = 1)
+        WHERE server_id = NEW.server_id AND tariff_id = NEW.tariff_id;
+"""
+
+_STATS_SUBSCRIPTION_REMOVE = """
+        UPDATE stats_subscriptions
+        SET total = total - 1, active = active - (OLD.is_active = 1)
+        WHERE server_id = OLD.server_id AND tariff_id = OLD.tariff_id;
+"""
+
+_STATS_BUYER_ADD = """
+        INSERT OR IGNORE INTO stats_buyers (user_id) VALUES (NEW.user_id);
+        UPDATE stats_buyers SET purchase_count = purchase_count + 1 WHERE user_id = NEW.user_id;
+"""
+
+_STATS_BUYER_REMOVE = """
+        UPDATE stats_buyers SET purchase_count = purchase_count - 1 WHERE user_id = OLD.user_id;
+"""
+
+STATS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_user_insert AFTER INSERT ON user
+    BEGIN
+        UPDATE stats_snapshot SET users_count = users_count + 1 WHERE id = 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_user_delete AFTER DELETE ON user
+    BEGIN
+        UPDATE stats_snapshot SET users_count = users_count - 1 WHERE id = 1;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_stats_payments_insert AFTER INSERT ON payments
+    BEGIN
+        UPDATE stats_snapshot SET payments_amount = payments_amount + COALESCE(NEW.price, 0) WHERE id = 1;
+        {_STATS_BUYER_ADD}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_stats_payments_delete AFTER DELETE ON payments
+    BEGIN
+        UPDATE stats_snapshot SET payments_amount = payments_amount - COALESCE(OLD.price, 0) WHERE id = 1;
+        {_STATS_BUYER_REMOVE}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_stats_payments_update AFTER UPDATE OF price, user_id ON payments
+    BEGIN
+        UPDATE stats_snapshot
+        SET payments_amount = payments_amount - COALESCE(OLD.price, 0) + COALESCE(NEW.price, 0)
+        WHERE id = 1;
+        {_STATS_BUYER_REMOVE}
+        {_STATS_BUYER_ADD}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_stats_user_subscription_insert AFTER INSERT ON user_subscription
+    BEGIN
+        {_STATS_SUBSCRIPTION_ADD}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_stats_user_subscription_delete AFTER DELETE ON user_subscription
+    BEGIN
+        {_STATS_SUBSCRIPTION_REMOVE}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_stats_user_subscription_update
+    AFTER UPDATE OF server_id, tariff_id, is_active ON user_subscription
+    BEGIN
+        {_STATS_SUBSCRIPTION_REMOVE}
+        {_STATS_SUBSCRIPTION_ADD}
+    END
+    """,
+)
+
+# Расход трафика подписок: приращения за интервал bucket длиной period секунд.
+# Свежие данные хранятся почасово, старше TRAFFIC_ROLLUP_DAYS сворачиваются в сутки.
+TRAFFIC_HOUR = 3600
+TRAFFIC_DAY = 86400
+
+TRAFFIC_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS traffic_usage (
+        subscription_id INTEGER NOT NULL,
+        period INTEGER NOT NULL,
+        bucket INTEGER NOT NULL,
+        up INTEGER NOT NULL DEFAULT 0,
+        down INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (subscription_id, period, bucket)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_traffic_usage_period_bucket ON traffic_usage(period, bucket)",
+    """
+    CREATE TABLE IF NOT EXISTS traffic_counters (
+        subscription_id INTEGER PRIMARY KEY,
+        up INTEGER NOT NULL DEFAULT 0,
+        down INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """,
+)
+
+# Почасовые итоги проверок доступности серверов (handlers/health_monitor.py)
+# и результат последней проверки в каждом часе
+SERVER_HEALTH_TABLE = """
+    CREATE TABLE IF NOT EXISTS server_health (
+        server_id INTEGER NOT NULL,
+        bucket INTEGER NOT NULL,
+        probes INTEGER NOT NULL DEFAULT 0,
+        failures INTEGER NOT NULL DEFAULT 0,
+        latency_sum INTEGER NOT NULL DEFAULT 0,
+        latency_max INTEGER NOT NULL DEFAULT 0,
+        last_at INTEGER NOT NULL,
+        last_ok INTEGER NOT NULL,
+        last_latency INTEGER,
+        last_status INTEGER,
+        PRIMARY KEY (server_id, bucket)
+    ) WITHOUT ROWID
+"""
+
+# Очередь создания оплаченных подписок (handlers/provisioning.py).
+# Задание пишется в одной транзакции с подтверждением оплаты, payment_id
+# уникален — повторная проверка того же платежа не создает второе задание.
+PROVISIONING_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS provisioning_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payment_id TEXT NOT NULL UNIQUE,
+        user_id INTEGER NOT NULL,
+        tariff_id INTEGER NOT NULL,
+        provider TEXT,
+        price DECIMAL(10,2),
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at INTEGER NOT NULL DEFAULT 0,
+        subscription_id INTEGER,
+        error TEXT,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_provisioning_jobs_status_next ON provisioning_jobs(status, next_attempt_at)",
+)
+
+# Заранее созданные отключенные клиенты панелей (handlers/key_pool.py).
+# Ключ выдается удалением строки, поэтому один ключ не достанется двоим.
+KEY_POOL_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS key_pool (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server_id INTEGER NOT NULL,
+        inbound_id INTEGER NOT NULL,
+        client_id TEXT NOT NULL,
+        email TEXT NOT NULL,
+        link TEXT NOT NULL,
+        created_at INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_key_pool_server_inbound ON key_pool(server_id, inbound_id)",
+)
+
+# Переносы подписок с сервера (handlers/evacuation.py). after_id — последняя
+# обработанная подписка источника, с нее перенос продолжается после перезапуска.
+# Для сервера может быть только один незавершенный перенос.
+SERVER_EVACUATION_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS server_evacuations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source_server_id INTEGER NOT NULL,
+        target_server_ids TEXT,
+        delete_source INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'pending',
+        after_id INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        moved INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        old_deleted INTEGER NOT NULL DEFAULT 0,
+        notified INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL,
+        finished_at INTEGER
+    )
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_server_evacuations_active
+    ON server_evacuations(source_server_id) WHERE status IN ('pending', 'running')
+    """,
+)
+
+# Продления подписок без нового ключа (SubscriptionManager.extend_subscription).
+# payment_id оплаты продления хранится здесь, а не в user_subscription: там
+# остается платеж, по которому подписка создана.
+SUBSCRIPTION_RENEWAL_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS subscription_renewals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        subscription_id INTEGER NOT NULL,
+        payment_id TEXT UNIQUE,
+        days INTEGER NOT NULL,
+        end_date TIMESTAMP NOT NULL,
+        created_at INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_subscription_renewals_subscription ON subscription_renewals(subscription_id)",
+)
+
+# Продление — такая же покупка тарифа, как новая подписка: сервер и тариф
+# продления хранятся в subscription_renewals, а stats_subscriptions.renewals
+# учитывает их в заработке и популярности тарифов. tariff_id NULL у продления
+# на произвольный срок (API без тарифа) — оно не считается покупкой.
+RENEWAL_STATS_COLUMNS = (
+    ('subscription_renewals', 'server_id', 'INTEGER'),
+    ('subscription_renewals', 'tariff_id', 'INTEGER'),
+    ('stats_subscriptions', 'renewals', 'INTEGER NOT NULL DEFAULT 0'),
+)
+
+RENEWAL_STATS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_subscription_renewals_insert AFTER INSERT ON subscription_renewals
+    WHEN NEW.server_id IS NOT NULL AND NEW.tariff_id IS NOT NULL
+    BEGIN
+        INSERT OR IGNORE INTO stats_subscriptions (server_id, tariff_id) VALUES (NEW.server_id, NEW.tariff_id);
+        UPDATE stats_subscriptions SET renewals = renewals + 1
+        WHERE server_id = NEW.server_id AND tariff_id = NEW.tariff_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_subscription_renewals_delete AFTER DELETE ON subscription_renewals
+    WHEN OLD.server_id IS NOT NULL AND OLD.tariff_id IS NOT NULL
+    BEGIN
+        UPDATE stats_subscriptions SET renewals = renewals - 1
+        WHERE server_id = OLD.server_id AND tariff_id = OLD.tariff_id;
+    END
+    """,
+)
+
+# Токены ссылок на подписку (handlers/subscription_feed.py). version
+# увеличивается триггерами при любом изменении подписок пользователя —
+# по ней процессы сбрасывают закэшированное тело подписки.
+SUBSCRIPTION_TOKEN_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS subscription_tokens (
+        user_id INTEGER PRIMARY KEY,
+        token TEXT NOT NULL UNIQUE,
+        version INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_subscription_tokens_insert AFTER INSERT ON user_subscription
+    BEGIN
+        UPDATE subscription_tokens SET version = version + 1 WHERE user_id = NEW.user_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_subscription_tokens_update
+    AFTER UPDATE OF user_id, server_id, vless, is_active, end_date ON user_subscription
+    BEGIN
+        UPDATE subscription_tokens SET version = version + 1 WHERE user_id IN (OLD.user_id, NEW.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_subscription_tokens_delete AFTER DELETE ON user_subscription
+    BEGIN
+        UPDATE subscription_tokens SET version = version + 1 WHERE user_id = OLD.user_id;
+    END
+    """,
+)
+
 class Database:
-    def __init__(self, db_path: str = 'instance/database.db'):
+    _pools: Dict[str, ConnectionPool] = {}
+    _settings: Dict[str, SettingsCache] = {}
+
+    def __init__(self, db_path: str = 'instance/database.db', pool_size: int = DEFAULT_POOL_SIZE,
+                 pool_timeout: float = DEFAULT_POOL_TIMEOUT):
         self.db_path = db_path
+        if db_path not in Database._pools:
+            Database._pools[db_path] = ConnectionPool(db_path, size=pool_size, timeout=pool_timeout)
+        self.pool = Database._pools[db_path]
+        if db_path not in Database._settings:
+            cache = SettingsCache(self.pool.acquire)
+            self.pool.add_commit_listener(cache.expire)
+            Database._settings[db_path] = cache
+        self.settings = Database._settings[db_path]
+
+    def acquire(self, write: bool = False):
+        """
+        Получение соединения из общего пула.
+        Все экземпляры Database с одним db_path используют один пул.
+
+        :param write: True для выделенного соединения на запись
+        """
+        return self.pool.acquire(write=write)
+
+    def pool_stats(self) -> Dict:
+        """Метрики пула соединений"""
+        return self.pool.stats()
+
+    def settings_cache_stats(self) -> Dict:
+        """Метрики кэша настроек"""
+        return self.settings.stats()
+
+    async def close(self):
+        """Закрытие соединений пула"""
+        await self.pool.close()
 
     async def db_operation_with_retry(self, operation_func, max_attempts=5):
         """Выполнение операции с базой данных с повторными попытками при блокировке"""
@@ -34,14 +551,64 @@ class Database:
                 raise
 
     async def init_db(self):
-        """Инициализация базы данных"""
-        async def _init_db_operation():
-            async with aiosqlite.connect(self.db_path, timeout=20.0) as conn:
-                 
-                await conn.execute("PRAGMA journal_mode=WAL;")      
-                await conn.execute("PRAGMA synchronous=NORMAL;")    
-                await conn.execute("PRAGMA busy_timeout=2000;")     
-                
+        """
+        Инициализация базы данных: применение недостающих миграций (MIGRATIONS).
+        Для актуальной схемы это одно чтение PRAGMA user_version.
+        """
+        await self.migrate()
+
+    async def schema_version(self) -> int:
+        """Версия схемы базы (PRAGMA user_version)"""
+        async def _operation():
+            async with self.acquire() as conn:
+                async with conn.execute("PRAGMA user_version") as cursor:
+                    return (await cursor.fetchone())[0]
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def migrate(self) -> int:
+        """
+        Последовательное применение миграций с версией больше текущей.
+        После каждого шага версия схемы сохраняется, поэтому прерванная
+        миграция продолжается со следующего запуска. Шаги идемпотентны:
+        базы, созданные до появления user_version, проходят их все.
+
+        :return: количество примененных миграций
+        """
+        current = await self.schema_version()
+        if current == SCHEMA_VERSION:
+            return 0
+        if current > SCHEMA_VERSION:
+            logger.warning(f"Версия схемы базы {current} новее поддерживаемой {SCHEMA_VERSION}")
+            return 0
+
+        applied = 0
+        for version, description, step in MIGRATIONS:
+            if version <= current:
+                continue
+            started = time.monotonic()
+            logger.info(f"Миграция {version}/{SCHEMA_VERSION}: {description}")
+            await getattr(self, step)()
+            await self._set_schema_version(version)
+            applied += 1
+            logger.info(f"Миграция {version} применена за {time.monotonic() - started:.2f}с")
+
+        self.settings.clear()
+        logger.info(f"База данных обновлена до версии {SCHEMA_VERSION}")
+        return applied
+
+    async def _set_schema_version(self, version: int):
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                await conn.execute(f"PRAGMA user_version = {int(version)}")
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def create_base_tables(self):
+        """Создание основных таблиц, которых еще нет"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
                 
                 await conn.execute('''
                     CREATE TABLE IF NOT EXISTS bot_settings (
@@ -79,19 +646,7 @@ class Database:
                     )
                 ''')
 
-                await conn.execute('''
-                    CREATE TABLE IF NOT EXISTS user (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT,
-                        telegram_id INTEGER UNIQUE NOT NULL,
-                        trial_period BOOLEAN DEFAULT 0,
-                        is_enable BOOLEAN NOT NULL DEFAULT 1,
-                        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        referral_code TEXT UNIQUE,
-                        referral_count INTEGER DEFAULT 0,
-                        referred_by TEXT
-                    )
-                ''')
+                await conn.execute(USER_TABLE_SQL.format(name='user'))
 
                 await conn.execute('''
                     CREATE TABLE IF NOT EXISTS tariff (
@@ -125,6 +680,7 @@ class Database:
                         server_id INTEGER NOT NULL,
                         start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         end_date TIMESTAMP NOT NULL,
+                        end_ts INTEGER,
                         vless TEXT,
                         is_active BOOLEAN NOT NULL DEFAULT 1,
                         FOREIGN KEY (user_id) REFERENCES user(id),
@@ -269,8 +825,6 @@ class Database:
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
-                await conn.commit()
-               # logger.info("Таблица referral_condition успешно создана или уже существует")
 
                 await conn.execute("""
                     CREATE TABLE IF NOT EXISTS referral_progress (
@@ -281,28 +835,11 @@ class Database:
                         FOREIGN KEY (user_id) REFERENCES user(telegram_id)
                     )
                 """)
-                await conn.commit()
-               # logger.info("Таблица referral_progress успешно создана или уже существует")
 
                 await conn.execute("""
                     CREATE INDEX IF NOT EXISTS idx_referral_progress_user_id 
                     ON referral_progress(user_id)
                 """)
-                await conn.commit()
-                logger.info("Индексы для таблиц рефералов успешно созданы")
-
-                async with conn.execute("SELECT COUNT(*) FROM referral_condition") as cursor:
-                    count = await cursor.fetchone()
-                    if count[0] == 0:
-                        await conn.execute("""
-                            INSERT INTO referral_condition (name, description, invitations, reward_sum)
-                            VALUES 
-                            ('Начальный уровень', 'Пригласите 5 друзей и получите награду', 5, 50.00),
-                            ('Продвинутый уровень', 'Пригласите 10 друзей и получите награду', 10, 150.00),
-                            ('Профессионал', 'Пригласите 25 друзей и получите награду', 25, 500.00)
-                        """)
-                        await conn.commit()
-                     #   logger.info("Добавлены тестовые условия реферальной программы")
 
                 await conn.execute("""
                     CREATE TABLE IF NOT EXISTS referral_rewards_history (
@@ -315,60 +852,635 @@ class Database:
                         FOREIGN KEY (condition_id) REFERENCES referral_condition(id)
                     )
                 """)
-                await conn.commit()
-               # logger.info("Таблица referral_rewards_history успешно создана или уже существует")
+
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS pspayments_settings (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT,
+                        shop_id TEXT NOT NULL,
+                        api_key TEXT NOT NULL,
+                        api_secret_key TEXT NOT NULL,
+                        description TEXT,
+                        is_enable INTEGER DEFAULT 0
+                    )
+                ''')
+
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS crypto_payments (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER NOT NULL,
+                        tariff_id INTEGER NOT NULL,
+                        invoice_id TEXT NOT NULL,
+                        amount DECIMAL(10,2) NOT NULL,
+                        asset TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (user_id) REFERENCES user (id),
+                        FOREIGN KEY (tariff_id) REFERENCES tariff (id)
+                    )
+                ''')
+
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS tariff_promo (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT NOT NULL,
+                        description TEXT,
+                        left_day INTEGER NOT NULL,
+                        server_id INTEGER,
+                        is_enable BOOLEAN NOT NULL DEFAULT 1,
+                        FOREIGN KEY (server_id) REFERENCES server_settings(id)
+                    )
+                """)
+
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS Reviews (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT NOT NULL,
+                        message TEXT NOT NULL,
+                        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
 
                 await conn.commit()
-                logger.info("База данных инициализирована")
         
-        return await self.db_operation_with_retry(_init_db_operation)
+        await self.db_operation_with_retry(_operation)
+
+    async def add_legacy_columns(self) -> int:
+        """
+        Добавление колонок, которые раньше добавлял update_db.py (LEGACY_COLUMNS)
+
+        :return: количество добавленных колонок
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                added = 0
+                for table, column, definition in LEGACY_COLUMNS:
+                    if column in await self._table_columns(conn, table):
+                        continue
+                    logger.info(f"Добавление колонки '{column}' в таблицу {table}")
+                    await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                    added += 1
+
+                await conn.execute("UPDATE payments SET provider = 'default' WHERE provider IS NULL")
+                await conn.commit()
+                return added
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def add_placement_columns(self) -> int:
+        """
+        Добавление колонок размещения подписок (PLACEMENT_COLUMNS)
+
+        :return: количество добавленных колонок
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                added = 0
+                for table, column, definition in PLACEMENT_COLUMNS:
+                    if column in await self._table_columns(conn, table):
+                        continue
+                    await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                    added += 1
+                await conn.commit()
+                return added
+
+        return await self.db_operation_with_retry(_operation)
+
+    @staticmethod
+    async def _table_columns(conn, table: str) -> List[str]:
+        async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+            return [row[1] for row in await cursor.fetchall()]
+
+    async def migrate_user_referral_columns(self):
+        """
+        Колонки реферальной системы в таблице user. referral_code UNIQUE
+        нельзя добавить через ALTER TABLE, поэтому старая таблица
+        пересобирается (см. _rebuild_table).
+        """
+        async def _columns():
+            async with self.acquire() as conn:
+                return await self._table_columns(conn, 'user')
+
+        columns = await self.db_operation_with_retry(_columns)
+        if 'referral_code' not in columns:
+            logger.info("Добавление колонок для реферальной системы в таблицу user")
+            await self._rebuild_table('user', USER_TABLE_SQL)
+            columns = await self.db_operation_with_retry(_columns)
+
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                if 'referral_count' not in columns:
+                    await conn.execute("ALTER TABLE user ADD COLUMN referral_count INTEGER DEFAULT 0")
+                if 'referred_by' not in columns:
+                    await conn.execute("ALTER TABLE user ADD COLUMN referred_by TEXT")
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def _rebuild_table(self, table: str, create_sql: str, batch_size: int = MIGRATION_BATCH_SIZE):
+        """
+        Пересборка таблицы по новому описанию без долгой блокировки записи.
+
+        Строки копируются в {table}_new пачками по id, каждая пачка — отдельная
+        запись. Изменения, сделанные во время копирования, переносятся
+        триггерами. После копирования таблицы меняются местами.
+        Прерванную пересборку можно безопасно запустить повторно.
+
+        :param create_sql: CREATE TABLE с плейсхолдером {name} для имени таблицы
+        """
+        new_table = f"{table}_new"
+
+        async def _prepare():
+            async with self.acquire(write=True) as conn:
+                await conn.execute(create_sql.format(name=new_table))
+                old_columns = await self._table_columns(conn, table)
+                new_columns = await self._table_columns(conn, new_table)
+                columns = [c for c in new_columns if c in old_columns]
+                column_list = ", ".join(columns)
+                values = ", ".join(f"NEW.{c}" for c in columns)
+                await conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{new_table}_insert AFTER INSERT ON {table}
+                    BEGIN
+                        INSERT OR REPLACE INTO {new_table} ({column_list}) VALUES ({values});
+                    END
+                """)
+                await conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{new_table}_update AFTER UPDATE ON {table}
+                    BEGIN
+                        DELETE FROM {new_table} WHERE id = OLD.id;
+                        INSERT OR REPLACE INTO {new_table} ({column_list}) VALUES ({values});
+                    END
+                """)
+                await conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{new_table}_delete AFTER DELETE ON {table}
+                    BEGIN
+                        DELETE FROM {new_table} WHERE id = OLD.id;
+                    END
+                """)
+                async with conn.execute(f"SELECT MIN(id), MAX(id), COUNT(*) FROM {table}") as cursor:
+                    bounds = await cursor.fetchone()
+                await conn.commit()
+                return column_list, bounds
+
+        column_list, (min_id, max_id, total) = await self.db_operation_with_retry(_prepare)
+
+        if total:
+            # Уже скопированные строки пропускаются (INSERT OR IGNORE)
+            start = min_id - 1
+            copied = 0
+            while start < max_id:
+                end = start + batch_size
+
+                async def _copy_batch():
+                    async with self.acquire(write=True) as conn:
+                        cursor = await conn.execute(f"""
+                            INSERT OR IGNORE INTO {new_table} ({column_list})
+                            SELECT {column_list} FROM {table} WHERE id > ? AND id <= ?
+                        """, (start, end))
+                        await conn.commit()
+                        return cursor.rowcount
+
+                copied += await self.db_operation_with_retry(_copy_batch)
+                start = end
+                logger.info(f"Пересборка {table}: скопировано {copied} из {total} строк")
+
+        async def _swap():
+            async with self.acquire(write=True) as conn:
+                await conn.execute(f"DROP TABLE {table}")
+                await conn.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+                await conn.commit()
+
+        await self.db_operation_with_retry(_swap)
+        logger.info(f"Таблица {table} пересобрана")
+
+    async def seed_defaults(self):
+        """Начальные записи настроек, которых еще нет"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                for table, columns, values in DEFAULT_ROWS:
+                    async with conn.execute(f"SELECT 1 FROM {table} LIMIT 1") as cursor:
+                        if await cursor.fetchone():
+                            continue
+                    placeholders = ", ".join("?" for _ in columns)
+                    await conn.executemany(
+                        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                        values
+                    )
+                    logger.info(f"Добавлены начальные записи в таблицу {table}")
+
+                await conn.execute("""
+                    INSERT INTO referral_progress (user_id)
+                    SELECT telegram_id
+                    FROM user
+                    WHERE telegram_id NOT IN (SELECT user_id FROM referral_progress)
+                """)
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def create_settings_version(self):
+        """
+        Создание таблицы settings_version и триггеров, которые увеличивают
+        версию при любом изменении таблиц настроек (SETTINGS_TABLES).
+        По версии процессы бота, API и админки сбрасывают кэш настроек.
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS settings_version (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        version INTEGER NOT NULL DEFAULT 0
+                    )
+                """)
+                await conn.execute("INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0)")
+
+                for table in SETTINGS_TABLES:
+                    for event in ('INSERT', 'UPDATE', 'DELETE'):
+                        try:
+                            await conn.execute(f"""
+                                CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()}
+                                AFTER {event} ON {table}
+                                BEGIN
+                                    UPDATE settings_version SET version = version + 1 WHERE id = 1;
+                                END
+                            """)
+                        except aiosqlite.OperationalError as e:
+                            logger.debug(f"Триггер версии настроек для {table} пропущен: {e}")
+
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+        self.settings.clear()
+
+    async def create_statistics_snapshot(self):
+        """
+        Создание таблиц снимка статистики (STATS_TABLES) и триггеров,
+        которые обновляют их при записи. При первом запуске снимок
+        заполняется из существующих данных.
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                for statement in STATS_TABLES + STATS_TRIGGERS:
+                    await conn.execute(statement)
+
+                async with conn.execute("SELECT 1 FROM stats_snapshot WHERE id = 1") as cursor:
+                    initialized = await cursor.fetchone() is not None
+                if not initialized:
+                    await self._fill_statistics(conn)
+                    logger.info("Снимок статистики заполнен")
+
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def create_traffic_usage(self):
+        """Создание таблиц расхода трафика (TRAFFIC_TABLES)"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                for statement in TRAFFIC_TABLES:
+                    await conn.execute(statement)
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def create_server_health(self):
+        """Создание таблицы почасовой доступности серверов (SERVER_HEALTH_TABLE)"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                await conn.execute(SERVER_HEALTH_TABLE)
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def create_provisioning_jobs(self):
+        """Создание таблицы очереди создания подписок (PROVISIONING_TABLES)"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                for statement in PROVISIONING_TABLES:
+                    await conn.execute(statement)
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def create_key_pool(self):
+        """Создание таблицы пула ключей (KEY_POOL_TABLES)"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                for statement in KEY_POOL_TABLES:
+                    await conn.execute(statement)
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def create_server_evacuations(self):
+        """Создание таблицы переносов подписок (SERVER_EVACUATION_TABLES)"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                for statement in SERVER_EVACUATION_TABLES:
+                    await conn.execute(statement)
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def create_subscription_tokens(self):
+        """Создание таблицы токенов ссылок на подписку и триггеров ее версии (SUBSCRIPTION_TOKEN_TABLES)"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                for statement in SUBSCRIPTION_TOKEN_TABLES:
+                    await conn.execute(statement)
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def create_subscription_renewals(self):
+        """
+        Создание таблицы продлений подписок (SUBSCRIPTION_RENEWAL_TABLES)
+        и колонки inbound клиента подписки (SUBSCRIPTION_INBOUND_COLUMN)
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                for statement in SUBSCRIPTION_RENEWAL_TABLES:
+                    await conn.execute(statement)
+                table, column, definition = SUBSCRIPTION_INBOUND_COLUMN
+                if column not in await self._table_columns(conn, table):
+                    await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def create_renewal_statistics(self):
+        """
+        Колонки и триггеры учета продлений в статистике (RENEWAL_STATS_COLUMNS,
+        RENEWAL_STATS_TRIGGERS). Сервер и тариф уже записанных продлений
+        берутся из их подписок, после чего снимок пересчитывается.
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                for table, column, definition in RENEWAL_STATS_COLUMNS:
+                    if column not in await self._table_columns(conn, table):
+                        await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                await conn.execute("""
+                    UPDATE subscription_renewals
+                    SET server_id = (SELECT server_id FROM user_subscription WHERE id = subscription_id),
+                        tariff_id = (SELECT tariff_id FROM user_subscription WHERE id = subscription_id)
+                    WHERE server_id IS NULL
+                """)
+                for statement in RENEWAL_STATS_TRIGGERS:
+                    await conn.execute(statement)
+                await self._fill_statistics(conn)
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def _fill_statistics(self, conn):
+        """Пересчет снимка статистики с нуля на переданном соединении"""
+        await conn.execute("DELETE FROM stats_snapshot")
+        await conn.execute("DELETE FROM stats_subscriptions")
+        await conn.execute("DELETE FROM stats_buyers")
+        await conn.execute("""
+            INSERT INTO stats_snapshot (id, users_count, payments_amount)
+            SELECT 1,
+                   (SELECT COUNT(*) FROM user),
+                   (SELECT COALESCE(SUM(price), 0) FROM payments)
+        """)
+        await conn.execute("""
+            INSERT INTO stats_subscriptions (server_id, tariff_id, total, active)
+            SELECT server_id, tariff_id, COUNT(*), SUM(is_active = 1)
+            FROM user_subscription
+            GROUP BY server_id, tariff_id
+        """)
+        # До миграции create_renewal_statistics продлений в снимке нет
+        if 'renewals' in await self._table_columns(conn, 'stats_subscriptions'):
+            await conn.execute("""
+                INSERT INTO stats_subscriptions (server_id, tariff_id, renewals)
+                SELECT server_id, tariff_id, COUNT(*)
+                FROM subscription_renewals
+                WHERE server_id IS NOT NULL AND tariff_id IS NOT NULL
+                GROUP BY server_id, tariff_id
+                ON CONFLICT(server_id, tariff_id) DO UPDATE SET renewals = excluded.renewals
+            """)
+        await conn.execute("""
+            INSERT INTO stats_buyers (user_id, purchase_count)
+            SELECT user_id, COUNT(*) FROM payments GROUP BY user_id
+        """)
+
+    async def rebuild_statistics(self) -> bool:
+        """
+        Пересчет снимка статистики по таблицам user, payments и user_subscription.
+        Нужен после ручной правки базы в обход триггеров.
+        """
+        async def _operation():
+            try:
+                async with self.acquire(write=True) as conn:
+                    await self._fill_statistics(conn)
+                    await conn.commit()
+                    logger.info("Снимок статистики пересчитан")
+                    return True
+            except Exception as e:
+                logger.error(f"Ошибка при пересчете статистики: {e}")
+                return False
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def migrate_subscription_end_ts(self, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+        """
+        Добавление колонки end_ts в user_subscription, триггеров для ее
+        обновления при любой записи end_date и заполнение существующих строк
+        пачками по id.
+
+        :return: количество заполненных строк
+        """
+        async def _prepare():
+            async with self.acquire(write=True) as conn:
+                if 'end_ts' not in await self._table_columns(conn, 'user_subscription'):
+                    logger.info("Добавление колонки 'end_ts' в таблицу user_subscription")
+                    await conn.execute("ALTER TABLE user_subscription ADD COLUMN end_ts INTEGER")
+
+                for trigger in SUBSCRIPTION_END_TS_TRIGGERS:
+                    await conn.execute(trigger)
+
+                async with conn.execute("SELECT MIN(id), MAX(id) FROM user_subscription") as cursor:
+                    bounds = await cursor.fetchone()
+                await conn.commit()
+                return bounds
+
+        min_id, max_id = await self.db_operation_with_retry(_prepare)
+        if min_id is None:
+            return 0
+
+        updated = 0
+        start = min_id - 1
+        while start < max_id:
+            end = start + batch_size
+
+            async def _fill_batch():
+                async with self.acquire(write=True) as conn:
+                    cursor = await conn.execute(f"""
+                        UPDATE user_subscription
+                        SET end_ts = {SUBSCRIPTION_END_TS_SQL.format(column='end_date')}
+                        WHERE id > ? AND id <= ? AND end_ts IS NULL AND end_date IS NOT NULL
+                    """, (start, end))
+                    await conn.commit()
+                    return cursor.rowcount
+
+            updated += await self.db_operation_with_retry(_fill_batch)
+            start = end
+
+        if updated > 0:
+            logger.info(f"Заполнено end_ts для подписок: {updated}")
+        return updated
+
+    async def migrate_user_balance_unique(self) -> int:
+        """
+        Объединение повторяющихся строк user_balance одного пользователя
+        и создание уникального индекса по user_id, нужного для UPSERT в операциях с балансом.
+
+        :return: количество объединенных пользователей
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                async with conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_user_balance_user_unique'"
+                ) as cursor:
+                    if await cursor.fetchone():
+                        return 0
+
+                async with conn.execute("""
+                    SELECT user_id, MIN(id), SUM(balance)
+                    FROM user_balance
+                    GROUP BY user_id
+                    HAVING COUNT(*) > 1
+                """) as cursor:
+                    duplicates = await cursor.fetchall()
+
+                for user_id, keep_id, total in duplicates:
+                    await conn.execute(
+                        "UPDATE user_balance SET balance = ?, last_update = CURRENT_TIMESTAMP WHERE id = ?",
+                        (total, keep_id)
+                    )
+                    await conn.execute(
+                        "DELETE FROM user_balance WHERE user_id = ? AND id != ?",
+                        (user_id, keep_id)
+                    )
+
+                await conn.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS idx_user_balance_user_unique ON user_balance(user_id)"
+                )
+                await conn.commit()
+                if duplicates:
+                    logger.info(f"Объединены повторяющиеся балансы пользователей: {len(duplicates)}")
+                return len(duplicates)
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def create_indexes(self) -> int:
+        """
+        Создание индексов для частых запросов (SCHEMA_INDEXES).
+        Повторный вызов безопасен, возвращает количество новых индексов.
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                async with conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'") as cursor:
+                    existing = {row[0] for row in await cursor.fetchall()}
+
+                created = 0
+                for name, table, columns in SCHEMA_INDEXES:
+                    if name in existing:
+                        continue
+                    try:
+                        await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})")
+                        created += 1
+                    except aiosqlite.OperationalError as e:
+                        logger.debug(f"Индекс {name} пропущен: {e}")
+
+                for name in OBSOLETE_INDEXES:
+                    if name in existing:
+                        await conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+                await conn.commit()
+                if created:
+                    logger.info(f"Создано индексов: {created}")
+                return created
+
+        return await self.db_operation_with_retry(_operation)
 
     async def get_bot_settings(self) -> Optional[Dict]:
         """Получение настроек бота из базы данных"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('SELECT * FROM bot_settings LIMIT 1') as cursor:
-                settings = await cursor.fetchone()
-                if settings:
-                    return {
-                        'bot_token': settings[0],
-                        'admin_id': settings[1].split(','),
-                        'chat_id': settings[2],
-                        'chanel_id': settings[3],
-                        'is_enable': bool(settings[4])
-                    }
-                return None
+        async def _operation():
+            async with self.acquire() as db:
+                async with db.execute('SELECT * FROM bot_settings LIMIT 1') as cursor:
+                    settings = await cursor.fetchone()
+                    if settings:
+                        return {
+                            'bot_token': settings[0],
+                            'admin_id': settings[1].split(','),
+                            'chat_id': settings[2],
+                            'chanel_id': settings[3],
+                            'is_enable': bool(settings[4])
+                        }
+                    return None
+
+        return await self.settings.get('bot_settings', _operation)
 
     async def get_bot_message(self, command: str) -> Optional[Dict]:
         """Получение сообщения бота по команде"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                'SELECT * FROM bot_message WHERE command = ? AND is_enable = 1', 
-                (command,)
-            ) as cursor:
-                message = await cursor.fetchone()
-                if message:
-                    return {
-                        'command': message[0],
-                        'text': message[1],
-                        'image_path': message[2],
-                        'is_enable': bool(message[3])
-                    }
-                return None
+        async def _operation():
+            async with self.acquire() as db:
+                async with db.execute(
+                    'SELECT * FROM bot_message WHERE command = ? AND is_enable = 1', 
+                    (command,)
+                ) as cursor:
+                    message = await cursor.fetchone()
+                    if message:
+                        return {
+                            'command': message[0],
+                            'text': message[1],
+                            'image_path': message[2],
+                            'is_enable': bool(message[3])
+                        }
+                    return None
+
+        return await self.settings.get(('bot_message', command), _operation)
 
     async def get_all_servers(self) -> List[Dict]:
         """Получение списка всех серверов"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.acquire() as db:
             db.row_factory = aiosqlite.Row
             async with db.execute('SELECT * FROM server_settings') as cursor:
                 servers = await cursor.fetchall()
                 return [dict(server) for server in servers]
 
+    async def get_placement_servers(self) -> List[Dict]:
+        """Включенные серверы для выбора при создании подписки (кэшируются до изменения server_settings)"""
+        async def _operation():
+            async with self.acquire() as conn:
+                conn.row_factory = aiosqlite.Row
+                async with conn.execute('SELECT * FROM server_settings WHERE is_enable = 1') as cursor:
+                    return [dict(server) for server in await cursor.fetchall()]
+
+        return await self.settings.get(('placement_servers',), _operation)
+
+    async def get_active_subscription_counts(self) -> Dict[int, int]:
+        """Количество активных подписок на каждом сервере (индекс idx_user_subscription_server_active)"""
+        async with self.acquire() as conn:
+            async with conn.execute("""
+                SELECT server_id, COUNT(*) FROM user_subscription
+                WHERE is_active = 1 GROUP BY server_id
+            """) as cursor:
+                return {server_id: count for server_id, count in await cursor.fetchall()}
+
     async def register_user(self, telegram_id: int, username: str = None, bot = None) -> bool:
-        """Регистрация нового пользователя"""
+        """
+        Регистрация нового пользователя. Проверка существования и подбор
+        реферального кода идут на читающем соединении, запись берется только
+        для INSERT; повторный /start уже зарегистрированного пользователя
+        запись не занимает.
+        """
         try:
             current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 async with db.execute(
                     'SELECT id FROM user WHERE telegram_id = ?',
                     (telegram_id,)
@@ -385,12 +1497,22 @@ class Database:
                     ) as cursor:
                         if not await cursor.fetchone():
                             break
-                
-                await db.execute(
-                    'INSERT INTO user (telegram_id, username, referral_code) VALUES (?, ?, ?)',
+
+                async with db.execute(
+                    'SELECT reg_notify FROM bot_settings LIMIT 1'
+                ) as cursor:
+                    notify_settings = await cursor.fetchone()
+
+            async with self.acquire(write=True) as db:
+                # Пользователя мог зарегистрировать параллельный /start
+                cursor = await db.execute(
+                    'INSERT INTO user (telegram_id, username, referral_code) VALUES (?, ?, ?) '
+                    'ON CONFLICT(telegram_id) DO NOTHING',
                     (telegram_id, username, referral_code)
                 )
-                await db.commit()
+                if cursor.rowcount != 1:
+                    await db.rollback()
+                    return True
 
                 await db.execute("""
                     INSERT INTO referral_progress (user_id, total_invites)
@@ -398,33 +1520,27 @@ class Database:
                 """, (telegram_id,))
                 await db.commit()
                 
-                async with db.execute(
-                    'SELECT reg_notify FROM bot_settings LIMIT 1'
-                ) as cursor:
-                    notify_settings = await cursor.fetchone()
+            if notify_settings and notify_settings[0] != 0 and bot:
                 
-                    
-                if notify_settings and notify_settings[0] != 0 and bot:
-                    
-                    message_text = (
-                        "🔔 Новая регистрация! 👤\n\n"
-                        "🚀 Пользователь успешно зарегистрирован!\n"
-                        "<blockquote>"
-                        f"📌 ID: {telegram_id}\n"
-                        f"👤 Username: {username or 'Не указан'}\n"
-                        f"📅 Дата: {current_date}\n"
-                        "</blockquote>"
+                message_text = (
+                    "🔔 Новая регистрация! 👤\n\n"
+                    "🚀 Пользователь успешно зарегистрирован!\n"
+                    "<blockquote>"
+                    f"📌 ID: {telegram_id}\n"
+                    f"👤 Username: {username or 'Не указан'}\n"
+                    f"📅 Дата: {current_date}\n"
+                    "</blockquote>"
+                )
+                
+                try:
+                    await bot.send_message(
+                        chat_id=notify_settings[0],
+                        text=message_text,
+                        parse_mode="HTML"
+                        #reply_markup=get_admin_keyboard()
                     )
-                    
-                    try:
-                        await bot.send_message(
-                            chat_id=notify_settings[0],
-                            text=message_text,
-                            parse_mode="HTML"
-                            #reply_markup=get_admin_keyboard()
-                        )
-                    except Exception as e:
-                        logger.error(f"Ошибка при отправке уведомления о регистрации: {e}")
+                except Exception as e:
+                    logger.error(f"Ошибка при отправке уведомления о регистрации: {e}")
             
             logger.info(f"Зарегистрирован новый пользователь: {telegram_id}")
             return True
@@ -435,7 +1551,7 @@ class Database:
 
     async def get_user(self, telegram_id: int) -> Optional[Dict]:
         """Получение информации о пользователе"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.acquire() as db:
             db.row_factory = aiosqlite.Row
             async with db.execute(
                 'SELECT * FROM user WHERE telegram_id = ?',
@@ -447,7 +1563,7 @@ class Database:
     async def get_active_trial_settings(self) -> Optional[Dict]:
         """Получение активных настроек пробного периода"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute('''
                     SELECT t.*, s.name as server_name 
@@ -465,7 +1581,7 @@ class Database:
     async def update_user_trial_status(self, telegram_id: int, used: bool = True) -> bool:
         """Обновление статуса использования пробного периода"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire(write=True) as db:
                 await db.execute(
                     'UPDATE user SET trial_period = ? WHERE telegram_id = ?',
                     (used, telegram_id)
@@ -487,7 +1603,7 @@ class Database:
     async def get_server_settings(self, server_id: int) -> Optional[Dict]:
         """Получение настроек сервера по ID"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute(
                     'SELECT * FROM server_settings WHERE id = ?',
@@ -499,17 +1615,13 @@ class Database:
             logger.error(f"Ошибка при получении настроек сервера {server_id}: {e}")
             return None
 
-    async def get_connection(self):
-        """Получение соединения с базой данных"""
-        return await aiosqlite.connect(self.db_path)
-
     async def get_active_tariffs(self, server_id: Optional[int] = None) -> List[Dict]:
         """
         Получение списка активных тарифов с возможностью фильтрации по серверу
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     
                     query = """
@@ -541,14 +1653,14 @@ class Database:
 
     async def get_yookassa_settings(self):
         """Получение настроек YooKassa"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.acquire() as db:
             async with db.execute("SELECT * FROM yookassa_settings LIMIT 1") as cursor:
                 settings = await cursor.fetchone()
                 return settings if settings else None
 
     async def update_yookassa_settings(self, name, shop_id, api_key, description, is_enable):
         """Обновление настроек YooKassa"""
-        async with await self.get_connection() as db:
+        async with self.acquire(write=True) as db:
             await db.execute('''
                 INSERT OR REPLACE INTO yookassa_settings (id, name, shop_id, api_key, description, is_enable)
                 VALUES (1, ?, ?, ?, ?, ?)
@@ -557,13 +1669,13 @@ class Database:
 
     async def enable_yookassa(self, enable: bool):
         """Включение/выключение YooKassa"""
-        async with await self.get_connection() as db:
+        async with self.acquire(write=True) as db:
             await db.execute("UPDATE yookassa_settings SET is_enable = ?", (int(enable),))
             await db.commit()
 
     async def get_pspayments_settings(self):
         """Получение настроек PSPayments"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.acquire() as db:
             async with db.execute("SELECT * FROM pspayments_settings WHERE is_enable = 1 LIMIT 1") as cursor:
                 settings = await cursor.fetchone()
                 return settings if settings else None
@@ -574,7 +1686,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute("""
                         INSERT INTO tariff_promo (name, description, left_day, server_id, is_enable)
                         VALUES (?, ?, ?, ?, 1)
@@ -590,7 +1702,7 @@ class Database:
     async def get_promo_tariffs(self) -> list:
         """Получение списка активных промо-тарифов"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 async with conn.execute("""
                     SELECT tp.*, ss.name as server_name
@@ -606,7 +1718,7 @@ class Database:
     async def delete_promo_tariff(self, tariff_id: int) -> bool:
         """Деактивация промо-тарифа"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire(write=True) as conn:
                 await conn.execute("""
                     UPDATE tariff_promo 
                     SET is_enable = 0 
@@ -621,7 +1733,7 @@ class Database:
     async def get_server_promo_inbound(self, server_id: int) -> int:
         """Получение promo inbound_id для сервера"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 async with conn.execute("""
                     SELECT inbound_id_promo 
                     FROM server_settings 
@@ -636,7 +1748,7 @@ class Database:
     async def set_reg_notify(self, chat_id: int) -> bool:
         """Установка ID чата для уведомлений о регистрации"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire(write=True) as conn:
                 await conn.execute("""
                     UPDATE bot_settings 
                     SET reg_notify = ?
@@ -650,7 +1762,7 @@ class Database:
     async def set_pay_notify(self, chat_id: int) -> bool:
         """Установка ID чата для уведомлений о платежах"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire(write=True) as conn:
                 await conn.execute("""
                     UPDATE bot_settings 
                     SET pay_notify = ?
@@ -664,7 +1776,7 @@ class Database:
     async def get_notify_settings(self) -> dict:
         """Получение настроек уведомлений"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 async with conn.execute("""
                     SELECT reg_notify, pay_notify 
@@ -679,7 +1791,7 @@ class Database:
     async def add_review(self, username: str, message: str) -> bool:
         """Добавление нового отзыва"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire(write=True) as conn:
                 await conn.execute("""
                     INSERT INTO Reviews (username, message)
                     VALUES (?, ?)
@@ -693,7 +1805,7 @@ class Database:
     async def get_reviews(self, limit: int = 10) -> list:
         """Получение последних отзывов"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 async with conn.execute("""
                     SELECT * FROM Reviews 
@@ -708,7 +1820,7 @@ class Database:
     async def get_support_info(self) -> Optional[Dict]:
         """Получение информации о поддержке"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute('SELECT * FROM support_info ORDER BY id DESC LIMIT 1') as cursor:
                     row = await cursor.fetchone()
@@ -720,7 +1832,7 @@ class Database:
     async def update_support_info(self, message: str, bot_version: str, support_url: str) -> bool:
         """Обновление информации о поддержке"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire(write=True) as db:
                 await db.execute('''
                     INSERT INTO support_info (message, bot_version, support_url)
                     VALUES (?, ?, ?)
@@ -734,7 +1846,7 @@ class Database:
     async def add_notify_setting(self, name: str, interval: int, type: str) -> bool:
         """Добавление новой настройки уведомлений"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire(write=True) as db:
                 await db.execute("""
                     UPDATE notify_settings 
                     SET is_enable = 0 
@@ -756,7 +1868,7 @@ class Database:
     async def get_notify_setting(self, setting_id: int) -> Optional[Dict]:
         """Получение настройки уведомлений по ID"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute(
                     'SELECT * FROM notify_settings WHERE id = ?',
@@ -771,7 +1883,7 @@ class Database:
     async def get_all_notify_settings(self) -> List[Dict]:
         """Получение всех настроек уведомлений"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute('SELECT * FROM notify_settings') as cursor:
                     rows = await cursor.fetchall()
@@ -783,7 +1895,7 @@ class Database:
     async def get_active_notify_settings(self) -> List[Dict]:
         """Получение активных настроек уведомлений"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute(
                     'SELECT * FROM notify_settings WHERE is_enable = 1'
@@ -799,7 +1911,7 @@ class Database:
                                   is_enable: bool = None) -> bool:
         """Обновление настройки уведомлений"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire(write=True) as db:
                 async with db.execute(
                     'SELECT * FROM notify_settings WHERE id = ?',
                     (setting_id,)
@@ -839,94 +1951,823 @@ class Database:
             logger.error(f"Ошибка при обновлении настройки уведомлений: {e}")
             return False
 
-    async def delete_notify_setting(self, setting_id: int) -> bool:
-        """Удаление настройки уведомлений"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute(
-                    'DELETE FROM notify_settings WHERE id = ?',
-                    (setting_id,)
-                )
-                await db.commit()
-                logger.info(f"Удалена настройка уведомлений ID: {setting_id}")
+    async def delete_notify_setting(self, setting_id: int) -> bool:
+        """Удаление настройки уведомлений"""
+        try:
+            async with self.acquire(write=True) as db:
+                await db.execute(
+                    'DELETE FROM notify_settings WHERE id = ?',
+                    (setting_id,)
+                )
+                await db.commit()
+                logger.info(f"Удалена настройка уведомлений ID: {setting_id}")
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка при удалении настройки уведомлений: {e}")
+            return False
+
+    async def enable_notify_setting(self, setting_id: int, enable: bool) -> bool:
+        """Включение/выключение настройки уведомлений"""
+        try:
+            async with self.acquire(write=True) as db:
+                await db.execute(
+                    'UPDATE notify_settings SET is_enable = ? WHERE id = ?',
+                    (enable, setting_id)
+                )
+                await db.commit()
+                status = "включена" if enable else "выключена"
+                logger.info(f"Настройка уведомлений ID: {setting_id} {status}")
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка при изменении статуса настройки уведомлений: {e}")
+            return False
+
+    async def update_notify_setting_by_name(self, name: str, is_enable: bool = None) -> bool:
+        """Обновление настройки уведомлений по имени"""
+        try:
+            async with self.acquire(write=True) as db:
+                async with db.execute(
+                    'SELECT id FROM notify_settings WHERE name = ? AND is_enable = 1',
+                    (name,)
+                ) as cursor:
+                    setting = await cursor.fetchone()
+                    if not setting:
+                        return False
+
+                if is_enable is not None:
+                    await db.execute(
+                        'UPDATE notify_settings SET is_enable = ? WHERE name = ?',
+                        (is_enable, name)
+                    )
+                    await db.commit()
+                    status = "включена" if is_enable else "выключена"
+                    logger.info(f"Настройка уведомлений '{name}' {status}")
+                    return True
+                return False
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении настройки уведомлений по имени: {e}")
+            return False
+
+    async def get_expiring_subscriptions(self) -> List[Dict]:
+        """Получение подписок, которые заканчиваются в течение 24 часов"""
+        try:
+            async with self.acquire() as db:
+                db.row_factory = aiosqlite.Row
+                
+                now = datetime.now(timezone.utc)
+                end_time = now + timedelta(hours=24)
+                
+                logger.debug(f"Проверка подписок между {now} и {end_time}")
+                
+                async with db.execute("""
+                    SELECT * FROM user_subscription 
+                    WHERE is_active = 1
+                    AND end_ts BETWEEN ? AND ?
+                """, (int(now.timestamp()), int(end_time.timestamp()))) as cursor:
+                    rows = await cursor.fetchall()
+                    subscriptions = [dict(row) for row in rows]
+                    logger.debug(f"Найдено подписок: {len(subscriptions)}")
+                    return subscriptions
+        except Exception as e:
+            logger.error(f"Ошибка при получении истекающих подписок: {e}")
+            return []
+
+    async def get_expired_subscriptions(self, before_ts: int, after: Optional[tuple] = None,
+                                        limit: int = 500) -> List[Dict]:
+        """
+        Активные подписки, закончившиеся до before_ts, вместе с настройками сервера.
+        inbound_id — inbound, на котором создан клиент подписки (для старых
+        подписок — текущий inbound сервера).
+        Диапазонное чтение по индексу (is_active, end_ts) в порядке (end_ts, id).
+
+        :param before_ts: Граница end_ts в секундах UTC
+        :param after: (end_ts, id) последней строки предыдущей страницы
+        :param limit: Размер страницы
+        """
+        last_ts, last_id = after if after else (-1, 0)
+        async with self.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            async with conn.execute("""
+                SELECT us.id, us.user_id, us.server_id, us.end_date, us.end_ts, us.vless,
+                       ss.id AS server_exists, ss.url, ss.port, ss.secret_path, ss.username,
+                       ss.password, COALESCE(us.inbound_id, ss.inbound_id) AS inbound_id, ss.protocol
+                FROM user_subscription us
+                LEFT JOIN server_settings ss ON ss.id = us.server_id
+                WHERE us.is_active = 1
+                AND us.end_ts < ?
+                AND us.end_ts >= ?
+                AND (us.end_ts > ? OR us.id > ?)
+                ORDER BY us.end_ts, us.id
+                LIMIT ?
+            """, (before_ts, last_ts, last_ts, last_id, limit)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def get_server_subscriptions_page(self, server_id: int, after_id: int = 0,
+                                            limit: int = 1000) -> List[Dict]:
+        """
+        Страница активных подписок сервера по возрастанию id
+        (индекс idx_user_subscription_server_active). inbound_id — inbound
+        клиента подписки, NULL для подписок, созданных до появления колонки
+        """
+        async with self.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            async with conn.execute("""
+                SELECT id, user_id, vless, end_ts, inbound_id
+                FROM user_subscription
+                WHERE server_id = ? AND is_active = 1 AND id > ?
+                ORDER BY id
+                LIMIT ?
+            """, (server_id, after_id, limit)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def has_active_subscription_link(self, server_id: int, link_pattern: str) -> bool:
+        """Есть ли активная подписка сервера со ссылкой, подходящей под LIKE-шаблон"""
+        async with self.acquire() as conn:
+            async with conn.execute("""
+                SELECT 1 FROM user_subscription
+                WHERE server_id = ? AND is_active = 1 AND vless LIKE ?
+                LIMIT 1
+            """, (server_id, link_pattern)) as cursor:
+                return await cursor.fetchone() is not None
+
+    async def deactivate_subscriptions(self, subscription_ids: List[int]) -> int:
+        """
+        Отключение подписок одной транзакцией
+
+        :return: Количество отключенных подписок
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                cursor = await conn.execute(
+                    f"UPDATE user_subscription SET is_active = 0 "
+                    f"WHERE is_active = 1 AND id IN ({','.join('?' * len(subscription_ids))})",
+                    subscription_ids
+                )
+                await conn.commit()
+                return cursor.rowcount
+
+        if not subscription_ids:
+            return 0
+        return await self.db_operation_with_retry(_operation)
+
+    async def record_traffic(self, counters: Dict[int, Tuple[int, int]], now: Optional[int] = None) -> int:
+        """
+        Запись расхода трафика по абсолютным счетчикам панели.
+
+        Приращение считается от счетчиков прошлого опроса (traffic_counters)
+        и добавляется в часовой интервал traffic_usage. Если счетчик панели
+        уменьшился (сброс трафика, пересоздание клиента), приращением считается
+        новое значение целиком.
+
+        :param counters: ID подписки -> (up, down) из clientStats панели
+        :return: Количество подписок с ненулевым приращением
+        """
+        now = int(now if now is not None else time.time())
+        bucket = now - now % TRAFFIC_HOUR
+        ids = list(counters)
+
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                previous = {}
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    async with conn.execute(
+                        f"SELECT subscription_id, up, down FROM traffic_counters "
+                        f"WHERE subscription_id IN ({','.join('?' * len(chunk))})",
+                        chunk
+                    ) as cursor:
+                        for sub_id, up, down in await cursor.fetchall():
+                            previous[sub_id] = (up, down)
+
+                usage = []
+                for sub_id, (up, down) in counters.items():
+                    prev_up, prev_down = previous.get(sub_id, (0, 0))
+                    delta_up = up - prev_up if up >= prev_up else up
+                    delta_down = down - prev_down if down >= prev_down else down
+                    if delta_up or delta_down:
+                        usage.append((sub_id, TRAFFIC_HOUR, bucket, delta_up, delta_down))
+
+                await conn.executemany("""
+                    INSERT INTO traffic_usage (subscription_id, period, bucket, up, down)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(subscription_id, period, bucket)
+                    DO UPDATE SET up = up + excluded.up, down = down + excluded.down
+                """, usage)
+                await conn.executemany("""
+                    INSERT INTO traffic_counters (subscription_id, up, down, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(subscription_id)
+                    DO UPDATE SET up = excluded.up, down = excluded.down, updated_at = excluded.updated_at
+                """, [(sub_id, up, down, now) for sub_id, (up, down) in counters.items()])
+                await conn.commit()
+                return len(usage)
+
+        if not counters:
+            return 0
+        return await self.db_operation_with_retry(_operation)
+
+    async def rollup_traffic(self, rollup_before: int, retention_before: Optional[int] = None) -> int:
+        """
+        Свертка часовых интервалов старше rollup_before в суточные
+        и удаление суточных интервалов старше retention_before
+
+        :return: Количество свернутых часовых строк
+        """
+        rollup_before -= rollup_before % TRAFFIC_DAY
+
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                await conn.execute("""
+                    INSERT INTO traffic_usage (subscription_id, period, bucket, up, down)
+                    SELECT subscription_id, ?, bucket - bucket % ?, SUM(up), SUM(down)
+                    FROM traffic_usage
+                    WHERE period = ? AND bucket < ?
+                    GROUP BY subscription_id, bucket - bucket % ?
+                    ON CONFLICT(subscription_id, period, bucket)
+                    DO UPDATE SET up = up + excluded.up, down = down + excluded.down
+                """, (TRAFFIC_DAY, TRAFFIC_DAY, TRAFFIC_HOUR, rollup_before, TRAFFIC_DAY))
+                cursor = await conn.execute(
+                    "DELETE FROM traffic_usage WHERE period = ? AND bucket < ?",
+                    (TRAFFIC_HOUR, rollup_before)
+                )
+                rolled_up = cursor.rowcount
+                if retention_before is not None:
+                    await conn.execute(
+                        "DELETE FROM traffic_usage WHERE period = ? AND bucket < ?",
+                        (TRAFFIC_DAY, retention_before)
+                    )
+                await conn.execute("""
+                    DELETE FROM traffic_counters WHERE subscription_id NOT IN (
+                        SELECT id FROM user_subscription WHERE is_active = 1
+                    )
+                """)
+                await conn.commit()
+                return rolled_up
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def get_traffic_usage(self, subscription_ids: List[int],
+                                since: Optional[int] = None) -> Dict[int, Dict[str, int]]:
+        """
+        Суммарный расход трафика подписок (с момента since, по умолчанию за все время)
+
+        :return: ID подписки -> {'up': байт, 'down': байт}
+        """
+        result = {sub_id: {'up': 0, 'down': 0} for sub_id in subscription_ids}
+        if not subscription_ids:
+            return result
+        async with self.acquire() as conn:
+            async with conn.execute(
+                f"SELECT subscription_id, SUM(up), SUM(down) FROM traffic_usage "
+                f"WHERE subscription_id IN ({','.join('?' * len(subscription_ids))}) AND bucket >= ? "
+                f"GROUP BY subscription_id",
+                (*subscription_ids, since or 0)
+            ) as cursor:
+                for sub_id, up, down in await cursor.fetchall():
+                    result[sub_id] = {'up': up or 0, 'down': down or 0}
+        return result
+
+    async def record_server_health(self, probes: List[Dict]):
+        """
+        Добавление результатов проверок серверов в почасовые итоги одной транзакцией
+
+        :param probes: Словари с server_id, checked_at, available, delay (мс) и status_code
+        """
+        rows = []
+        for probe in probes:
+            checked_at = int(probe['checked_at'])
+            delay = probe['delay'] if probe['available'] else None
+            rows.append((
+                probe['server_id'], checked_at - checked_at % TRAFFIC_HOUR,
+                0 if probe['available'] else 1, delay or 0, delay or 0,
+                checked_at, 1 if probe['available'] else 0, delay, probe['status_code']
+            ))
+
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                await conn.executemany("""
+                    INSERT INTO server_health
+                    (server_id, bucket, probes, failures, latency_sum, latency_max,
+                     last_at, last_ok, last_latency, last_status)
+                    VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(server_id, bucket) DO UPDATE SET
+                        probes = probes + 1,
+                        failures = failures + excluded.failures,
+                        latency_sum = latency_sum + excluded.latency_sum,
+                        latency_max = MAX(latency_max, excluded.latency_max),
+                        last_at = excluded.last_at,
+                        last_ok = excluded.last_ok,
+                        last_latency = excluded.last_latency,
+                        last_status = excluded.last_status
+                """, rows)
+                await conn.commit()
+
+        if rows:
+            await self.db_operation_with_retry(_operation)
+
+    async def get_server_health_summary(self, since: int) -> Dict[int, Dict]:
+        """
+        Доступность серверов с момента since и результат последней проверки
+
+        :return: ID сервера -> итоги проверок
+        """
+        async with self.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            # При единственном MAX() остальные колонки SQLite берет из строки с максимумом
+            async with conn.execute("""
+                SELECT server_id, SUM(probes) AS probes, SUM(failures) AS failures,
+                       SUM(latency_sum) AS latency_sum, MAX(last_at) AS checked_at,
+                       last_ok, last_latency, last_status
+                FROM server_health
+                WHERE bucket >= ?
+                GROUP BY server_id
+            """, (since - since % TRAFFIC_HOUR,)) as cursor:
+                rows = await cursor.fetchall()
+
+        result = {}
+        for row in rows:
+            successes = row['probes'] - row['failures']
+            result[row['server_id']] = {
+                'available': bool(row['last_ok']),
+                'delay': row['last_latency'],
+                'status_code': row['last_status'],
+                'checked_at': row['checked_at'],
+                'uptime': round(successes / row['probes'] * 100, 1) if row['probes'] else None,
+                'avg_ms': round(row['latency_sum'] / successes, 1) if successes else None,
+                'probes': row['probes']
+            }
+        return result
+
+    async def prune_server_health(self, before: int) -> int:
+        """Удаление почасовых итогов проверок старше before"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                cursor = await conn.execute("DELETE FROM server_health WHERE bucket < ?", (before,))
+                await conn.commit()
+                return cursor.rowcount
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def create_provisioning_job(self, payment_id: str, user_id: int, tariff_id: int,
+                                      price: float, provider: str = None,
+                                      crypto_invoice_id: str = None) -> Dict:
+        """
+        Подтверждение оплаты и постановка подписки в очередь одной транзакцией:
+        задание в provisioning_jobs, запись в payments и (для Crypto Pay) статус счета.
+        Для уже поставленного payment_id ничего не меняется.
+
+        :return: Задание (новое или существующее) и флаг created
+        """
+        async def _operation():
+            now = int(time.time())
+            async with self.acquire(write=True) as conn:
+                conn.row_factory = aiosqlite.Row
+                cursor = await conn.execute("""
+                    INSERT INTO provisioning_jobs
+                    (payment_id, user_id, tariff_id, provider, price, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(payment_id) DO NOTHING
+                """, (payment_id, user_id, tariff_id, provider, price, now, now))
+                created = cursor.rowcount == 1
+                if created:
+                    await conn.execute("""
+                        INSERT INTO payments (user_id, tariff_id, price, provider)
+                        VALUES (?, ?, ?, ?)
+                    """, (user_id, tariff_id, price, provider or 'default'))
+                    if crypto_invoice_id:
+                        await conn.execute(
+                            "UPDATE crypto_payments SET status = 'paid' WHERE invoice_id = ?",
+                            (crypto_invoice_id,)
+                        )
+                await conn.commit()
+                async with conn.execute(
+                    "SELECT * FROM provisioning_jobs WHERE payment_id = ?", (payment_id,)
+                ) as cursor:
+                    job = dict(await cursor.fetchone())
+                job['created'] = created
+                return job
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def get_provisioning_job(self, payment_id: str) -> Optional[Dict]:
+        """Задание очереди по ID платежа"""
+        async with self.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            async with conn.execute(
+                "SELECT * FROM provisioning_jobs WHERE payment_id = ?", (payment_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def claim_provisioning_job(self) -> Optional[Dict]:
+        """Захват одного готового к выполнению задания (pending -> processing)"""
+        async def _operation():
+            now = int(time.time())
+            async with self.acquire(write=True) as conn:
+                conn.row_factory = aiosqlite.Row
+                cursor = await conn.execute("""
+                    UPDATE provisioning_jobs
+                    SET status = 'processing', attempts = attempts + 1, updated_at = ?
+                    WHERE id = (
+                        SELECT id FROM provisioning_jobs
+                        WHERE status = 'pending' AND next_attempt_at <= ?
+                        ORDER BY next_attempt_at, id
+                        LIMIT 1
+                    )
+                    RETURNING *
+                """, (now, now))
+                row = await cursor.fetchone()
+                await conn.commit()
+                return dict(row) if row else None
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def finish_provisioning_job(self, job_id: int, status: str, subscription_id: int = None,
+                                      error: str = None, next_attempt_at: int = 0):
+        """
+        Итог попытки: done (подписка создана), pending (повтор в next_attempt_at)
+        или failed (попытки исчерпаны)
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                await conn.execute("""
+                    UPDATE provisioning_jobs
+                    SET status = ?, subscription_id = COALESCE(?, subscription_id), error = ?,
+                        next_attempt_at = ?, updated_at = ?
+                    WHERE id = ?
+                """, (status, subscription_id, error, next_attempt_at, int(time.time()), job_id))
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def requeue_stale_provisioning_jobs(self, stale_before: int) -> int:
+        """Возврат в очередь заданий, зависших в processing (процесс остановился во время выполнения)"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                cursor = await conn.execute("""
+                    UPDATE provisioning_jobs SET status = 'pending', next_attempt_at = 0
+                    WHERE status = 'processing' AND updated_at < ?
+                """, (stale_before,))
+                await conn.commit()
+                return cursor.rowcount
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def get_subscription_by_payment(self, payment_id: str) -> Optional[Dict]:
+        """
+        Подписка, созданная или продленная по платежу
+        (индексы idx_user_subscription_payment_id и уникальный payment_id subscription_renewals)
+        """
+        async with self.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            async with conn.execute("""
+                SELECT id, user_id, vless, end_date, 0 AS renewed FROM user_subscription WHERE payment_id = ?
+                UNION ALL
+                SELECT us.id, us.user_id, us.vless, us.end_date, 1 AS renewed
+                FROM subscription_renewals r
+                JOIN user_subscription us ON us.id = r.subscription_id
+                WHERE r.payment_id = ?
+                LIMIT 1
+            """, (payment_id, payment_id)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def count_pool_keys(self) -> Dict[Tuple[int, int], int]:
+        """Количество свободных ключей пула: (server_id, inbound_id) -> количество"""
+        async with self.acquire() as conn:
+            async with conn.execute("""
+                SELECT server_id, inbound_id, COUNT(*) FROM key_pool GROUP BY server_id, inbound_id
+            """) as cursor:
+                return {(server_id, inbound_id): count for server_id, inbound_id, count in await cursor.fetchall()}
+
+    async def add_pool_keys(self, keys: List[Dict]):
+        """Добавление ключей в пул одной транзакцией"""
+        async def _operation():
+            now = int(time.time())
+            async with self.acquire(write=True) as conn:
+                await conn.executemany("""
+                    INSERT INTO key_pool (server_id, inbound_id, client_id, email, link, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, [
+                    (key['server_id'], key['inbound_id'], key['client_id'], key['email'], key['link'],
+                     key.get('created_at') or now)
+                    for key in keys
+                ])
+                await conn.commit()
+
+        if keys:
+            await self.db_operation_with_retry(_operation)
+
+    async def take_pool_key(self, server_id: int, inbound_id: int) -> Optional[Dict]:
+        """Выдача самого старого свободного ключа сервера: строка удаляется из пула"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                conn.row_factory = aiosqlite.Row
+                cursor = await conn.execute("""
+                    DELETE FROM key_pool WHERE id = (
+                        SELECT id FROM key_pool WHERE server_id = ? AND inbound_id = ?
+                        ORDER BY id LIMIT 1
+                    )
+                    RETURNING *
+                """, (server_id, inbound_id))
+                row = await cursor.fetchone()
+                await conn.commit()
+                return dict(row) if row else None
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def delete_pool_keys(self, server_id: int, keep_inbound_id: Optional[int] = None) -> List[Dict]:
+        """
+        Удаление ключей пула сервера (кроме ключей inbound keep_inbound_id)
+
+        :return: Удаленные ключи, чтобы убрать их клиентов из панели
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                conn.row_factory = aiosqlite.Row
+                cursor = await conn.execute("""
+                    DELETE FROM key_pool WHERE server_id = ? AND inbound_id != ?
+                    RETURNING *
+                """, (server_id, keep_inbound_id if keep_inbound_id is not None else -1))
+                rows = [dict(row) for row in await cursor.fetchall()]
+                await conn.commit()
+                return rows
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def create_server_evacuation(self, source_server_id: int, target_server_ids: Optional[List[int]] = None,
+                                       delete_source: bool = False) -> Optional[Dict]:
+        """
+        Постановка переноса подписок с сервера. В той же транзакции сервер и
+        его тарифы отключаются, чтобы новые подписки на нем не появлялись.
+        Если перенос с сервера уже идет, возвращается он.
+
+        :return: Задание переноса с флагом created или None, если сервера нет
+        """
+        async def _operation():
+            now = int(time.time())
+            async with self.acquire(write=True) as conn:
+                conn.row_factory = aiosqlite.Row
+                async with conn.execute(
+                    "SELECT id FROM server_settings WHERE id = ?", (source_server_id,)
+                ) as cursor:
+                    if not await cursor.fetchone():
+                        return None
+
+                cursor = await conn.execute("""
+                    INSERT INTO server_evacuations
+                    (source_server_id, target_server_ids, delete_source, total, created_at, updated_at)
+                    SELECT ?, ?, ?, COUNT(*), ?, ?
+                    FROM user_subscription WHERE server_id = ? AND is_active = 1
+                    ON CONFLICT DO NOTHING
+                """, (
+                    source_server_id,
+                    ','.join(str(server_id) for server_id in target_server_ids) if target_server_ids else None,
+                    int(delete_source), now, now, source_server_id
+                ))
+                created = cursor.rowcount == 1
+                if created:
+                    await conn.execute("UPDATE server_settings SET is_enable = 0 WHERE id = ?", (source_server_id,))
+                    await conn.execute("UPDATE tariff SET is_enable = 0 WHERE server_id = ?", (source_server_id,))
+                await conn.commit()
+
+                async with conn.execute("""
+                    SELECT * FROM server_evacuations
+                    WHERE source_server_id = ? ORDER BY id DESC LIMIT 1
+                """, (source_server_id,)) as cursor:
+                    job = dict(await cursor.fetchone())
+                job['created'] = created
+                return job
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def get_server_evacuation(self, job_id: int) -> Optional[Dict]:
+        """Задание переноса по ID"""
+        async with self.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            async with conn.execute("SELECT * FROM server_evacuations WHERE id = ?", (job_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def get_server_evacuations(self, source_server_id: Optional[int] = None, limit: int = 20) -> List[Dict]:
+        """Последние переносы (всех серверов или одного сервера-источника)"""
+        async with self.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            if source_server_id is None:
+                query, params = "SELECT * FROM server_evacuations ORDER BY id DESC LIMIT ?", (limit,)
+            else:
+                query, params = ("SELECT * FROM server_evacuations WHERE source_server_id = ? ORDER BY id DESC LIMIT ?",
+                                 (source_server_id, limit))
+            async with conn.execute(query, params) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def claim_server_evacuation(self) -> Optional[Dict]:
+        """
+        Следующий перенос для выполнения (pending -> running). Задания в
+        running тоже возвращаются: переносы выполняет один процесс, и такое
+        задание прервано его перезапуском
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                conn.row_factory = aiosqlite.Row
+                cursor = await conn.execute("""
+                    UPDATE server_evacuations SET status = 'running', updated_at = ?
+                    WHERE id = (
+                        SELECT id FROM server_evacuations
+                        WHERE status IN ('pending', 'running')
+                        ORDER BY status = 'pending', id
+                        LIMIT 1
+                    )
+                    RETURNING *
+                """, (int(time.time()),))
+                row = await cursor.fetchone()
+                await conn.commit()
+                return dict(row) if row else None
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def update_server_evacuation(self, job_id: int, after_id: int, moved: int = 0, failed: int = 0,
+                                       old_deleted: int = 0, notified: int = 0):
+        """Сохранение прогресса переноса: позиция и приращения счетчиков"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                await conn.execute("""
+                    UPDATE server_evacuations
+                    SET after_id = MAX(after_id, ?), moved = moved + ?, failed = failed + ?,
+                        old_deleted = old_deleted + ?, notified = notified + ?, updated_at = ?
+                    WHERE id = ?
+                """, (after_id, moved, failed, old_deleted, notified, int(time.time()), job_id))
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def finish_server_evacuation(self, job_id: int, status: str, error: str = None):
+        """Завершение переноса: done, failed или cancelled"""
+        async def _operation():
+            now = int(time.time())
+            async with self.acquire(write=True) as conn:
+                await conn.execute("""
+                    UPDATE server_evacuations SET status = ?, error = ?, updated_at = ?, finished_at = ?
+                    WHERE id = ?
+                """, (status, error, now, now, job_id))
+                await conn.commit()
+
+        await self.db_operation_with_retry(_operation)
+
+    async def move_subscriptions(self, moves: List[Dict]) -> List[int]:
+        """
+        Перенос подписок на другие серверы одной транзакцией: у строки
+        меняются server_id и ссылка, ID и дата окончания сохраняются.
+        Подписка переносится, только если она все еще активна на прежнем сервере.
+
+        :param moves: Словари с id, old_server_id, server_id, inbound_id и vless
+        :return: ID перенесенных подписок
+        """
+        async def _operation():
+            moved = []
+            async with self.acquire(write=True) as conn:
+                for move in moves:
+                    cursor = await conn.execute("""
+                        UPDATE user_subscription SET server_id = ?, inbound_id = ?, vless = ?
+                        WHERE id = ? AND server_id = ? AND is_active = 1
+                    """, (move['server_id'], move.get('inbound_id'), move['vless'], move['id'], move['old_server_id']))
+                    if cursor.rowcount == 1:
+                        moved.append(move['id'])
+                await conn.commit()
+            return moved
+
+        if not moves:
+            return []
+        return await self.db_operation_with_retry(_operation)
+
+    async def get_renewable_subscription(self, user_id: int, tariff_id: int,
+                                         expired_within: float = 0) -> Optional[Dict]:
+        """
+        Подписка пользователя, которую можно продлить при покупке тарифа:
+        активная, с тем же тарифом, на включенном сервере, не истекшая или
+        истекшая не раньше expired_within секунд назад.
+        Из нескольких выбирается заканчивающаяся раньше всех.
+        """
+        async with self.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            async with conn.execute("""
+                SELECT us.id FROM user_subscription us
+                JOIN server_settings s ON s.id = us.server_id
+                WHERE us.user_id = ? AND us.is_active = 1 AND us.tariff_id = ?
+                AND us.end_ts > ?
+                AND s.is_enable = 1
+                ORDER BY us.end_ts
+                LIMIT 1
+            """, (user_id, tariff_id, int(time.time() - expired_within))) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def get_subscription_with_server(self, subscription_id: int) -> Optional[Dict]:
+        """
+        Подписка вместе с настройками панели ее сервера. inbound_id — inbound,
+        на котором создан клиент подписки (для старых подписок — текущий inbound сервера)
+        """
+        async with self.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            async with conn.execute("""
+                SELECT us.id, us.user_id, us.tariff_id, us.server_id, us.end_date, us.end_ts,
+                       us.vless, us.is_active, us.payment_id,
+                       s.url, s.port, s.secret_path, s.username, s.password,
+                       COALESCE(us.inbound_id, s.inbound_id) AS inbound_id,
+                       s.protocol, s.is_enable AS server_enabled
+                FROM user_subscription us
+                JOIN server_settings s ON s.id = us.server_id
+                WHERE us.id = ?
+            """, (subscription_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def extend_subscription(self, subscription_id: int, server_id: int, end_date: datetime,
+                                  days: int, payment_id: str = None, tariff_id: int = None) -> bool:
+        """
+        Новая дата окончания подписки и запись о продлении одной транзакцией.
+        Строка меняется, только если подписка все еще активна на том же сервере
+        (не отключена и не перенесена, пока продлевался клиент в панели).
+        Платеж продления записывается в subscription_renewals, чтобы повтор
+        по тому же платежу находил эту подписку (get_subscription_by_payment).
+        Продление с tariff_id считается покупкой тарифа в статистике.
+
+        :return: True, если подписка продлена
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                cursor = await conn.execute("""
+                    UPDATE user_subscription SET end_date = ?
+                    WHERE id = ? AND server_id = ? AND is_active = 1
+                """, (end_date, subscription_id, server_id))
+                if cursor.rowcount != 1:
+                    await conn.rollback()
+                    return False
+                await conn.execute("""
+                    INSERT INTO subscription_renewals
+                        (subscription_id, server_id, tariff_id, payment_id, days, end_date, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(payment_id) DO NOTHING
+                """, (subscription_id, server_id, tariff_id, payment_id, days, end_date, int(time.time())))
+                await conn.commit()
                 return True
-        except Exception as e:
-            logger.error(f"Ошибка при удалении настройки уведомлений: {e}")
-            return False
 
-    async def enable_notify_setting(self, setting_id: int, enable: bool) -> bool:
-        """Включение/выключение настройки уведомлений"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute(
-                    'UPDATE notify_settings SET is_enable = ? WHERE id = ?',
-                    (enable, setting_id)
-                )
-                await db.commit()
-                status = "включена" if enable else "выключена"
-                logger.info(f"Настройка уведомлений ID: {setting_id} {status}")
-                return True
-        except Exception as e:
-            logger.error(f"Ошибка при изменении статуса настройки уведомлений: {e}")
-            return False
+        return await self.db_operation_with_retry(_operation)
 
-    async def update_notify_setting_by_name(self, name: str, is_enable: bool = None) -> bool:
-        """Обновление настройки уведомлений по имени"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute(
-                    'SELECT id FROM notify_settings WHERE name = ? AND is_enable = 1',
-                    (name,)
+    async def get_subscription_token(self, user_id: int) -> str:
+        """Токен ссылки на подписку пользователя; создается при первом обращении"""
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                await conn.execute("""
+                    INSERT OR IGNORE INTO subscription_tokens (user_id, token, created_at) VALUES (?, ?, ?)
+                """, (user_id, secrets.token_urlsafe(SUBSCRIPTION_TOKEN_BYTES), int(time.time())))
+                await conn.commit()
+                async with conn.execute(
+                    "SELECT token FROM subscription_tokens WHERE user_id = ?", (user_id,)
                 ) as cursor:
-                    setting = await cursor.fetchone()
-                    if not setting:
-                        return False
+                    return (await cursor.fetchone())[0]
 
-                if is_enable is not None:
-                    await db.execute(
-                        'UPDATE notify_settings SET is_enable = ? WHERE name = ?',
-                        (is_enable, name)
-                    )
-                    await db.commit()
-                    status = "включена" if is_enable else "выключена"
-                    logger.info(f"Настройка уведомлений '{name}' {status}")
-                    return True
-                return False
-        except Exception as e:
-            logger.error(f"Ошибка при обновлении настройки уведомлений по имени: {e}")
-            return False
+        return await self.db_operation_with_retry(_operation)
 
-    async def get_expiring_subscriptions(self) -> List[Dict]:
-        """Получение подписок, которые заканчиваются в течение 24 часов"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                
-                now = datetime.now(timezone.utc)
-                end_time = now + timedelta(hours=24)
-                
-                now_str = now.strftime('%Y-%m-%d %H:%M:%S.%f')
-                end_time_str = end_time.strftime('%Y-%m-%d %H:%M:%S.%f')
-                
-                logger.debug(f"Проверка подписок между {now_str} и {end_time_str}")
-                
-                async with db.execute("""
-                    SELECT * FROM user_subscription 
-                    WHERE datetime(end_date) BETWEEN datetime(?) AND datetime(?)
-                    AND is_active = 1
-                """, (now_str, end_time_str)) as cursor:
-                    rows = await cursor.fetchall()
-                    subscriptions = [dict(row) for row in rows]
-                    logger.debug(f"Найдено подписок: {len(subscriptions)}")
-                    return subscriptions
-        except Exception as e:
-            logger.error(f"Ошибка при получении истекающих подписок: {e}")
-            return []
+    async def reset_subscription_token(self, user_id: int) -> str:
+        """Новый токен ссылки на подписку: старая ссылка перестает работать"""
+        async def _operation():
+            token = secrets.token_urlsafe(SUBSCRIPTION_TOKEN_BYTES)
+            async with self.acquire(write=True) as conn:
+                await conn.execute("""
+                    INSERT INTO subscription_tokens (user_id, token, created_at) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        token = excluded.token, version = version + 1, created_at = excluded.created_at
+                """, (user_id, token, int(time.time())))
+                await conn.commit()
+            return token
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def get_subscription_token_version(self, token: str) -> Optional[Tuple[int, int]]:
+        """Пользователь и версия подписок по токену (поиск по уникальному индексу)"""
+        async with self.acquire() as conn:
+            async with conn.execute(
+                "SELECT user_id, version FROM subscription_tokens WHERE token = ?", (token,)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return (row[0], row[1]) if row else None
+
+    async def get_active_subscription_links(self, user_id: int) -> List[Dict]:
+        """Ключи активных подписок пользователя, новые первыми (индекс idx_user_subscription_user_active)"""
+        async with self.acquire() as conn:
+            conn.row_factory = aiosqlite.Row
+            async with conn.execute("""
+                SELECT id, vless, end_ts FROM user_subscription
+                WHERE user_id = ? AND is_active = 1
+                ORDER BY end_date DESC
+            """, (user_id,)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
 
     async def get_tariff(self, tariff_id: int) -> Optional[Dict]:
         """Получение информации о тарифе"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute(
                     'SELECT * FROM tariff WHERE id = ?',
@@ -941,7 +2782,7 @@ class Database:
     async def get_server(self, server_id: int) -> Optional[Dict]:
         """Получение информации о сервере"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute(
                     'SELECT * FROM server_settings WHERE id = ?',
@@ -956,7 +2797,7 @@ class Database:
     async def add_payment_code(self, pay_code: str, sum: float) -> bool:
         """Добавление нового кода оплаты"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire(write=True) as db:
                 await db.execute("""
                     INSERT INTO payments_code (pay_code, sum)
                     VALUES (?, ?)
@@ -971,7 +2812,7 @@ class Database:
     async def get_payment_code(self, pay_code: str) -> Optional[Dict]:
         """Получение информации о коде оплаты"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute(
                     'SELECT * FROM payments_code WHERE pay_code = ? AND is_enable = 1',
@@ -986,7 +2827,7 @@ class Database:
     async def disable_payment_code(self, pay_code: str) -> bool:
         """Деактивация кода оплаты"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire(write=True) as db:
                 await db.execute(
                     'UPDATE payments_code SET is_enable = 0 WHERE pay_code = ?',
                     (pay_code,)
@@ -1001,7 +2842,7 @@ class Database:
     async def get_all_payment_codes(self) -> List[Dict]:
         """Получение списка всех кодов оплаты"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute('SELECT * FROM payments_code') as cursor:
                     rows = await cursor.fetchall()
@@ -1013,7 +2854,7 @@ class Database:
     async def enable_payment_code(self, pay_code: str) -> bool:
         """Активация кода оплаты"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire(write=True) as db:
                 await db.execute(
                     'UPDATE payments_code SET is_enable = 1 WHERE pay_code = ?',
                     (pay_code,)
@@ -1028,7 +2869,7 @@ class Database:
     async def get_active_codes_sum(self) -> float:
         """Получение суммы всех активных кодов оплаты"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 async with db.execute(
                     'SELECT SUM(sum) FROM payments_code WHERE is_enable = 1'
                 ) as cursor:
@@ -1041,7 +2882,7 @@ class Database:
     async def get_used_codes_sum(self) -> float:
         """Получение суммы всех использованных кодов оплаты"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 async with db.execute(
                     'SELECT SUM(sum) FROM payments_code WHERE is_enable = 0'
                 ) as cursor:
@@ -1053,39 +2894,48 @@ class Database:
 
     async def is_yookassa_enabled(self) -> bool:
         """Проверка активности Юкассы"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
+        async def _operation():
+            async with self.acquire() as db:
                 async with db.execute(
                     'SELECT is_enable FROM yookassa_settings WHERE is_enable = 1 LIMIT 1'
                 ) as cursor:
                     result = await cursor.fetchone()
                     return bool(result[0]) if result else False
+
+        try:
+            return await self.settings.get('yookassa_enabled', _operation)
         except Exception as e:
             logger.error(f"Ошибка при проверке статуса Юкассы: {e}")
             return False
 
     async def is_pspayments_enabled(self) -> bool:
         """Проверка активности PSPayments"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
+        async def _operation():
+            async with self.acquire() as db:
                 async with db.execute(
                     'SELECT is_enable FROM pspayments_settings WHERE is_enable = 1 LIMIT 1'
                 ) as cursor:
                     result = await cursor.fetchone()
                     return bool(result[0]) if result else False
+
+        try:
+            return await self.settings.get('pspayments_enabled', _operation)
         except Exception as e:
             logger.error(f"Ошибка при проверке статуса PsPayments: {e}")
             return False
 
     async def is_crypto_enabled(self) -> bool:
         """Проверка активности Crypto Pay"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
+        async def _operation():
+            async with self.acquire() as db:
                 async with db.execute(
                     'SELECT is_enable FROM crypto_settings WHERE is_enable = 1 LIMIT 1'
                 ) as cursor:
                     result = await cursor.fetchone()
                     return bool(result[0]) if result else False
+
+        try:
+            return await self.settings.get('crypto_enabled', _operation)
         except Exception as e:
             logger.error(f"Ошибка при проверке статуса Crypto Pay: {e}")
             return False        
@@ -1096,7 +2946,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
                         SELECT api_token, is_enable, min_amount, supported_assets, webhook_url, webhook_secret
@@ -1120,7 +2970,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     
                     await conn.execute("""
                         UPDATE crypto_settings 
@@ -1148,7 +2998,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     if is_enable:
                         await conn.execute("""
                             UPDATE crypto_settings 
@@ -1179,7 +3029,7 @@ class Database:
     async def execute_fetchone(self, query: str, params: tuple = ()) -> Optional[Dict]:
         """Выполнение запроса с получением одной строки"""
         async def _execute_query():
-            async with aiosqlite.connect(self.db_path, timeout=20.0) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute(query, params) as cursor:
                     result = await cursor.fetchone()
@@ -1194,7 +3044,7 @@ class Database:
     async def create_raffle(self, name: str, description: str) -> bool:
         """Создание нового розыгрыша"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire(write=True) as db:
                 await db.execute("""
                     INSERT INTO raffles (name, description, status)
                     VALUES (?, ?, 'active')
@@ -1208,7 +3058,7 @@ class Database:
     async def add_raffle_tickets(self, user_id: int, telegram_id: int, tickets_count: int, raffle_id: int) -> bool:
         """Добавление билетов пользователю"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire(write=True) as conn:
                 for _ in range(tickets_count):
                     ticket_number = f"T{random.randint(100000, 999999)}"
                     await conn.execute("""
@@ -1225,7 +3075,7 @@ class Database:
     async def get_user_tickets(self, telegram_id: int, raffle_id: int = None) -> List[Dict]:
         """Получение билетов пользователя"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 query = """
                     SELECT rt.*, r.name as raffle_name, u.username 
@@ -1250,7 +3100,7 @@ class Database:
     async def get_active_raffles(self) -> List[Dict]:
         """Получение активных розыгрышей"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 cursor = await conn.execute("""
                     SELECT * FROM raffles 
@@ -1266,7 +3116,7 @@ class Database:
     async def get_raffle_participants(self, raffle_id: int) -> List[Dict]:
         """Получение участников розыгрыша с их билетами"""
         try:
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 cursor = await conn.execute("""
                     SELECT 
@@ -1289,7 +3139,7 @@ class Database:
     async def deactivate_raffle(self) -> bool:
         """Деактивация текущего активного розыгрыша"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire(write=True) as db:
                 await db.execute("""
                     UPDATE raffles 
                     SET status = 'inactive', 
@@ -1305,7 +3155,7 @@ class Database:
     async def delete_all_raffle_tickets(self) -> bool:
         """Удаление всех билетов розыгрыша"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire(write=True) as db:
                 await db.execute("DELETE FROM raffle_tickets")
                 await db.commit()
                 return True
@@ -1316,7 +3166,7 @@ class Database:
     async def get_tickets_report(self) -> List[Dict]:
         """Получение данных о билетах для отчета"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute("""
                     SELECT 
@@ -1338,7 +3188,7 @@ class Database:
     async def get_user_balance(self, user_id: int) -> float:
         """Получение баланса пользователя с повторными попытками"""
         async def _operation():
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 async with conn.execute(
                     "SELECT balance FROM user_balance WHERE user_id = ?",
                     (user_id,)
@@ -1349,62 +3199,141 @@ class Database:
         return await self.db_operation_with_retry(_operation)
 
     async def update_balance(self, user_id: int, amount: float, type: str, description: str = None, payment_id: str = None) -> bool:
-        """Обновление баланса пользователя с повторными попытками"""
+        """
+        Изменение баланса пользователя на amount без проверки остатка.
+        Для списаний используйте conditional_debit.
+        """
+        return await self.credit(user_id, amount, type, description, payment_id) is not None
+
+    async def credit(self, user_id: int, amount: float, type: str, description: str = None,
+                     payment_id: str = None) -> Optional[float]:
+        """
+        Зачисление на баланс одной транзакцией (UPSERT + запись в историю)
+
+        :return: Новый баланс или None при ошибке
+        """
         async def _operation():
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire(write=True) as conn:
                 try:
-                    async with conn.execute(
-                        "SELECT balance FROM user_balance WHERE user_id = ?",
-                        (user_id,)
-                    ) as cursor:
-                        current_balance = await cursor.fetchone()
+                    async with conn.execute(BALANCE_CREDIT_SQL, (user_id, amount)) as cursor:
+                        row = await cursor.fetchone()
+                    await conn.execute(BALANCE_TRANSACTION_SQL, (user_id, amount, type, description, payment_id))
+                    await conn.commit()
+                    return float(row[0])
+                except Exception as e:
+                    logger.error(f"Ошибка при зачислении на баланс пользователя {user_id}: {e}")
+                    return None
 
-                    if current_balance:
-                        await conn.execute(
-                            """
-                            UPDATE user_balance 
-                            SET balance = balance + ?, last_update = CURRENT_TIMESTAMP 
-                            WHERE user_id = ?
-                            """,
-                            (amount, user_id)
-                        )
-                    else:
-                        await conn.execute(
-                            "INSERT INTO user_balance (user_id, balance) VALUES (?, ?)",
-                            (user_id, amount)
-                        )
+        return await self.db_operation_with_retry(_operation)
 
-                    await conn.execute(
-                        """
-                        INSERT INTO balance_transactions 
-                        (user_id, amount, type, description, payment_id) 
-                        VALUES (?, ?, ?, ?, ?)
-                        """,
-                        (user_id, amount, type, description, payment_id)
-                    )
+    async def conditional_debit(self, user_id: int, amount: float, type: str, description: str = None,
+                                payment_id: str = None) -> Optional[float]:
+        """
+        Списание с баланса, только если на нем не меньше amount.
+        Проверка и списание выполняются одним UPDATE, без окна для гонки.
+
+        :return: Новый баланс или None, если средств недостаточно
+        :raises ValueError: amount не положительный
+        Ошибки базы не перехватываются: сбой не выглядит как нехватка средств
+        """
+        if amount <= 0:
+            raise ValueError(f"Сумма списания должна быть положительной: {amount}")
+
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                async with conn.execute(BALANCE_DEBIT_SQL, (amount, user_id, amount)) as cursor:
+                    row = await cursor.fetchone()
+                if not row:
+                    await conn.rollback()
+                    return None
+                await conn.execute(BALANCE_TRANSACTION_SQL, (user_id, -amount, type, description, payment_id))
+                await conn.commit()
+                return float(row[0])
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def transfer(self, from_user_id: int, to_user_id: int, amount: float) -> Optional[float]:
+        """
+        Перевод между балансами пользователей одной транзакцией
+
+        :return: Новый баланс отправителя или None, если средств недостаточно
+        :raises ValueError: amount не положительный
+        Ошибки базы не перехватываются: сбой не выглядит как нехватка средств
+        """
+        if amount <= 0:
+            raise ValueError(f"Сумма перевода должна быть положительной: {amount}")
+
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                async with conn.execute(BALANCE_DEBIT_SQL, (amount, from_user_id, amount)) as cursor:
+                    row = await cursor.fetchone()
+                if not row:
+                    await conn.rollback()
+                    return None
+                await conn.execute(BALANCE_CREDIT_SQL, (to_user_id, amount))
+                await conn.executemany(BALANCE_TRANSACTION_SQL, (
+                    (from_user_id, -amount, 'transfer_out', f"Перевод пользователю {to_user_id}", None),
+                    (to_user_id, amount, 'transfer_in', f"Перевод от пользователя {from_user_id}", None),
+                ))
+                await conn.commit()
+                return float(row[0])
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def credit_many(self, credits: List[Dict]) -> bool:
+        """
+        Зачисление на балансы нескольких пользователей одной транзакцией
+        (реферальные награды, возвраты)
+
+        :param credits: Список словарей с ключами user_id, amount, type
+                        и необязательными description, payment_id
+        :return: True, если зачислены все суммы; при ошибке не зачисляется ничего
+        """
+        if not credits:
+            return True
 
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                try:
+                    await conn.executemany(
+                        BALANCE_CREDIT_SQL.replace(" RETURNING balance", ""),
+                        [(c['user_id'], c['amount']) for c in credits]
+                    )
+                    await conn.executemany(BALANCE_TRANSACTION_SQL, [
+                        (c['user_id'], c['amount'], c['type'], c.get('description'), c.get('payment_id'))
+                        for c in credits
+                    ])
                     await conn.commit()
                     return True
                 except Exception as e:
-                    logger.error(f"Ошибка при обновлении баланса: {e}")
+                    logger.error(f"Ошибка при пакетном зачислении на балансы: {e}")
                     return False
 
         return await self.db_operation_with_retry(_operation)
 
-    async def get_balance_transactions(self, user_id: int, limit: int = None) -> List[Dict]:
-        """Получение транзакций пользователя с повторными попытками"""
+    async def get_balance_transactions(self, user_id: int, limit: int = None, after: Optional[str] = None) -> List[Dict]:
+        """
+        Получение транзакций пользователя с повторными попытками
+
+        :param limit: Сколько записей вернуть
+        :param after: Курсор следующей страницы (id последней полученной записи)
+        """
+        after_id = decode_cursor(after)
+
         async def _operation():
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
-                query = """
-                    SELECT * FROM balance_transactions 
-                    WHERE user_id = ? 
-                    ORDER BY created_at DESC
-                """
+                query = "SELECT * FROM balance_transactions WHERE user_id = ?"
+                params = [user_id]
+                if after_id is not None:
+                    query += " AND id < ?"
+                    params.append(after_id)
+                query += " ORDER BY id DESC"
                 if limit:
-                    query += f" LIMIT {limit}"
+                    query += " LIMIT ?"
+                    params.append(limit)
                 
-                async with conn.execute(query, (user_id,)) as cursor:
+                async with conn.execute(query, params) as cursor:
                     return [dict(row) for row in await cursor.fetchall()]
 
         return await self.db_operation_with_retry(_operation)
@@ -1426,7 +3355,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     
                     query = """
@@ -1458,7 +3387,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute("""
                         INSERT INTO referral_condition 
                         (name, description, invitations, reward_sum, is_enable)
@@ -1483,7 +3412,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute("""
                         SELECT 1 FROM referral_condition WHERE id = ?
                     """, (condition_id,))
@@ -1510,7 +3439,7 @@ class Database:
     async def get_user_referral_progress(self, user_id: int) -> Dict:
         """Получение прогресса реферальной программы пользователя"""
         async def _operation():
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 cursor = await conn.execute("""
                     SELECT rp.*, u.referral_count 
@@ -1526,7 +3455,7 @@ class Database:
     async def create_referral_progress(self, user_id: int) -> bool:
         """Создание записи прогресса реферальной программы"""
         async def _operation():
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire(write=True) as conn:
                 await conn.execute("""
                     INSERT INTO referral_progress (user_id, total_invites)
                     VALUES (?, 0)
@@ -1539,7 +3468,7 @@ class Database:
     async def update_referral_progress(self, user_id: int, total_invites: int) -> bool:
         """Обновление прогресса реферальной программы"""
         async def _operation():
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire(write=True) as conn:
                 await conn.execute("""
                     UPDATE referral_progress 
                     SET total_invites = ?, 
@@ -1554,7 +3483,7 @@ class Database:
     async def check_referral_reward(self, user_id: int) -> Optional[float]:
         """Проверка и начисление реферальной награды"""
         async def _operation():
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire(write=True) as conn:
                 conn.row_factory = aiosqlite.Row
                 
                 cursor = await conn.execute("""
@@ -1605,7 +3534,7 @@ class Database:
     async def get_user_by_referral_code(self, referral_code: str) -> Dict:
         """Получение пользователя по реферальному коду"""
         async def _operation():
-            async with aiosqlite.connect(self.db_path) as conn:
+            async with self.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 cursor = await conn.execute("""
                     SELECT * FROM user WHERE referral_code = ?
@@ -1620,38 +3549,62 @@ class Database:
         Получение списка всех пользователей
         """
         try:
-            conn = await self.get_connection()
-            cursor = await conn.cursor()
-            await cursor.execute("SELECT * FROM user")
-            users = await cursor.fetchall()
-            
-            columns = [col[0] for col in cursor.description]
-            result = []
-            for user in users:
-                user_dict = dict(zip(columns, user))
-                result.append(user_dict)
-            
-            await cursor.close()
-            await conn.close()
-            return result
+            async with self.acquire() as conn:
+                cursor = await conn.cursor()
+                await cursor.execute("SELECT * FROM user")
+                users = await cursor.fetchall()
+                
+                columns = [col[0] for col in cursor.description]
+                result = []
+                for user in users:
+                    user_dict = dict(zip(columns, user))
+                    result.append(user_dict)
+                
+                await cursor.close()
+                return result
         except Exception as e:
             logger.error(f"Ошибка при получении всех пользователей: {e}")
             return []
 
+    async def get_users_page(self, limit: int = DEFAULT_PAGE_LIMIT, after: Optional[str] = None, skip: int = 0) -> List[Dict]:
+        """
+        Получение страницы пользователей в порядке регистрации
+
+        :param limit: Сколько записей вернуть
+        :param after: Курсор следующей страницы (id последнего полученного пользователя)
+        :param skip: Смещение для старых клиентов, используется только без курсора
+        """
+        after_id = decode_cursor(after)
+
+        async def _operation():
+            async with self.acquire() as conn:
+                conn.row_factory = aiosqlite.Row
+                if after_id is not None:
+                    query, params = "SELECT * FROM user WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+                else:
+                    query, params = "SELECT * FROM user ORDER BY id LIMIT ? OFFSET ?", (limit, skip)
+                async with conn.execute(query, params) as cursor:
+                    return [dict(row) for row in await cursor.fetchall()]
+
+        return await self.db_operation_with_retry(_operation)
+
     async def add_server(self, name: str, url: str, port: str, secret_path: str, 
                         username: str, password: str, inbound_id: int, 
-                        protocol: str, ip: str) -> bool:
+                        protocol: str, ip: str, region: str = None,
+                        capacity: int = 0, weight: float = 1.0) -> bool:
         """
         Добавление нового сервера
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute("""
                         INSERT INTO server_settings 
-                        (name, url, port, secret_path, username, password, inbound_id, protocol, ip, is_enable)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
-                    """, (name, url, port, secret_path, username, password, inbound_id, protocol, ip))
+                        (name, url, port, secret_path, username, password, inbound_id, protocol, ip, is_enable,
+                         region, capacity, weight)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?, ?)
+                    """, (name, url, port, secret_path, username, password, inbound_id, protocol, ip,
+                          region, capacity, weight))
                     await conn.commit()
                     return True
             except Exception as e:
@@ -1666,7 +3619,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     if include_server_name:
                         async with conn.execute("""
@@ -1699,7 +3652,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute("""
                         INSERT INTO tariff 
                         (name, description, price, left_day, server_id, is_enable)
@@ -1719,7 +3672,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute(
                         "SELECT id FROM tariff WHERE id = ? AND is_enable = 1",
                         (tariff_id,)
@@ -1747,7 +3700,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute(
                         "SELECT name FROM tariff WHERE name = ? AND is_enable = 1",
                         (tariff_name,)
@@ -1775,7 +3728,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     
                     cursor = await conn.execute("""
@@ -1811,7 +3764,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
                         SELECT * FROM api_key WHERE key = ? AND is_enable = 1
@@ -1830,7 +3783,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute("""
                         INSERT INTO api_key (name, key, is_enable)
                         VALUES (?, ?, 1)
@@ -1849,7 +3802,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute("""
                         UPDATE api_key SET is_enable = 0 WHERE id = ?
                     """, (key_id,))
@@ -1867,7 +3820,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
                         SELECT * FROM api_key ORDER BY date DESC
@@ -1890,7 +3843,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute(
                         "SELECT telegram_id FROM user WHERE telegram_id = ? AND is_enable = 0",
                         (telegram_id,)
@@ -1918,7 +3871,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute(
                         "SELECT telegram_id FROM user WHERE telegram_id = ? AND is_enable = 1",
                         (telegram_id,)
@@ -1950,7 +3903,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     
                     if only_sum:
@@ -2003,7 +3956,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute(
                         "SELECT name FROM server_settings WHERE id = ?",
                         (server_id,)
@@ -2058,7 +4011,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     
                     if trial_id is not None:
@@ -2092,7 +4045,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute("""
                         INSERT INTO trial_settings (id, name, left_day, server_id, is_enable)
                         VALUES ((SELECT COALESCE(MAX(id), 100) + 1 FROM trial_settings), ?, ?, ?, 1)
@@ -2114,7 +4067,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     update_fields = []
                     params = []
                     
@@ -2154,7 +4107,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute("""
                         UPDATE trial_settings 
                         SET is_enable = 0 
@@ -2174,7 +4127,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
                         SELECT promocod, activation_limit, activation_total, percentage
@@ -2205,7 +4158,7 @@ class Database:
             try:
                 while True:
                     promocode = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(12))
-                    async with aiosqlite.connect(self.db_path) as conn:
+                    async with self.acquire() as conn:
                         cursor = await conn.execute(
                             "SELECT promocod FROM promocodes WHERE promocod = ?",
                             (promocode,)
@@ -2213,7 +4166,7 @@ class Database:
                         if not await cursor.fetchone():
                             break
                 
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute("""
                         INSERT INTO promocodes (promocod, activation_limit, percentage, is_enable)
                         VALUES (?, ?, ?, 1)
@@ -2238,7 +4191,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute(
                         "UPDATE promocodes SET is_enable = 0 WHERE promocod = ?",
                         (promocode,)
@@ -2257,8 +4210,8 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
-                    cursor = await conn.execute("SELECT COUNT(*) as total_users FROM user")
+                async with self.acquire() as conn:
+                    cursor = await conn.execute("SELECT users_count FROM stats_snapshot WHERE id = 1")
                     result = await cursor.fetchone()
                     return result[0] if result else 0
             except Exception as e:
@@ -2273,10 +4226,10 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
-                    cursor = await conn.execute("SELECT COUNT(*) as total_subscriptions FROM user_subscription")
+                async with self.acquire() as conn:
+                    cursor = await conn.execute("SELECT SUM(total) FROM stats_subscriptions")
                     result = await cursor.fetchone()
-                    return result[0] if result else 0
+                    return result[0] if result and result[0] else 0
             except Exception as e:
                 logger.error(f"Ошибка при получении количества подписок: {e}")
                 return 0
@@ -2289,13 +4242,14 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
-                        SELECT t.name, COUNT(*) as count
-                        FROM user_subscription us
-                        JOIN tariff t ON us.tariff_id = t.id
-                        GROUP BY us.tariff_id
+                        SELECT t.name, SUM(st.total + st.renewals) as count
+                        FROM stats_subscriptions st
+                        JOIN tariff t ON st.tariff_id = t.id
+                        GROUP BY st.tariff_id
+                        HAVING count > 0
                         ORDER BY count DESC
                         LIMIT 1
                     """)
@@ -2313,7 +4267,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
                         SELECT p.price, p.date as payment_date, u.username, u.telegram_id
@@ -2336,8 +4290,8 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
-                    cursor = await conn.execute('SELECT SUM(price) as total FROM payments')
+                async with self.acquire() as conn:
+                    cursor = await conn.execute("SELECT payments_amount FROM stats_snapshot WHERE id = 1")
                     result = await cursor.fetchone()
                     return result[0] if result and result[0] else 0
             except Exception as e:
@@ -2352,14 +4306,14 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
-                        SELECT u.username, u.telegram_id, COUNT(*) as purchase_count
-                        FROM payments p
-                        JOIN user u ON p.user_id = u.telegram_id
-                        GROUP BY p.user_id
-                        ORDER BY purchase_count DESC
+                        SELECT u.username, u.telegram_id, b.purchase_count
+                        FROM stats_buyers b
+                        JOIN user u ON b.user_id = u.telegram_id
+                        WHERE b.purchase_count > 0
+                        ORDER BY b.purchase_count DESC
                         LIMIT 1
                     """)
                     result = await cursor.fetchone()
@@ -2370,13 +4324,65 @@ class Database:
         
         return await self.db_operation_with_retry(_operation)
 
+    async def get_statistics_summary(self) -> Dict:
+        """
+        Общая статистика из снимка stats_* одним соединением
+        """
+        async def _operation():
+            async with self.acquire() as conn:
+                conn.row_factory = aiosqlite.Row
+                async with conn.execute(
+                    "SELECT users_count, payments_amount FROM stats_snapshot WHERE id = 1"
+                ) as cursor:
+                    snapshot = await cursor.fetchone()
+                async with conn.execute("SELECT SUM(total) FROM stats_subscriptions") as cursor:
+                    total_subscriptions = (await cursor.fetchone())[0] or 0
+                async with conn.execute("""
+                    SELECT t.name, SUM(st.total + st.renewals) as count
+                    FROM stats_subscriptions st
+                    JOIN tariff t ON st.tariff_id = t.id
+                    GROUP BY st.tariff_id
+                    HAVING count > 0
+                    ORDER BY count DESC
+                    LIMIT 1
+                """) as cursor:
+                    popular_tariff = await cursor.fetchone()
+                async with conn.execute("""
+                    SELECT p.price, p.date as payment_date, u.username, u.telegram_id
+                    FROM payments p
+                    JOIN user u ON p.user_id = u.telegram_id
+                    ORDER BY p.date DESC
+                    LIMIT 1
+                """) as cursor:
+                    last_payment = await cursor.fetchone()
+                async with conn.execute("""
+                    SELECT u.username, u.telegram_id, b.purchase_count
+                    FROM stats_buyers b
+                    JOIN user u ON b.user_id = u.telegram_id
+                    WHERE b.purchase_count > 0
+                    ORDER BY b.purchase_count DESC
+                    LIMIT 1
+                """) as cursor:
+                    top_buyer = await cursor.fetchone()
+
+                return {
+                    "total_users": snapshot['users_count'] if snapshot else 0,
+                    "total_subscriptions": total_subscriptions,
+                    "popular_tariff": dict(popular_tariff) if popular_tariff else None,
+                    "last_payment": dict(last_payment) if last_payment else None,
+                    "total_amount": snapshot['payments_amount'] if snapshot and snapshot['payments_amount'] else 0,
+                    "top_buyer": dict(top_buyer) if top_buyer else None
+                }
+
+        return await self.db_operation_with_retry(_operation)
+
     async def get_all_users_for_notify(self) -> List[Dict]:
         """
         Получение списка всех пользователей для рассылки
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
                         SELECT telegram_id, username
@@ -2397,7 +4403,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
                         SELECT telegram_id, username
@@ -2418,7 +4424,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
                         SELECT tp.*, s.name as server_name
@@ -2441,7 +4447,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute("""
                         UPDATE tariff_promo 
                         SET is_enable = 0 
@@ -2461,7 +4467,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     conn.row_factory = aiosqlite.Row
                     
                     cursor = await conn.execute("""
@@ -2498,7 +4504,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     cursor = await conn.execute(
                         "SELECT COUNT(DISTINCT user_id) as users_count FROM user_balance"
                     )
@@ -2530,7 +4536,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
                         SELECT command, text, image_path, is_enable
@@ -2551,7 +4557,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute("""
                         SELECT 1 FROM bot_message WHERE command = ?
                     """, (command,))
@@ -2588,7 +4594,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute("""
                         SELECT 1 FROM bot_message WHERE command = ?
                     """, (command,))
@@ -2613,18 +4619,22 @@ class Database:
         return await self.db_operation_with_retry(_operation)
 
     async def get_referral_rewards_history(self, user_id: Optional[int] = None, 
-                                           limit: int = 100, offset: int = 0) -> List[Dict]:
+                                           limit: int = 100, offset: int = 0,
+                                           after: Optional[str] = None) -> List[Dict]:
         """
         Получение истории реферальных вознаграждений
         
         :param user_id: ID пользователя (опционально, для фильтрации)
         :param limit: Лимит записей
-        :param offset: Смещение для пагинации
+        :param offset: Смещение для пагинации (только без курсора)
+        :param after: Курсор следующей страницы
         :return: Список записей истории вознаграждений
         """
+        after_id = decode_cursor(after)
+
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     
                     query = """
@@ -2641,13 +4651,19 @@ class Database:
                         LEFT JOIN referral_condition rc ON h.condition_id = rc.id
                     """
                     
+                    conditions = []
                     params = []
                     if user_id is not None:
-                        query += " WHERE h.user_id = ?"
+                        conditions.append("h.user_id = ?")
                         params.append(user_id)
+                    if after_id is not None:
+                        conditions.append("h.id < ?")
+                        params.append(after_id)
+                    if conditions:
+                        query += " WHERE " + " AND ".join(conditions)
                     
-                    query += " ORDER BY h.created_at DESC LIMIT ? OFFSET ?"
-                    params.extend([limit, offset])
+                    query += " ORDER BY h.id DESC LIMIT ? OFFSET ?"
+                    params.extend([limit, 0 if after_id is not None else offset])
                     
                     cursor = await conn.execute(query, params)
                     history = await cursor.fetchall()
@@ -2668,7 +4684,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute("""
                         INSERT INTO user_subscription 
                         (user_id, tariff_id, server_id, end_date, vless, payment_id, is_active)
@@ -2684,7 +4700,65 @@ class Database:
             except Exception as e:
                 logger.error(f"Ошибка при добавлении подписки пользователя: {e}")
                 return 0
-        
+
+        return await self.db_operation_with_retry(_operation)
+
+    async def add_user_subscriptions(self, subscriptions: List[Dict]) -> List[int]:
+        """
+        Добавление нескольких подписок одной транзакцией
+
+        :param subscriptions: Словари с полями user_id, tariff_id, server_id, end_date, vless
+            и необязательным payment_id
+        :return: ID новых подписок в порядке subscriptions
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                ids = []
+                for sub in subscriptions:
+                    cursor = await conn.execute("""
+                        INSERT INTO user_subscription
+                        (user_id, tariff_id, server_id, end_date, vless, payment_id, is_active)
+                        VALUES (?, ?, ?, ?, ?, ?, 1)
+                        RETURNING id
+                    """, (sub['user_id'], sub['tariff_id'], sub['server_id'], sub['end_date'],
+                          sub['vless'], sub.get('payment_id')))
+                    ids.append((await cursor.fetchone())[0])
+                await conn.commit()
+                return ids
+
+        if not subscriptions:
+            return []
+        return await self.db_operation_with_retry(_operation)
+
+    async def ensure_users(self, users: List[Tuple[int, str]]) -> set:
+        """
+        Добавление пользователей, которых еще нет, одной транзакцией
+
+        :param users: Пары (telegram_id, username); существующие пользователи не меняются
+        :return: telegram_id из users, которые есть в базе после добавления
+        """
+        async def _operation():
+            async with self.acquire(write=True) as conn:
+                await conn.executemany("""
+                    INSERT INTO user
+                    (telegram_id, username, trial_period, is_enable, referral_code, referral_count)
+                    VALUES (?, ?, 0, 1, ?, 0)
+                    ON CONFLICT DO NOTHING
+                """, [
+                    (telegram_id, username or "",
+                     ''.join(random.choices(string.ascii_uppercase + string.digits, k=8)))
+                    for telegram_id, username in users
+                ])
+                await conn.commit()
+                placeholders = ','.join('?' * len(users))
+                async with conn.execute(
+                    f"SELECT telegram_id FROM user WHERE telegram_id IN ({placeholders})",
+                    [telegram_id for telegram_id, _ in users]
+                ) as cursor:
+                    return {row[0] for row in await cursor.fetchall()}
+
+        if not users:
+            return set()
         return await self.db_operation_with_retry(_operation)
 
     async def add_user(self, telegram_id: int, username: str = "", 
@@ -2707,7 +4781,7 @@ class Database:
                 else:
                     ref_code = referral_code
                     
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute("""
                         INSERT INTO user 
                         (telegram_id, username, trial_period, is_enable, referral_code, referral_count, referred_by)
@@ -2735,7 +4809,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     cursor = await conn.execute("""
                         SELECT SUM(amount) as total
                         FROM crypto_payments
@@ -2758,7 +4832,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     
                     cursor = await conn.execute("""
@@ -2815,17 +4889,23 @@ class Database:
         
         return await self.db_operation_with_retry(_operation)
 
-    async def get_all_payments(self) -> List[Dict]:
+    async def get_all_payments(self, limit: Optional[int] = None, after: Optional[str] = None,
+                               skip: int = 0) -> List[Dict]:
         """
         Получение списка всех платежей с информацией о пользователе и тарифе
         
+        :param limit: Сколько записей вернуть (без лимита — все платежи)
+        :param after: Курсор следующей страницы
+        :param skip: Смещение для старых клиентов, используется только без курсора
         :return: Список словарей с информацией о платежах
         """
+        after_id = decode_cursor(after)
+
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
-                    cursor = await conn.execute("""
+                    query = """
                         SELECT 
                             p.id,
                             p.user_id AS telegram_id,
@@ -2837,8 +4917,16 @@ class Database:
                         FROM payments p
                         LEFT JOIN user u ON p.user_id = u.telegram_id
                         LEFT JOIN tariff t ON p.tariff_id = t.id
-                        ORDER BY p.date DESC
-                    """)
+                    """
+                    params = []
+                    if after_id is not None:
+                        query += " WHERE p.id < ?"
+                        params.append(after_id)
+                    query += " ORDER BY p.id DESC"
+                    if limit:
+                        query += " LIMIT ? OFFSET ?"
+                        params.extend([limit, 0 if after_id is not None else skip])
+                    cursor = await conn.execute(query, params)
                     
                     payments = await cursor.fetchall()
                     return [dict(row) for row in payments]
@@ -2898,7 +4986,7 @@ class Database:
                 sql = f"UPDATE tariff SET {', '.join(updates)} WHERE id = ?"
                 params.append(tariff_id)
                 
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute("SELECT id FROM tariff WHERE id = ?", (tariff_id,))
                     tariff = await cursor.fetchone()
                     
@@ -2923,7 +5011,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     cursor = await conn.execute("""
                         SELECT 
@@ -2965,7 +5053,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute("""
                         UPDATE bot_settings SET is_enable = 0
                     """)
@@ -3050,7 +5138,7 @@ class Database:
                 
                 sql = f"UPDATE bot_settings SET {', '.join(updates)} WHERE is_enable = 1"
                 
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     await conn.execute(sql, params)
                     await conn.commit()
                     return True
@@ -3070,7 +5158,7 @@ class Database:
         """
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute(
                         "SELECT id FROM referral_condition WHERE id = ?",
                         (condition_id,)
@@ -3098,7 +5186,8 @@ class Database:
 
     async def update_server(self, server_id: int, name: str = None, ip: str = None, 
                            port: str = None, inbound_id: int = None, 
-                           is_enable: bool = None, inbound_id_promo: int = None) -> bool:
+                           is_enable: bool = None, inbound_id_promo: int = None,
+                           region: str = None, capacity: int = None, weight: float = None) -> bool:
         """
         Обновление настроек сервера
         
@@ -3109,6 +5198,9 @@ class Database:
         :param inbound_id: Новый ID входящего соединения (опционально)
         :param is_enable: Новый статус активности сервера (опционально)
         :param inbound_id_promo: Новый ID входящего соединения для промо (опционально)
+        :param region: Регион для распределения подписок, пустая строка — без региона (опционально)
+        :param capacity: Максимум активных подписок, 0 — без ограничения (опционально)
+        :param weight: Относительная доля новых подписок (опционально)
         :return: True если сервер успешно обновлен, иначе False
         """
         async def _operation():
@@ -3139,6 +5231,18 @@ class Database:
                 if inbound_id_promo is not None:
                     updates.append("inbound_id_promo = ?")
                     params.append(inbound_id_promo)
+
+                if region is not None:
+                    updates.append("region = ?")
+                    params.append(region or None)
+
+                if capacity is not None:
+                    updates.append("capacity = ?")
+                    params.append(capacity)
+
+                if weight is not None:
+                    updates.append("weight = ?")
+                    params.append(weight)
                 
                 if not updates:
                     return True
@@ -3146,7 +5250,7 @@ class Database:
                 sql = f"UPDATE server_settings SET {', '.join(updates)} WHERE id = ?"
                 params.append(server_id)
                 
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire(write=True) as conn:
                     cursor = await conn.execute("SELECT id FROM server_settings WHERE id = ?", (server_id,))
                     server = await cursor.fetchone()
                     
@@ -3175,14 +5279,14 @@ class Database:
                 SELECT 
                     s.id as server_id,
                     s.name as server_name,
-                    COUNT(us.id) as subscriptions_count
+                    SUM(st.active) as subscriptions_count
                 FROM server_settings s
-                LEFT JOIN user_subscription us ON s.id = us.server_id
-                WHERE us.is_active = 1
+                JOIN stats_subscriptions st ON s.id = st.server_id
                 GROUP BY s.id, s.name
+                HAVING subscriptions_count > 0
                 ORDER BY s.id
             """
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute(query)
                 rows = await cursor.fetchall()
@@ -3193,6 +5297,7 @@ class Database:
     async def get_servers_total_earnings(self) -> List[Dict]:
         """
         Получает статистику по общей сумме заработка на каждом сервере.
+        Продления тарифа (stats_subscriptions.renewals) входят в заработок.
         
         Returns:
             List[Dict]: Список словарей с информацией о серверах и общей суммой заработка
@@ -3201,16 +5306,17 @@ class Database:
             query = """
                 SELECT 
                     ss.name AS server_name,
-                    COUNT(us.id) AS total_subscriptions,
-                    SUM(COALESCE(t.price, 0)) AS total_earnings
-                FROM user_subscription us
-                LEFT JOIN tariff t ON us.tariff_id = t.id
-                JOIN server_settings ss ON us.server_id = ss.id
+                    SUM(st.total) AS total_subscriptions,
+                    SUM((st.total + st.renewals) * COALESCE(t.price, 0)) AS total_earnings
+                FROM stats_subscriptions st
+                LEFT JOIN tariff t ON st.tariff_id = t.id
+                JOIN server_settings ss ON st.server_id = ss.id
                 GROUP BY ss.id, ss.name
+                HAVING SUM(st.total + st.renewals) > 0
                 ORDER BY total_earnings DESC;
 
             """
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute(query)
                 rows = await cursor.fetchall()
@@ -3237,11 +5343,12 @@ class Database:
                 LEFT JOIN server_settings ss ON us.server_id = ss.id
                 LEFT JOIN tariff t ON us.tariff_id = t.id
                 WHERE us.is_active = 1
-                AND us.end_date BETWEEN DATETIME('now') AND DATETIME('now', '+10 days')
-                ORDER BY us.end_date ASC;
+                AND us.end_ts BETWEEN CAST(strftime('%s', 'now') AS INTEGER)
+                    AND CAST(strftime('%s', 'now', '+10 days') AS INTEGER)
+                ORDER BY us.end_ts ASC;
 
             """
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.acquire() as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute(query)
                 rows = await cursor.fetchall()
@@ -3249,18 +5356,25 @@ class Database:
                 
         return await self.db_operation_with_retry(_operation)
 
-    async def get_all_crypto_payments(self) -> List[Dict]:
+    async def get_all_crypto_payments(self, limit: Optional[int] = None, after: Optional[str] = None,
+                                      skip: int = 0) -> List[Dict]:
         """
         Получение списка всех платежей с информацией о пользователе и тарифе
         
+        :param limit: Сколько записей вернуть (без лимита — все платежи)
+        :param after: Курсор следующей страницы
+        :param skip: Смещение для старых клиентов, используется только без курсора
         :return: Список словарей с информацией о платежах
         """
+        after_id = decode_cursor(after)
+
         async def _operation():
             try:
-                async with aiosqlite.connect(self.db_path) as conn:
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
-                    cursor = await conn.execute("""
+                    query = """
                 SELECT 
+                    cp.id AS id,
                     u.username AS username,
                     u.telegram_id AS telegram_id,
                     t.name AS tariff_name,
@@ -3270,8 +5384,16 @@ class Database:
                 LEFT JOIN user u ON cp.user_id = u.telegram_id
                 LEFT JOIN tariff t ON cp.tariff_id = t.id
                 WHERE cp.status = 'paid'
-                ORDER BY cp.created_at DESC;
-                    """)
+                    """
+                    params = []
+                    if after_id is not None:
+                        query += " AND cp.id < ?"
+                        params.append(after_id)
+                    query += " ORDER BY cp.id DESC"
+                    if limit:
+                        query += " LIMIT ? OFFSET ?"
+                        params.extend([limit, 0 if after_id is not None else skip])
+                    cursor = await conn.execute(query, params)
                     
                     payments = await cursor.fetchall()
                     return [dict(row) for row in payments]
@@ -3281,15 +5403,20 @@ class Database:
         
         return await self.db_operation_with_retry(_operation)
 
-    async def get_all_balance_transactions(self, skip: int = 0, limit: int = 100, type_filter: Optional[str] = None) -> Dict:
+    async def get_all_balance_transactions(self, skip: int = 0, limit: int = 100, type_filter: Optional[str] = None,
+                                           after: Optional[str] = None) -> Dict:
         """
         Получение всех транзакций баланса с пагинацией и опциональной фильтрацией по типу
         
-        :param skip: Сколько записей пропустить (для пагинации)
+        :param skip: Сколько записей пропустить (для старых клиентов, только без курсора)
         :param limit: Сколько записей вернуть (для пагинации)
         :param type_filter: Фильтр по типу транзакции (опционально)
-        :return: Словарь со списком транзакций и общим количеством записей
+        :param after: Курсор следующей страницы
+        :return: Словарь со списком транзакций, курсором следующей страницы
+                 и общим количеством записей (только для первой страницы)
         """
+        after_id = decode_cursor(after)
+
         async def _operation():
             try:
                 query = """
@@ -3306,26 +5433,34 @@ class Database:
                     LEFT JOIN user u ON bt.user_id = u.telegram_id
                 """
                 
+                conditions = []
                 params = []
                 if type_filter:
-                    query += " WHERE bt.type = ? "
+                    conditions.append("bt.type = ?")
                     params.append(type_filter)
                 
-                query += " ORDER BY bt.created_at DESC "
-                
                 count_query = "SELECT COUNT(*) as total FROM balance_transactions bt "
-                if type_filter:
-                    count_query += " WHERE bt.type = ? "
+                if conditions:
+                    count_query += " WHERE " + " AND ".join(conditions)
+                count_params = list(params)
                 
-                query += " LIMIT ? OFFSET ? "
-                params.extend([limit, skip])
+                if after_id is not None:
+                    conditions.append("bt.id < ?")
+                    params.append(after_id)
+                if conditions:
+                    query += " WHERE " + " AND ".join(conditions)
                 
-                async with aiosqlite.connect(self.db_path) as conn:
+                query += " ORDER BY bt.id DESC LIMIT ? OFFSET ? "
+                params.extend([limit, 0 if after_id is not None else skip])
+                
+                async with self.acquire() as conn:
                     conn.row_factory = aiosqlite.Row
                     
-                    cursor = await conn.execute(count_query, params[:-2] if type_filter else [])
-                    row = await cursor.fetchone()
-                    total_count = row['total'] if row else 0
+                    total_count = None
+                    if after_id is None:
+                        cursor = await conn.execute(count_query, count_params)
+                        row = await cursor.fetchone()
+                        total_count = row['total'] if row else 0
                     
                     cursor = await conn.execute(query, params)
                     rows = await cursor.fetchall()
@@ -3335,7 +5470,8 @@ class Database:
                         "transactions": transactions,
                         "total_count": total_count,
                         "limit": limit,
-                        "offset": skip
+                        "offset": skip if after_id is None else None,
+                        "next_cursor": next_cursor(transactions, limit)
                     }
             except Exception as e:
                 logger.error(f"Ошибка при получении транзакций баланса: {e}")
@@ -0,0 +1,219 @@
+import os
+import time
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager, AsyncExitStack
+from typing import Optional, Dict, List, Callable
+
+import aiosqlite
+from loguru import logger
+
+from handlers.db_writer import WriteQueue
+
+DEFAULT_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 4))
+DEFAULT_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 20.0))
+
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA busy_timeout=2000;",
+)
+
+# (task, pool, write, connection) — соединение, которое уже занято текущей задачей.
+# Вложенные вызовы Database внутри одной задачи переиспользуют его, а не ждут второе.
+_held_connection = contextvars.ContextVar("db_pool_held_connection", default=None)
+
+
+class ConnectionPool:
+    """
+    Пул долгоживущих соединений с SQLite:
+    N соединений на чтение и одно выделенное соединение на запись.
+    Запись идет через очередь с групповым коммитом (см. WriteQueue).
+    Соединения открываются лениво и один раз, с PRAGMA из init_db.
+    """
+
+    def __init__(self, db_path: str, size: int = DEFAULT_POOL_SIZE, timeout: float = DEFAULT_POOL_TIMEOUT):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._readers: Optional[asyncio.Queue] = None
+        self._writer: Optional[WriteQueue] = None
+        self._opened = 0
+        self._commit_listeners: List[Callable[[], None]] = []
+        self._metrics = {
+            'read': self._empty_metrics(),
+            'write': self._empty_metrics()
+        }
+
+    @staticmethod
+    def _empty_metrics() -> Dict:
+        return {
+            'acquired': 0,
+            'waited': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+            'timeouts': 0,
+            'in_use': 0
+        }
+
+    def _bind_loop(self):
+        """Привязка очередей пула к текущему event loop"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+
+        if self._loop is not None:
+            logger.warning("Пул соединений используется в новом event loop, соединения будут открыты заново")
+
+        self._loop = loop
+        self._opened = 0
+        self._readers = asyncio.Queue()
+        self._writer = WriteQueue(self._open, on_commit=self._notify_commit)
+        for _ in range(self.size):
+            self._readers.put_nowait(None)
+
+    def add_commit_listener(self, listener: Callable[[], None]):
+        """Регистрация функции, которая вызывается после каждого коммита записи"""
+        if listener not in self._commit_listeners:
+            self._commit_listeners.append(listener)
+
+    def _notify_commit(self):
+        for listener in self._commit_listeners:
+            listener()
+
+    async def _open(self) -> aiosqlite.Connection:
+        """Открытие нового соединения с настройками из init_db"""
+        conn = await aiosqlite.connect(self.db_path, timeout=20.0)
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        self._opened += 1
+        return conn
+
+    def _record_wait(self, kind: str, started: float):
+        metrics = self._metrics[kind]
+        waited = time.monotonic() - started
+        metrics['acquired'] += 1
+        if waited > 0.001:
+            metrics['waited'] += 1
+        metrics['wait_total'] += waited
+        metrics['wait_max'] = max(metrics['wait_max'], waited)
+
+    async def _take(self) -> aiosqlite.Connection:
+        """Получение соединения на чтение с учетом времени ожидания"""
+        started = time.monotonic()
+        try:
+            conn = await asyncio.wait_for(self._readers.get(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._metrics['read']['timeouts'] += 1
+            logger.error(f"Не удалось получить соединение (read) из пула за {self.timeout}с")
+            raise
+        self._record_wait('read', started)
+
+        if conn is None:
+            try:
+                conn = await self._open()
+            except Exception:
+                self._readers.put_nowait(None)
+                raise
+        return conn
+
+    async def _take_writer(self, stack: AsyncExitStack) -> aiosqlite.Connection:
+        """Ожидание очереди на запись с учетом времени ожидания"""
+        started = time.monotonic()
+        try:
+            conn = await stack.enter_async_context(self._writer.slot(self.timeout))
+        except asyncio.TimeoutError:
+            self._metrics['write']['timeouts'] += 1
+            logger.error(f"Не удалось получить соединение (write) из пула за {self.timeout}с")
+            raise
+        self._record_wait('write', started)
+        return conn
+
+    async def _release(self, conn: aiosqlite.Connection):
+        """Возврат соединения на чтение в пул с откатом незавершенной транзакции"""
+        try:
+            if conn.in_transaction:
+                await conn.rollback()
+            conn.row_factory = None
+        except Exception as e:
+            logger.error(f"Соединение с базой данных повреждено и будет открыто заново: {e}")
+            try:
+                await conn.close()
+            except Exception:
+                pass
+            self._opened -= 1
+            conn = None
+        self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def acquire(self, write: bool = False):
+        """
+        Получение соединения из пула.
+
+        :param write: True для выделенного соединения на запись
+        """
+        task = asyncio.current_task()
+        held = _held_connection.get()
+        if held and held[0] is task and held[1] is self and (held[2] or not write):
+            conn = held[3]
+            row_factory = conn.row_factory
+            try:
+                yield conn
+            finally:
+                conn.row_factory = row_factory
+            return
+
+        self._bind_loop()
+        kind = 'write' if write else 'read'
+        async with AsyncExitStack() as stack:
+            if write:
+                conn = await self._take_writer(stack)
+            else:
+                conn = await self._take()
+                stack.push_async_callback(self._release, conn)
+
+            self._metrics[kind]['in_use'] += 1
+            token = _held_connection.set((task, self, write, conn))
+            try:
+                yield conn
+            finally:
+                _held_connection.reset(token)
+                self._metrics[kind]['in_use'] -= 1
+
+    def stats(self) -> Dict:
+        """Метрики пула: размер, занятые соединения и время ожидания"""
+        result = {
+            'db_path': self.db_path,
+            'readers': self.size,
+            'writers': 1,
+            'opened': self._opened,
+            'timeout': self.timeout
+        }
+        for kind, metrics in self._metrics.items():
+            acquired = metrics['acquired']
+            result[kind] = {
+                **metrics,
+                'wait_total': round(metrics['wait_total'], 6),
+                'wait_max': round(metrics['wait_max'], 6),
+                'wait_avg': round(metrics['wait_total'] / acquired, 6) if acquired else 0.0
+            }
+        result['group_commit'] = self._writer.stats() if self._writer is not None else {}
+        return result
+
+    async def close(self):
+        """Закрытие всех открытых соединений пула"""
+        if self._writer is not None:
+            await self._writer.close()
+        if self._readers is not None:
+            while not self._readers.empty():
+                conn = self._readers.get_nowait()
+                if conn is not None:
+                    try:
+                        await conn.close()
+                    except Exception as e:
+                        logger.error(f"Ошибка при закрытии соединения пула: {e}")
+        self._loop = None
+        self._readers = None
+        self._writer = None
+        self._opened = 0
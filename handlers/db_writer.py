@@ -0,0 +1,271 @@
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, List, Callable, Awaitable
+
+import aiosqlite
+from loguru import logger
+
+GROUP_COMMIT_WINDOW = float(os.environ.get("DB_GROUP_COMMIT_WINDOW_MS", 2)) / 1000
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("DB_GROUP_COMMIT_MAX_BATCH", 64))
+
+BEGIN_ATTEMPTS = 5
+
+_STOP = object()
+
+
+def _resolve(future: asyncio.Future, result=None, error: Optional[BaseException] = None):
+    """Установка результата future, если его еще никто не отменил"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class GroupConnection:
+    """
+    Соединение, которое получает одна операция записи внутри общей транзакции.
+
+    Операция выполняется в своем SAVEPOINT: commit() фиксирует ее изменения
+    в рамках пачки (на диск они попадут общим коммитом), rollback() и выход
+    из блока без commit() откатывают изменения после последнего commit(),
+    как это было при отдельном соединении на каждый вызов.
+    """
+
+    def __init__(self, conn: aiosqlite.Connection, savepoint: str):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_savepoint', savepoint)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    async def commit(self):
+        """Фиксация изменений операции до общего коммита пачки"""
+        await self._conn.execute(f"RELEASE SAVEPOINT {self._savepoint}")
+        await self._conn.execute(f"SAVEPOINT {self._savepoint}")
+
+    async def rollback(self):
+        """Откат изменений операции после последнего commit()"""
+        await self._conn.execute(f"ROLLBACK TO SAVEPOINT {self._savepoint}")
+
+
+class _WriteJob:
+    __slots__ = ('granted', 'finished', 'committed')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.granted = loop.create_future()
+        self.finished = loop.create_future()
+        self.committed = loop.create_future()
+
+
+class WriteQueue:
+    """
+    Очередь записи с групповым коммитом.
+
+    Все изменения выполняются одной фоновой задачей на единственном соединении.
+    Операции, пришедшие в течение окна группировки, выполняются в одной
+    транзакции (каждая в своем SAVEPOINT) и фиксируются одним COMMIT.
+    Вызывающий код выходит из блока записи только после коммита своей пачки.
+    """
+
+    def __init__(self, open_connection: Callable[[], Awaitable[aiosqlite.Connection]],
+                 window: float = GROUP_COMMIT_WINDOW, max_batch: int = GROUP_COMMIT_MAX_BATCH,
+                 on_commit: Optional[Callable[[], None]] = None):
+        self._open_connection = open_connection
+        self._on_commit = on_commit
+        self.window = max(0.0, window)
+        self.max_batch = max(1, max_batch)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._metrics = {
+            'batches': 0,
+            'jobs': 0,
+            'rolled_back': 0,
+            'failed_commits': 0,
+            'max_batch_size': 0
+        }
+
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    @asynccontextmanager
+    async def slot(self, timeout: float):
+        """
+        Ожидание очереди на запись и выдача соединения операции.
+
+        :param timeout: максимальное время ожидания своей очереди
+        """
+        self._start()
+        job = _WriteJob(asyncio.get_running_loop())
+        self._queue.put_nowait(job)
+        try:
+            conn = await asyncio.wait_for(asyncio.shield(job.granted), timeout=timeout)
+        except BaseException as e:
+            if not job.granted.cancel() and not job.granted.cancelled() and job.granted.exception() is None:
+                # Очередь подошла одновременно с отменой — освобождаем ее
+                _resolve(job.finished, e)
+            raise
+
+        try:
+            yield conn
+        except BaseException as e:
+            _resolve(job.finished, e)
+            raise
+        _resolve(job.finished, None)
+        await job.committed
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._conn is None:
+            self._conn = await self._open_connection()
+        return self._conn
+
+    async def _begin(self, conn: aiosqlite.Connection):
+        """Начало транзакции пачки с повторными попытками при блокировке другим процессом"""
+        for attempt in range(1, BEGIN_ATTEMPTS + 1):
+            try:
+                await conn.execute("BEGIN IMMEDIATE")
+                return
+            except aiosqlite.OperationalError as e:
+                if "database is locked" in str(e) and attempt < BEGIN_ATTEMPTS:
+                    wait_time = 0.1 * (2 ** (attempt - 1))
+                    logger.warning(f"База данных заблокирована, повторная попытка {attempt} через {wait_time:.2f}с")
+                    await asyncio.sleep(wait_time)
+                else:
+                    raise
+
+    async def _next(self, deadline: float):
+        """Следующая операция для текущей пачки или None, если окно группировки закрыто"""
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining <= 0:
+                job = self._queue.get_nowait()
+            else:
+                job = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+        except (asyncio.QueueEmpty, asyncio.TimeoutError):
+            return None
+        if job is _STOP:
+            self._queue.put_nowait(_STOP)
+            return None
+        return job
+
+    async def _run_job(self, conn: aiosqlite.Connection, job: _WriteJob, savepoint: str) -> bool:
+        """Выполнение одной операции в своем SAVEPOINT. True, если операция ждет коммита"""
+        if job.granted.cancelled():
+            return False
+
+        await conn.execute(f"SAVEPOINT {savepoint}")
+        job.granted.set_result(GroupConnection(conn, savepoint))
+        try:
+            error = await job.finished
+        finally:
+            conn.row_factory = None
+
+        await conn.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+        await conn.execute(f"RELEASE SAVEPOINT {savepoint}")
+        if error is not None:
+            self._metrics['rolled_back'] += 1
+        return error is None
+
+    async def _reset(self):
+        """Откат незавершенной транзакции, при ошибке соединение будет открыто заново"""
+        if self._conn is None:
+            return
+        try:
+            if self._conn.in_transaction:
+                await self._conn.rollback()
+            self._conn.row_factory = None
+        except Exception as e:
+            logger.error(f"Соединение для записи повреждено и будет открыто заново: {e}")
+            try:
+                await self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    async def _run(self):
+        """Фоновая задача записи"""
+        while True:
+            job = await self._queue.get()
+            if job is _STOP:
+                return
+            if job.granted.cancelled():
+                continue
+
+            batch: List[_WriteJob] = []
+            try:
+                conn = await self._connection()
+                await self._begin(conn)
+                deadline = time.monotonic() + self.window
+                index = 0
+                while job is not None:
+                    index += 1
+                    if await self._run_job(conn, job, f"write_{index}"):
+                        batch.append(job)
+                    if index >= self.max_batch:
+                        break
+                    job = await self._next(deadline)
+                await conn.commit()
+            except asyncio.CancelledError:
+                await self._reset()
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при групповой записи в базу данных: {e}")
+                self._metrics['failed_commits'] += 1
+                if job is not None and job not in batch:
+                    if not job.granted.done():
+                        _resolve(job.granted, error=e)
+                    elif job.finished.done() and job.finished.result() is None:
+                        _resolve(job.committed, error=e)
+                for done_job in batch:
+                    _resolve(done_job.committed, error=e)
+                await self._reset()
+                continue
+
+            self._metrics['batches'] += 1
+            self._metrics['jobs'] += len(batch)
+            self._metrics['max_batch_size'] = max(self._metrics['max_batch_size'], len(batch))
+            if batch and self._on_commit is not None:
+                try:
+                    self._on_commit()
+                except Exception as e:
+                    logger.error(f"Ошибка в обработчике коммита: {e}")
+            for done_job in batch:
+                _resolve(done_job.committed)
+
+    def stats(self) -> Dict:
+        """Метрики группового коммита"""
+        batches = self._metrics['batches']
+        return {
+            **self._metrics,
+            'queued': self._queue.qsize(),
+            'window_ms': round(self.window * 1000, 3),
+            'avg_batch_size': round(self._metrics['jobs'] / batches, 2) if batches else 0.0
+        }
+
+    async def close(self):
+        """Остановка фоновой задачи и закрытие соединения"""
+        if self._task is not None and not self._task.done():
+            self._queue.put_nowait(_STOP)
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        if self._conn is not None:
+            try:
+                await self._conn.close()
+            except Exception as e:
+                logger.error(f"Ошибка при закрытии соединения для записи: {e}")
+            self._conn = None
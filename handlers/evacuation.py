@@ -0,0 +1,314 @@
+import os
+import time
+import asyncio
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from loguru import logger
+
+from handlers.database import db
+from handlers.x_ui import xui_manager, panel_client_id
+from handlers.x_ui_ss import xui_ss_manager
+from handlers.placement import placement
+from handlers.user.user_kb import get_back_to_start_keyboard
+
+# Сколько подписок переносится за один шаг (одна транзакция в базе)
+EVACUATION_BATCH_SIZE = int(os.environ.get("EVACUATION_BATCH_SIZE", 500))
+# Сколько одиночных запросов к панелям (удаление, Shadowsocks) выполняется одновременно
+EVACUATION_CONCURRENCY = int(os.environ.get("EVACUATION_CONCURRENCY", 16))
+# Сколько сообщений пользователям отправляется в секунду
+EVACUATION_NOTIFY_RATE = float(os.environ.get("EVACUATION_NOTIFY_RATE", 20))
+# Как часто воркер проверяет новые переносы без сигнала, секунд
+EVACUATION_POLL_INTERVAL = float(os.environ.get("EVACUATION_POLL_INTERVAL", 10))
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_wakeup = asyncio.Event()
+
+
+class NotificationSender:
+    """
+    Отправка сообщений из очереди не чаще rate сообщений в секунду.
+    На TelegramRetryAfter отправка приостанавливается на указанное время,
+    поэтому перенос не ждет рассылку и не упирается в лимиты Telegram.
+    """
+
+    def __init__(self, bot: Optional[Bot], rate: float = EVACUATION_NOTIFY_RATE):
+        self.bot = bot
+        self.interval = 1 / rate if rate > 0 else 0
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.sent = 0
+        self.failed = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def send(self, chat_id: int, text: str, **kwargs):
+        if not self.bot:
+            return
+        self.queue.put_nowait((chat_id, text, kwargs))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            chat_id, text, kwargs = await self.queue.get()
+            try:
+                await self._send(chat_id, text, kwargs)
+            finally:
+                self.queue.task_done()
+            await asyncio.sleep(self.interval)
+
+    async def _send(self, chat_id: int, text: str, kwargs: Dict):
+        for _ in range(3):
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                logger.warning(f"Лимит сообщений Telegram, пауза {e.retry_after}с")
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+                break
+        self.failed += 1
+
+    async def close(self):
+        """Дождаться отправки очереди"""
+        if self._task is not None:
+            await self.queue.join()
+            self._task.cancel()
+            self._task = None
+
+
+async def start_evacuation(source_server_id: int, target_server_ids: Optional[List[int]] = None,
+                           delete_source: bool = False) -> Optional[Dict]:
+    """
+    Постановка переноса всех активных подписок с сервера. Сервер и его тарифы
+    сразу отключаются; перенос выполняет воркер в процессе бота.
+
+    :param target_server_ids: Серверы для переноса; по умолчанию включенные
+        серверы того же протокола из региона источника (или все, если в регионе их нет)
+    :param delete_source: Удалить сервер, когда на нем не останется подписок
+    :return: Задание переноса или None, если сервера нет
+    """
+    job = await db.create_server_evacuation(source_server_id, target_server_ids, delete_source)
+    if job and job['created']:
+        logger.info(f"Поставлен перенос подписок с сервера {source_server_id} "
+                    f"(подписок: {job['total']}, серверы: {target_server_ids or 'авто'})")
+        _wakeup.set()
+    return job
+
+
+async def _resolve_targets(job: Dict, source: Dict) -> List[Dict]:
+    protocol = source.get('protocol') or 'vless'
+    servers = [
+        server for server in await db.get_placement_servers()
+        if server['id'] != source['id'] and (server.get('protocol') or 'vless') == protocol
+    ]
+    if job['target_server_ids']:
+        target_ids = {int(server_id) for server_id in job['target_server_ids'].split(',')}
+        return [server for server in servers if server['id'] in target_ids]
+    if source.get('region'):
+        same_region = [server for server in servers if server.get('region') == source['region']]
+        if same_region:
+            return same_region
+    return servers
+
+
+def _end_time(sub: Dict) -> datetime:
+    if sub['end_ts']:
+        return datetime.fromtimestamp(sub['end_ts'])
+    return datetime.now() + timedelta(days=1)
+
+
+async def _create_clients(source: Dict, placed: List[tuple], semaphore: asyncio.Semaphore) -> List[Optional[str]]:
+    """Новые клиенты на целевых серверах; для каждой пары (подписка, сервер) — ссылка или None"""
+    if (source.get('protocol') or 'vless') != 'shadowsocks':
+        results = await xui_manager.provision_batch([
+            {'server_settings': target, 'telegram_id': sub['user_id'], 'end_date': _end_time(sub)}
+            for sub, target in placed
+        ])
+        return [result['link'] for result in results]
+
+    async def _create_ss(sub: Dict, target: Dict) -> Optional[str]:
+        days_left = max(1, int(((_end_time(sub) - datetime.now()).total_seconds() + 86399) // 86400))
+        async with semaphore:
+            return await xui_ss_manager.create_ss_user(target, {'left_day': days_left}, sub['user_id'])
+
+    return await asyncio.gather(*(_create_ss(sub, target) for sub, target in placed))
+
+
+def _inbound_id(server: Dict, sub: Dict) -> int:
+    """inbound клиента подписки; для старых подписок — текущий inbound сервера"""
+    return sub.get('inbound_id') or server.get('inbound_id') or 1
+
+
+async def _delete_clients(clients: List[tuple], semaphore: asyncio.Semaphore) -> int:
+    """Удаление клиентов (сервер, inbound, ссылка) из панелей; возвращает число удаленных"""
+    async def _delete(server: Dict, inbound_id: int, link: str) -> bool:
+        client_id = panel_client_id(link)
+        if not client_id:
+            return False
+        async with semaphore:
+            return await xui_manager.delete_client(server, inbound_id, client_id)
+
+    return sum(await asyncio.gather(*(_delete(server, inbound_id, link) for server, inbound_id, link in clients)))
+
+
+def _notification_text(target: Dict, sub: Dict, link: str) -> str:
+    return (
+        "🔄 Ваша подписка перенесена на другой сервер\n"
+        "<blockquote>"
+        f"<b>Сервер:</b> {target['name']}\n"
+        f"<b>Действует до:</b> {_end_time(sub).strftime('%d.%m.%Y')}\n"
+        "</blockquote>"
+        "Старый ключ больше не работает. Замените его в приложении на новый:\n\n"
+        f"<code>{link}</code>"
+    )
+
+
+async def evacuate_batch(source: Dict, targets: List[Dict], subscriptions: List[Dict],
+                         sender: NotificationSender, semaphore: asyncio.Semaphore) -> Dict:
+    """
+    Перенос одной пачки подписок источника: клиенты создаются на целевых
+    серверах пачками, строки подписок меняются одной транзакцией, затем
+    удаляются старые клиенты и ставятся в очередь уведомления.
+    """
+    result = {'moved': 0, 'failed': 0, 'old_deleted': 0}
+    await placement.refresh()
+    placed = []
+    for sub in subscriptions:
+        target = placement.pick(targets)
+        if target is None:
+            result['failed'] += 1
+            continue
+        placed.append((sub, target))
+    if len(placed) < len(subscriptions):
+        logger.warning(f"Перенос с сервера {source['id']}: нет свободных серверов "
+                       f"для {len(subscriptions) - len(placed)} подписок")
+
+    links = await _create_clients(source, placed, semaphore)
+
+    moves = []
+    for (sub, target), link in zip(placed, links):
+        if link:
+            moves.append({
+                'id': sub['id'],
+                'old_server_id': source['id'],
+                'server_id': target['id'],
+                'inbound_id': target.get('inbound_id') or 1,
+                'vless': link
+            })
+        else:
+            placement.release(target['id'])
+    moved_ids = set(await db.move_subscriptions(moves))
+
+    # Подписка изменилась, пока создавался клиент (удалена, продлена на другом сервере) —
+    # новый клиент не нужен
+    stale = [
+        (target, target.get('inbound_id') or 1, link) for (sub, target), link in zip(placed, links)
+        if link and sub['id'] not in moved_ids
+    ]
+    if stale:
+        await _delete_clients(stale, semaphore)
+
+    moved = [(sub, target, link) for (sub, target), link in zip(placed, links) if sub['id'] in moved_ids]
+    result['moved'] = len(moved)
+    result['failed'] += len(placed) - len(moved)
+    result['old_deleted'] = await _delete_clients(
+        [(source, _inbound_id(source, sub), sub['vless']) for sub, _, _ in moved], semaphore
+    )
+
+    for sub, target, link in moved:
+        sender.send(sub['user_id'], _notification_text(target, sub, link), parse_mode="HTML",
+                    reply_markup=get_back_to_start_keyboard())
+    return result
+
+
+async def run_evacuation(job: Dict, bot: Optional[Bot] = None, batch_size: int = EVACUATION_BATCH_SIZE):
+    """
+    Выполнение переноса с позиции after_id задания. Прогресс сохраняется
+    после каждой пачки, поэтому прерванный перенос продолжается с места остановки.
+    Подписки, которые не удалось перенести, остаются на источнике — повторный
+    перенос с сервера подберет только их. Клиентов, созданных пачкой, которую
+    прервал перезапуск, удаляет сверка (reconcile.py --fix).
+    """
+    started = time.monotonic()
+    source = next((server for server in await db.get_all_servers() if server['id'] == job['source_server_id']), None)
+    if not source:
+        await db.finish_server_evacuation(job['id'], FAILED, error="Сервер-источник не найден")
+        return
+    targets = await _resolve_targets(job, source)
+    if not targets:
+        await db.finish_server_evacuation(job['id'], FAILED, error="Нет включенных серверов для переноса")
+        logger.error(f"Перенос с сервера {source['id']}: нет включенных серверов того же протокола")
+        return
+
+    logger.info(f"Перенос подписок с сервера {source['id']} на серверы {[server['id'] for server in targets]}, "
+                f"с подписки {job['after_id']}")
+    sender = NotificationSender(bot)
+    semaphore = asyncio.Semaphore(EVACUATION_CONCURRENCY)
+    after_id = job['after_id']
+    totals = {'moved': job['moved'], 'failed': job['failed']}
+    notified = 0
+    try:
+        while True:
+            page = await db.get_server_subscriptions_page(source['id'], after_id, batch_size)
+            if not page:
+                break
+            result = await evacuate_batch(source, targets, page, sender, semaphore)
+            after_id = page[-1]['id']
+            sent = sender.sent
+            await db.update_server_evacuation(
+                job['id'], after_id,
+                moved=result['moved'], failed=result['failed'],
+                old_deleted=result['old_deleted'], notified=sent - notified
+            )
+            notified = sent
+            totals['moved'] += result['moved']
+            totals['failed'] += result['failed']
+            logger.info(f"Перенос с сервера {source['id']}: перенесено {totals['moved']} из {job['total']}, "
+                        f"ошибок {totals['failed']}")
+    finally:
+        await sender.close()
+        await db.update_server_evacuation(job['id'], after_id, notified=sender.sent - notified)
+
+    remaining = await db.get_server_subscriptions_page(source['id'], 0, 1)
+    if not remaining and job['delete_source']:
+        await db.delete_server(source['id'])
+        logger.info(f"Сервер {source['id']} удален после переноса подписок")
+    await db.finish_server_evacuation(
+        job['id'], DONE,
+        error="На сервере остались подписки, которые не удалось перенести" if remaining else None
+    )
+    logger.info(f"Перенос с сервера {source['id']} завершен за {time.monotonic() - started:.1f}с: "
+                f"перенесено {totals['moved']}, ошибок {totals['failed']}, уведомлено {sender.sent}")
+
+
+async def start_evacuation_worker(bot: Optional[Bot] = None):
+    """Выполнение переносов по очереди из процесса бота (переносы из API подхватываются опросом)"""
+    logger.info("Запуск воркера переноса подписок")
+    while True:
+        _wakeup.clear()
+        try:
+            job = await db.claim_server_evacuation()
+        except Exception as e:
+            logger.error(f"Ошибка чтения очереди переносов: {e}")
+            job = None
+
+        if job is None:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), EVACUATION_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        try:
+            await run_evacuation(job, bot)
+        except Exception as e:
+            logger.error(f"Ошибка при переносе подписок с сервера {job['source_server_id']}: {e}")
+            await db.finish_server_evacuation(job['id'], FAILED, error=str(e))
@@ -0,0 +1,130 @@
+import os
+import time
+import asyncio
+from typing import Dict, List
+
+from loguru import logger
+
+from handlers.database import db
+from handlers.x_ui import xui_manager, panel_client_id
+
+# Интервал между проходами, минут
+EXPIRY_SWEEP_INTERVAL = float(os.environ.get("EXPIRY_SWEEP_INTERVAL", 15))
+# Сколько подписок читается и отключается за одну транзакцию
+EXPIRY_SWEEP_BATCH = int(os.environ.get("EXPIRY_SWEEP_BATCH", 500))
+# Сколько часов после окончания подписки ждать перед удалением клиента.
+# Истекший клиент и так не работает (срок проверяет панель), а пока он не
+# удален, подписку можно продлить с тем же ключом
+EXPIRY_SWEEP_GRACE_HOURS = float(os.environ.get("EXPIRY_SWEEP_GRACE_HOURS", 48))
+# Сколько серверов обрабатывается одновременно
+EXPIRY_SWEEP_CONCURRENCY = int(os.environ.get("EXPIRY_SWEEP_CONCURRENCY", 4))
+# Только подсчет, без изменений в панелях и базе
+EXPIRY_SWEEP_DRY_RUN = os.environ.get("EXPIRY_SWEEP_DRY_RUN", "0") == "1"
+
+sweeper_stats = {
+    'runs': 0,
+    'last_run_at': None,
+    'last_duration': 0.0,
+    'last_expired': 0,
+    'last_deactivated': 0,
+    'total_deactivated': 0,
+    'total_panel_deleted': 0,
+    'total_panel_failed': 0,
+    'dry_run': EXPIRY_SWEEP_DRY_RUN
+}
+
+
+async def _remove_panel_clients(subscriptions: List[Dict], semaphore: asyncio.Semaphore) -> List[int]:
+    """
+    Удаление клиентов одного сервера и inbound
+
+    :return: ID подписок, клиенты которых удалены или уже отсутствуют
+    """
+    server_settings = subscriptions[0]
+    removed = []
+    async with semaphore:
+        results = await asyncio.gather(*(
+            xui_manager.delete_client(server_settings, server_settings['inbound_id'], panel_client_id(sub['vless']))
+            for sub in subscriptions
+        ))
+    for sub, ok in zip(subscriptions, results):
+        if ok:
+            removed.append(sub['id'])
+    return removed
+
+
+async def sweep_expired_subscriptions(dry_run: bool = EXPIRY_SWEEP_DRY_RUN,
+                                      batch_size: int = EXPIRY_SWEEP_BATCH) -> Dict:
+    """
+    Один проход: отключение истекших подписок и удаление их клиентов из панелей.
+
+    Подписка отключается, только если клиент удален из панели, либо если
+    удалять нечего (сервер удален, ссылку не удалось разобрать). Подписки,
+    которые панель не смогла удалить, остаются активными до следующего прохода.
+    """
+    started = time.monotonic()
+    before_ts = int(time.time() - EXPIRY_SWEEP_GRACE_HOURS * 3600)
+    semaphore = asyncio.Semaphore(EXPIRY_SWEEP_CONCURRENCY)
+    result = {'expired': 0, 'panel_deleted': 0, 'panel_failed': 0, 'deactivated': 0}
+
+    after = None
+    while True:
+        batch = await db.get_expired_subscriptions(before_ts, after=after, limit=batch_size)
+        if not batch:
+            break
+        after = (batch[-1]['end_ts'], batch[-1]['id'])
+        result['expired'] += len(batch)
+
+        groups: Dict[tuple, List[Dict]] = {}
+        without_client = []
+        for sub in batch:
+            if sub['server_exists'] is None or not panel_client_id(sub['vless']):
+                without_client.append(sub['id'])
+            else:
+                groups.setdefault((sub['server_id'], sub['inbound_id']), []).append(sub)
+
+        if dry_run:
+            logger.info(f"[dry-run] Истекших подписок в пачке: {len(batch)}, "
+                        f"серверов: {len(groups)}, без клиента в панели: {len(without_client)}")
+            continue
+
+        removed_groups = await asyncio.gather(*(
+            _remove_panel_clients(subs, semaphore) for subs in groups.values()
+        ))
+        removed = [sub_id for group in removed_groups for sub_id in group]
+        result['panel_deleted'] += len(removed)
+        result['panel_failed'] += sum(len(subs) for subs in groups.values()) - len(removed)
+
+        result['deactivated'] += await db.deactivate_subscriptions(removed + without_client)
+
+    duration = time.monotonic() - started
+    sweeper_stats['runs'] += 1
+    sweeper_stats['last_run_at'] = time.time()
+    sweeper_stats['last_duration'] = round(duration, 2)
+    sweeper_stats['last_expired'] = result['expired']
+    sweeper_stats['last_deactivated'] = result['deactivated']
+    sweeper_stats['total_deactivated'] += result['deactivated']
+    sweeper_stats['total_panel_deleted'] += result['panel_deleted']
+    sweeper_stats['total_panel_failed'] += result['panel_failed']
+
+    if result['expired']:
+        logger.info(f"Очистка истекших подписок за {duration:.1f}с{' (dry-run)' if dry_run else ''}: "
+                    f"найдено {result['expired']}, отключено {result['deactivated']}, "
+                    f"удалено из панелей {result['panel_deleted']}, ошибок панели {result['panel_failed']}")
+    return result
+
+
+async def start_expiry_sweeper(interval_minutes: float = EXPIRY_SWEEP_INTERVAL):
+    """Периодическая очистка истекших подписок из процесса бота"""
+    if interval_minutes <= 0:
+        logger.info("Очистка истекших подписок отключена")
+        return
+
+    logger.info(f"Запуск очистки истекших подписок каждые {interval_minutes:g} мин."
+                f"{' (dry-run)' if EXPIRY_SWEEP_DRY_RUN else ''}")
+    while True:
+        try:
+            await sweep_expired_subscriptions()
+        except Exception as e:
+            logger.error(f"Ошибка при очистке истекших подписок: {e}")
+        await asyncio.sleep(interval_minutes * 60)
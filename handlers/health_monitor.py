@@ -0,0 +1,168 @@
+import os
+import time
+import asyncio
+from collections import deque
+from typing import Dict, List, Optional
+
+import aiohttp
+from loguru import logger
+
+from handlers.database import db
+from handlers.circuit_breaker import circuit_breakers
+
+# Интервал между проверками всех серверов, секунд
+HEALTH_CHECK_INTERVAL = float(os.environ.get("HEALTH_CHECK_INTERVAL", 60))
+# Таймаут одной проверки, секунд
+HEALTH_PROBE_TIMEOUT = float(os.environ.get("HEALTH_PROBE_TIMEOUT", 5))
+# Сколько серверов проверяется одновременно
+HEALTH_CONCURRENCY = int(os.environ.get("HEALTH_CONCURRENCY", 20))
+# Сколько последних проверок каждого сервера хранится в памяти
+HEALTH_HISTORY_SIZE = int(os.environ.get("HEALTH_HISTORY_SIZE", 60))
+# Сколько дней хранятся почасовые итоги в базе
+HEALTH_RETENTION_DAYS = int(os.environ.get("HEALTH_RETENTION_DAYS", 30))
+# После скольких неудачных проверок подряд сервер считается недоступным
+HEALTH_FAILURE_THRESHOLD = int(os.environ.get("HEALTH_FAILURE_THRESHOLD", 2))
+
+
+class HealthMonitor:
+    """
+    Периодическая проверка доступности серверов.
+
+    Все серверы проверяются параллельно (не больше HEALTH_CONCURRENCY
+    одновременно) через одну общую HTTP-сессию. Последние HEALTH_HISTORY_SIZE
+    проверок каждого сервера хранятся в памяти в кольцевом буфере, почасовые
+    итоги — в таблице server_health. Админ-панель, API и выбор сервера при
+    покупке читают готовое состояние, не дожидаясь проверок. Результаты
+    проверок передаются предохранителям панелей.
+    """
+
+    def __init__(self):
+        self._history: Dict[int, deque] = {}
+        self._failures: Dict[int, int] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.last_run_at: Optional[float] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(ssl=False, limit=HEALTH_CONCURRENCY),
+                timeout=aiohttp.ClientTimeout(total=HEALTH_PROBE_TIMEOUT)
+            )
+        return self._session
+
+    async def probe(self, server: Dict) -> Dict:
+        """Проверка доступности сервера и измерение задержки"""
+        url = f"{server['url']}:{server['port']}"
+        result = {
+            'server_id': server['id'],
+            'checked_at': time.time(),
+            'available': False,
+            'delay': None,
+            'status_code': None
+        }
+        try:
+            started = time.monotonic()
+            async with self._get_session().get(url) as response:
+                result['delay'] = round((time.monotonic() - started) * 1000)
+                result['available'] = True
+                result['status_code'] = response.status
+        except asyncio.TimeoutError:
+            logger.warning(f"Таймаут при проверке сервера {url}")
+        except Exception as e:
+            logger.warning(f"Ошибка при проверке сервера {url}: {e}")
+        return result
+
+    def _store(self, probe: Dict):
+        server_id = probe['server_id']
+        history = self._history.get(server_id)
+        if history is None:
+            history = self._history[server_id] = deque(maxlen=HEALTH_HISTORY_SIZE)
+        history.append(probe)
+        self._failures[server_id] = 0 if probe['available'] else self._failures.get(server_id, 0) + 1
+        if not self.is_available(server_id):
+            circuit_breakers.report_probe(server_id, False)
+        elif probe['available']:
+            circuit_breakers.report_probe(server_id, True)
+
+    async def check_servers(self, servers: List[Dict]) -> List[Dict]:
+        """Параллельная проверка серверов с записью результатов в историю и базу"""
+        semaphore = asyncio.Semaphore(HEALTH_CONCURRENCY)
+
+        async def _probe(server: Dict) -> Dict:
+            async with semaphore:
+                return await self.probe(server)
+
+        probes = await asyncio.gather(*(_probe(server) for server in servers))
+        for probe in probes:
+            self._store(probe)
+        self.last_run_at = time.time()
+
+        try:
+            await db.record_server_health(probes)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить результаты проверки серверов: {e}")
+        return probes
+
+    async def check_all(self) -> List[Dict]:
+        """Проверка всех серверов из базы"""
+        return await self.check_servers(await db.get_all_servers())
+
+    def state(self, server_id: int) -> Optional[Dict]:
+        """
+        Состояние сервера по истории проверок: результат последней проверки,
+        доступность и задержка за период истории. None — проверок еще не было
+        """
+        history = self._history.get(server_id)
+        if not history:
+            return None
+        last = history[-1]
+        delays = sorted(probe['delay'] for probe in history if probe['available'])
+        return {
+            'available': self.is_available(server_id),
+            'delay': last['delay'],
+            'status_code': last['status_code'],
+            'checked_at': last['checked_at'],
+            'uptime': round(len(delays) / len(history) * 100, 1),
+            'avg_ms': round(sum(delays) / len(delays), 1) if delays else None,
+            'p95_ms': delays[min(len(delays) - 1, int(len(delays) * 0.95))] if delays else None,
+            'probes': len(history)
+        }
+
+    def is_available(self, server_id: int) -> bool:
+        """Сервер не провалил HEALTH_FAILURE_THRESHOLD проверок подряд (непроверенный считается доступным)"""
+        return self._failures.get(server_id, 0) < HEALTH_FAILURE_THRESHOLD
+
+    def is_fresh(self) -> bool:
+        """Состояние обновлялось не раньше двух интервалов проверки назад"""
+        return self.last_run_at is not None and time.time() - self.last_run_at < HEALTH_CHECK_INTERVAL * 2
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+health_monitor = HealthMonitor()
+
+
+async def start_health_monitor(interval_seconds: float = HEALTH_CHECK_INTERVAL):
+    """Периодическая проверка серверов из процесса бота"""
+    if interval_seconds <= 0:
+        logger.info("Мониторинг серверов отключен")
+        return
+
+    logger.info(f"Запуск мониторинга серверов каждые {interval_seconds:g} с")
+    last_prune = 0.0
+    while True:
+        started = time.monotonic()
+        try:
+            probes = await health_monitor.check_all()
+            failed = [probe['server_id'] for probe in probes if not probe['available']]
+            logger.debug(f"Проверено серверов: {len(probes)} за {time.monotonic() - started:.1f}с"
+                         f"{f', недоступны: {failed}' if failed else ''}")
+            if time.time() - last_prune >= 86400:
+                await db.prune_server_health(int(time.time()) - HEALTH_RETENTION_DAYS * 86400)
+                last_prune = time.time()
+        except Exception as e:
+            logger.error(f"Ошибка при проверке серверов: {e}")
+        await asyncio.sleep(max(0.0, interval_seconds - (time.monotonic() - started)))
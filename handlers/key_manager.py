@@ -24,7 +24,7 @@ async def get_user_keys_keyboard(telegram_id: int) -> InlineKeyboardMarkup:
     keyboard = []
     
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             
             async with conn.execute("""
@@ -102,7 +102,7 @@ async def show_available_servers(callback: CallbackQuery):
         
         subscription_id = int(callback.data.split('_')[2])
         
-        async with aiosqlite.connect(Database().db_path) as conn:
+        async with Database().acquire() as conn:
             conn.row_factory = aiosqlite.Row
             
             async with conn.execute("""
@@ -187,7 +187,7 @@ async def confirm_server_change(callback: CallbackQuery):
         
         _, _, subscription_id, new_server_id = callback.data.split('_')
         
-        async with aiosqlite.connect(Database().db_path) as conn:
+        async with Database().acquire() as conn:
             conn.row_factory = aiosqlite.Row
             
             async with conn.execute("""
@@ -0,0 +1,182 @@
+import os
+import time
+import uuid
+import asyncio
+from datetime import datetime
+from typing import Dict, Optional
+
+from loguru import logger
+
+from handlers.database import db
+from handlers.x_ui import xui_manager
+from handlers.xui_inbounds import get_inbound_meta
+from handlers.xui_session import panel_server_id
+from handlers.circuit_breaker import circuit_breakers
+
+# Сколько отключенных клиентов держать наготове на каждом сервере (0 — пул выключен)
+KEY_POOL_SIZE = int(os.environ.get("KEY_POOL_SIZE", 0))
+# Как часто пул пополняется без сигнала о выданном ключе, секунд
+KEY_POOL_REFILL_INTERVAL = float(os.environ.get("KEY_POOL_REFILL_INTERVAL", 60))
+# Пауза после выдачи ключа перед пополнением, чтобы при всплеске покупок
+# пополнять пул одной пачкой, а не по одному клиенту, секунд
+KEY_POOL_REFILL_DELAY = 1.0
+# Сколько серверов пополняется одновременно
+KEY_POOL_CONCURRENCY = int(os.environ.get("KEY_POOL_CONCURRENCY", 4))
+# Префикс email клиентов пула: сверка считает их чужими и не удаляет
+KEY_POOL_PREFIX = 'pool_'
+
+_refill = asyncio.Event()
+
+pool_stats = {
+    'taken': 0,
+    'missed': 0,
+    'failed': 0,
+    'created': 0,
+    'last_refill_at': None
+}
+
+
+def is_enabled() -> bool:
+    return KEY_POOL_SIZE > 0
+
+
+def _is_pool_server(server: Dict) -> bool:
+    """Пул ведется только для VLESS: ключ Shadowsocks содержит пароль, заданный при создании"""
+    return bool(server.get('is_enable')) and (server.get('protocol') or 'vless') == 'vless'
+
+
+async def _delete_panel_clients(server: Dict, keys):
+    await asyncio.gather(*(
+        xui_manager.delete_client(server, key['inbound_id'], key['client_id']) for key in keys
+    ))
+
+
+async def refill_server(server: Dict, counts: Dict) -> int:
+    """
+    Пополнение пула сервера до KEY_POOL_SIZE ключей одним запросом addClient.
+    Ключи inbound, который больше не указан у сервера, удаляются.
+
+    :return: Сколько ключей добавлено
+    """
+    inbound_id = server.get('inbound_id') or 1
+    stale = await db.delete_pool_keys(server['id'], keep_inbound_id=inbound_id)
+    if stale:
+        logger.info(f"Пул сервера {server['id']}: удалено ключей старого inbound: {len(stale)}")
+        await _delete_panel_clients(server, stale)
+
+    missing = KEY_POOL_SIZE - counts.get((server['id'], inbound_id), 0)
+    if missing <= 0:
+        return 0
+
+    inbound = await get_inbound_meta(server, inbound_id)
+    if not inbound.get('reality'):
+        logger.warning(f"Пул сервера {server['id']}: inbound {inbound_id} не VLESS Reality, пул не ведется")
+        return 0
+
+    clients = [
+        xui_manager._client_payload(None, f"{KEY_POOL_PREFIX}{uuid.uuid4().hex[:12]}", None)
+        for _ in range(missing)
+    ]
+    await xui_manager.add_clients(server, inbound_id, clients)
+    await db.add_pool_keys([
+        {
+            'server_id': server['id'],
+            'inbound_id': inbound_id,
+            'client_id': client['id'],
+            'email': client['email'],
+            'link': xui_manager._build_link(server, inbound, client['id'], client['email'])
+        }
+        for client in clients
+    ])
+    pool_stats['created'] += missing
+    logger.info(f"Пул сервера {server['id']}: добавлено ключей {missing}")
+    return missing
+
+
+async def refill_all() -> int:
+    """Пополнение пулов всех включенных VLESS серверов; ключи остальных серверов удаляются"""
+    servers = await db.get_all_servers()
+    counts = await db.count_pool_keys()
+    semaphore = asyncio.Semaphore(KEY_POOL_CONCURRENCY)
+
+    async def _refill_one(server: Dict) -> int:
+        async with semaphore:
+            try:
+                if not _is_pool_server(server):
+                    keys = await db.delete_pool_keys(server['id'])
+                    if keys:
+                        logger.info(f"Пул сервера {server['id']}: сервер отключен, удалено ключей {len(keys)}")
+                        await _delete_panel_clients(server, keys)
+                    return 0
+                if not circuit_breakers.available(server['id']):
+                    return 0
+                return await refill_server(server, counts)
+            except Exception as e:
+                logger.error(f"Ошибка при пополнении пула сервера {server['id']}: {e}")
+                return 0
+
+    created = sum(await asyncio.gather(*(_refill_one(server) for server in servers)))
+
+    # Ключи удаленных серверов: клиентов в панели уже не удалить, только строки пула
+    known = {server['id'] for server in servers}
+    for server_id in {server_id for server_id, _ in counts if server_id not in known}:
+        await db.delete_pool_keys(server_id)
+
+    pool_stats['last_refill_at'] = time.time()
+    return created
+
+
+async def claim_key(server_settings: Dict, telegram_id: int, end_date: datetime) -> Optional[str]:
+    """
+    Выдача ключа из пула: клиент пула включается в панели одним запросом
+    updateClient с email, tgId и датой окончания пользователя.
+
+    :return: Ссылка для пользователя или None, если пул пуст, выключен или
+        панель не приняла изменение (ключ тогда создается обычным способом)
+    """
+    if not is_enabled() or (server_settings.get('protocol') or 'vless') != 'vless':
+        return None
+
+    server_id = panel_server_id(server_settings)
+    inbound_id = server_settings.get('inbound_id', 1)
+    key = await db.take_pool_key(server_id, inbound_id)
+    _refill.set()
+    if not key:
+        pool_stats['missed'] += 1
+        return None
+
+    email = xui_manager._generate_email(telegram_id)
+    client = xui_manager._client_payload(telegram_id, email, end_date, client_id=key['client_id'])
+    try:
+        await xui_manager.update_client(server_settings, inbound_id, client)
+    except Exception as e:
+        # Состояние клиента неизвестно (запрос мог дойти до панели), в пул он не возвращается
+        pool_stats['failed'] += 1
+        logger.warning(f"Не удалось активировать ключ пула {key['email']} на сервере {server_id}: {e}")
+        await xui_manager.delete_client(server_settings, inbound_id, key['client_id'])
+        return None
+
+    pool_stats['taken'] += 1
+    logger.info(f"Пользователю {telegram_id} выдан ключ из пула сервера {server_id}")
+    return f"{key['link'].split('#', 1)[0]}#{email}"
+
+
+async def start_key_pool(interval_seconds: float = KEY_POOL_REFILL_INTERVAL):
+    """Пополнение пула ключей из процесса бота: по таймеру и после выдачи ключей"""
+    if not is_enabled():
+        logger.info("Пул ключей отключен")
+        return
+
+    logger.info(f"Запуск пула ключей: {KEY_POOL_SIZE} на сервер")
+    while True:
+        _refill.clear()
+        try:
+            await refill_all()
+        except Exception as e:
+            logger.error(f"Ошибка при пополнении пула ключей: {e}")
+
+        try:
+            await asyncio.wait_for(_refill.wait(), interval_seconds)
+            await asyncio.sleep(KEY_POOL_REFILL_DELAY)
+        except asyncio.TimeoutError:
+            pass
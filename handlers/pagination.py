@@ -0,0 +1,35 @@
+import json
+import base64
+from typing import Optional, List, Dict, Any
+
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+
+def encode_cursor(last_id: int) -> str:
+    """Курсор для следующей страницы по id последней записи"""
+    payload = json.dumps({"id": int(last_id)}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(after: Optional[str]) -> Optional[int]:
+    """
+    Разбор курсора, полученного от клиента.
+
+    :raises ValueError: если курсор поврежден
+    """
+    if not after:
+        return None
+    try:
+        padded = after + '=' * (-len(after) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return int(payload["id"])
+    except Exception:
+        raise ValueError("Некорректный курсор пагинации")
+
+
+def next_cursor(items: List[Dict[str, Any]], limit: Optional[int], key: str = 'id') -> Optional[str]:
+    """Курсор следующей страницы или None, если страница неполная"""
+    if not limit or len(items) < limit or not items:
+        return None
+    return encode_cursor(items[-1][key])
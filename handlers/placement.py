@@ -0,0 +1,138 @@
+import os
+import time
+import asyncio
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from handlers.database import db
+from handlers.xui_session import panel_sessions
+from handlers.health_monitor import health_monitor
+from handlers.circuit_breaker import circuit_breakers
+
+# Как часто счетчики активных подписок перечитываются из базы, секунд.
+# Между перечитываниями они обновляются при каждом создании подписки.
+PLACEMENT_REFRESH_INTERVAL = float(os.environ.get("PLACEMENT_REFRESH_INTERVAL", 300))
+# Емкость сервера без заданного capacity (для сравнения заполненности)
+PLACEMENT_DEFAULT_CAPACITY = int(os.environ.get("PLACEMENT_DEFAULT_CAPACITY", 1000))
+# Задержка сервера, при которой он считается вдвое более загруженным, мс
+PLACEMENT_LATENCY_REF_MS = float(os.environ.get("PLACEMENT_LATENCY_REF_MS", 1000))
+
+# Поля подключения к панели, которые подменяются у тарифа при выборе другого сервера
+PANEL_FIELDS = ('url', 'port', 'secret_path', 'username', 'password', 'secretkey',
+                'ip', 'inbound_id', 'protocol')
+
+
+class PlacementEngine:
+    """
+    Выбор сервера для новой подписки с учетом нагрузки.
+
+    Тариф привязан к серверу, а сервер — к региону (server_settings.region).
+    Новая подписка создается на наименее загруженном включенном сервере
+    того же региона и протокола. Загрузка — число активных подписок,
+    деленное на емкость (capacity) и вес (weight), с поправкой на задержку
+    по данным мониторинга. Недоступные по мониторингу серверы и серверы
+    с разомкнутым предохранителем панели пропускаются.
+    Сервер без региона не делит нагрузку с другими.
+    """
+
+    def __init__(self):
+        self._loads: Dict[int, int] = {}
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _ensure_loads(self):
+        if time.monotonic() - self._loaded_at < PLACEMENT_REFRESH_INTERVAL:
+            return
+        async with self._lock:
+            if time.monotonic() - self._loaded_at < PLACEMENT_REFRESH_INTERVAL:
+                return
+            self._loads = await db.get_active_subscription_counts()
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """Перечитать счетчики подписок при следующем выборе"""
+        self._loaded_at = 0.0
+
+    def score(self, server: Dict) -> Optional[float]:
+        """Заполненность сервера с учетом веса и задержки, None — сервер заполнен или недоступен"""
+        load = self._loads.get(server['id'], 0)
+        capacity = server.get('capacity') or 0
+        if capacity and load >= capacity:
+            return None
+        if not health_monitor.is_available(server['id']) or not circuit_breakers.available(server['id']):
+            return None
+        weight = server.get('weight') or 1.0
+        score = (load + 1) / ((capacity or PLACEMENT_DEFAULT_CAPACITY) * weight)
+
+        health = health_monitor.state(server['id'])
+        latency_ms = health['avg_ms'] if health and health['avg_ms'] is not None else None
+        if latency_ms is None:
+            panel_latency = panel_sessions.latency_stats(server['id'])
+            latency_ms = panel_latency['avg_ms'] if panel_latency else None
+        if latency_ms:
+            score *= 1 + latency_ms / PLACEMENT_LATENCY_REF_MS
+        return score
+
+    async def candidates(self, server_id: int) -> List[Dict]:
+        """Серверы, взаимозаменяемые с server_id: тот же регион и протокол"""
+        servers = await db.get_placement_servers()
+        home = next((server for server in servers if server['id'] == server_id), None)
+        if not home or not home.get('region'):
+            return [home] if home else []
+        protocol = home.get('protocol') or 'vless'
+        return [
+            server for server in servers
+            if server.get('region') == home['region'] and (server.get('protocol') or 'vless') == protocol
+        ]
+
+    async def acquire(self, server_id: int) -> Optional[Dict]:
+        """
+        Выбор сервера для подписки тарифа с сервером server_id.
+        Выбранному серверу сразу засчитывается подписка, чтобы параллельные
+        покупки распределялись; при неудаче создания нужно вызвать release.
+
+        :return: Настройки выбранного сервера или None, если сервер тарифа отключен
+        """
+        await self._ensure_loads()
+        servers = await self.candidates(server_id)
+        chosen = self.pick(servers)
+        if not chosen:
+            # Все серверы региона заполнены или недоступны — остаемся на сервере тарифа
+            chosen = next((server for server in servers if server['id'] == server_id), None)
+            if chosen:
+                logger.warning(f"Нет свободных доступных серверов в регионе сервера {server_id}")
+                self._loads[chosen['id']] = self._loads.get(chosen['id'], 0) + 1
+
+        if chosen and chosen['id'] != server_id:
+            logger.info(f"Подписка тарифа сервера {server_id} размещена на сервере {chosen['id']}")
+        return chosen
+
+    def pick(self, servers: List[Dict]) -> Optional[Dict]:
+        """
+        Наименее загруженный из переданных серверов; ему сразу засчитывается
+        подписка. None — все серверы заполнены или недоступны
+        """
+        scored = [(self.score(server), server) for server in servers]
+        available = [(score, server) for score, server in scored if score is not None]
+        if not available:
+            return None
+        chosen = min(available, key=lambda item: item[0])[1]
+        self._loads[chosen['id']] = self._loads.get(chosen['id'], 0) + 1
+        return chosen
+
+    async def refresh(self):
+        """Счетчики подписок, перечитанные при необходимости"""
+        await self._ensure_loads()
+
+    def release(self, server_id: int):
+        """Отмена засчитанной подписки, если создать ее не удалось"""
+        if self._loads.get(server_id):
+            self._loads[server_id] -= 1
+
+    def stats(self) -> Dict[int, int]:
+        """Текущие счетчики активных подписок по серверам"""
+        return dict(self._loads)
+
+
+placement = PlacementEngine()
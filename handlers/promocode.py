@@ -10,7 +10,7 @@ class PromoCodeManager:
         Returns: (is_valid, message, discount_percentage)
         """
         try:
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire() as conn:
                 conn.row_factory = aiosqlite.Row
                 async with conn.execute("""
                     SELECT * FROM promocodes 
@@ -47,7 +47,7 @@ class PromoCodeManager:
             discount = price * (percentage / 100)
             new_price = price - discount
             
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire(write=True) as conn:
                 await conn.execute("""
                     UPDATE promocodes 
                     SET activation_total = activation_total + 1 
@@ -0,0 +1,203 @@
+import os
+import time
+import asyncio
+from typing import Dict, Optional
+
+from aiogram import Bot
+from loguru import logger
+
+from handlers.database import db
+from handlers.buy_subscribe import subscription_manager
+from handlers.user.user_kb import get_success_by_keyboard
+
+# Сколько подписок создается одновременно
+PROVISIONING_WORKERS = int(os.environ.get("PROVISIONING_WORKERS", 4))
+# Сколько попыток создать подписку до отказа
+PROVISIONING_MAX_ATTEMPTS = int(os.environ.get("PROVISIONING_MAX_ATTEMPTS", 6))
+# Пауза перед первым повтором, секунд; дальше удваивается
+PROVISIONING_RETRY_DELAY = float(os.environ.get("PROVISIONING_RETRY_DELAY", 15))
+PROVISIONING_MAX_RETRY_DELAY = 900
+# Как часто воркеры проверяют очередь без сигнала о новом задании, секунд
+PROVISIONING_POLL_INTERVAL = float(os.environ.get("PROVISIONING_POLL_INTERVAL", 5))
+# Задание в processing дольше этого времени считается брошенным, секунд
+PROVISIONING_STALE_AFTER = 600
+
+PENDING = 'pending'
+PROCESSING = 'processing'
+DONE = 'done'
+FAILED = 'failed'
+
+_wakeup = asyncio.Event()
+
+provisioning_stats = {
+    'done': 0,
+    'retried': 0,
+    'failed': 0,
+    'last_duration': 0.0
+}
+
+
+async def enqueue_subscription(payment_id: str, user_id: int, tariff_id: int, price: float,
+                               provider: str = None, crypto_invoice_id: str = None) -> Dict:
+    """
+    Подтверждение оплаты и постановка создания подписки в очередь.
+    Повторный вызов с тем же payment_id возвращает существующее задание.
+    """
+    job = await db.create_provisioning_job(
+        payment_id=payment_id,
+        user_id=user_id,
+        tariff_id=tariff_id,
+        price=price,
+        provider=provider,
+        crypto_invoice_id=crypto_invoice_id
+    )
+    if job['created']:
+        logger.info(f"Платеж {payment_id} пользователя {user_id} поставлен в очередь создания подписки")
+        _wakeup.set()
+    return job
+
+
+async def get_job_status(payment_id: str) -> Optional[str]:
+    """Статус создания подписки по платежу: pending, processing, done, failed или None"""
+    job = await db.get_provisioning_job(payment_id)
+    return job['status'] if job else None
+
+
+def _retry_delay(attempts: int) -> float:
+    return min(PROVISIONING_RETRY_DELAY * 2 ** (attempts - 1), PROVISIONING_MAX_RETRY_DELAY)
+
+
+async def _notify_user(bot: Optional[Bot], job: Dict, subscription: Dict):
+    if not bot:
+        return
+    end_date = subscription['end_date'].split('.')[0] if isinstance(subscription['end_date'], str) \
+        else subscription['end_date'].strftime('%d.%m.%Y')
+    try:
+        await bot.send_message(
+            chat_id=job['user_id'],
+            text=(
+                f"🎉 Поздравляем! Ваша подписка {'продлена' if subscription.get('renewed') else 'активирована'}!\n\n"
+                f"<blockquote>"
+                f"<b>Действует до:</b> {end_date}\n"
+                f"</blockquote>"
+                "Для подключения используйте следующую ссылку:\n\n"
+                "<blockquote>"
+                f"<code>{subscription['vless']}</code>\n"
+                "</blockquote>\n"
+                "⚠️ Сохраните эту ссылку, она потребуется для настройки приложения.\n"
+                "Инструкции по настройке Вы найдете в личном кабинете."
+            ),
+            reply_markup=get_success_by_keyboard(),
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"Не удалось отправить ключ пользователю {job['user_id']}: {e}")
+
+
+async def _notify_failure(bot: Optional[Bot], job: Dict):
+    if not bot:
+        return
+    try:
+        await bot.send_message(
+            chat_id=job['user_id'],
+            text=(
+                "❌ Не удалось активировать оплаченную подписку.\n"
+                f"Номер платежа: <code>{job['payment_id']}</code>\n"
+                "Пожалуйста, обратитесь в поддержку."
+            ),
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"Не удалось уведомить пользователя {job['user_id']} об ошибке: {e}")
+
+
+async def process_job(job: Dict, bot: Optional[Bot] = None):
+    """
+    Одна попытка создания подписки по заданию.
+
+    Если подписка по этому платежу уже есть (процесс остановился после ее
+    создания, но до отметки задания), задание завершается, а ключ
+    отправляется пользователю: уведомление идет только после отметки,
+    значит, прошлая попытка его не отправила.
+    """
+    started = time.monotonic()
+    existing = await db.get_subscription_by_payment(job['payment_id'])
+    if existing:
+        await db.finish_provisioning_job(job['id'], DONE, subscription_id=existing['id'])
+        logger.info(f"Подписка по платежу {job['payment_id']} уже создана")
+        await _notify_user(bot, job, existing)
+        return
+
+    subscription = await subscription_manager.create_subscription(
+        user_id=job['user_id'],
+        tariff_id=job['tariff_id'],
+        bot=bot,
+        payment_id=job['payment_id']
+    )
+    provisioning_stats['last_duration'] = round(time.monotonic() - started, 2)
+
+    if subscription:
+        created = await db.get_subscription_by_payment(job['payment_id'])
+        await db.finish_provisioning_job(job['id'], DONE, subscription_id=created['id'] if created else None)
+        provisioning_stats['done'] += 1
+        await _notify_user(bot, job, subscription)
+        return
+
+    if job['attempts'] >= PROVISIONING_MAX_ATTEMPTS:
+        await db.finish_provisioning_job(job['id'], FAILED, error="Подписка не создана")
+        provisioning_stats['failed'] += 1
+        logger.error(f"Подписка по платежу {job['payment_id']} не создана за {job['attempts']} попыток")
+        await _notify_failure(bot, job)
+        return
+
+    delay = _retry_delay(job['attempts'])
+    await db.finish_provisioning_job(job['id'], PENDING, error="Подписка не создана",
+                                     next_attempt_at=int(time.time() + delay))
+    provisioning_stats['retried'] += 1
+    logger.warning(f"Подписка по платежу {job['payment_id']} не создана "
+                   f"(попытка {job['attempts']}), повтор через {delay:g}с")
+
+
+async def _worker(number: int, bot: Optional[Bot]):
+    while True:
+        _wakeup.clear()
+        try:
+            job = await db.claim_provisioning_job()
+        except Exception as e:
+            logger.error(f"Воркер очереди подписок {number}: ошибка чтения очереди: {e}")
+            job = None
+
+        if job is None:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), PROVISIONING_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        try:
+            await process_job(job, bot)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке задания {job['id']} (платеж {job['payment_id']}): {e}")
+            await db.finish_provisioning_job(job['id'], PENDING, error=str(e),
+                                             next_attempt_at=int(time.time() + _retry_delay(job['attempts'])))
+
+
+async def start_provisioning_workers(bot: Optional[Bot] = None, workers: int = PROVISIONING_WORKERS):
+    """Воркеры очереди создания подписок в процессе бота"""
+    # Воркеры работают только в процессе бота: после перезапуска все
+    # задания в processing брошены предыдущим процессом
+    requeued = await db.requeue_stale_provisioning_jobs(int(time.time()) + 1)
+    if requeued:
+        logger.warning(f"Возвращено в очередь незавершенных заданий: {requeued}")
+
+    logger.info(f"Запуск очереди создания подписок: воркеров {workers}")
+    tasks = [asyncio.create_task(_worker(number, bot)) for number in range(workers)]
+    while True:
+        await asyncio.sleep(PROVISIONING_STALE_AFTER)
+        try:
+            await db.requeue_stale_provisioning_jobs(int(time.time()) - PROVISIONING_STALE_AFTER)
+        except Exception as e:
+            logger.error(f"Ошибка при возврате зависших заданий: {e}")
+        for number, task in enumerate(tasks):
+            if task.done():
+                tasks[number] = asyncio.create_task(_worker(number, bot))
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import asyncio
+from typing import Dict, List, Optional
+from urllib.parse import unquote, quote
+
+from loguru import logger
+
+from handlers.database import db
+from handlers.x_ui import xui_manager, panel_client_id
+
+# Сколько серверов сверяется одновременно
+RECONCILE_CONCURRENCY = int(os.environ.get("RECONCILE_CONCURRENCY", 4))
+# Сколько подписок читается из базы за один запрос
+RECONCILE_PAGE_SIZE = 1000
+# Сколько примеров расхождений попадает в отчет
+RECONCILE_SAMPLE_SIZE = 20
+
+# Клиенты, созданные ботом; остальные клиенты панели не трогаем
+BOT_CLIENT_PREFIX = 'tg_'
+
+
+def _client_index(inbound: Dict) -> Dict[str, bool]:
+    """
+    Компактный индекс клиентов inbound: идентификатор клиента (UUID для vless,
+    email для Shadowsocks) -> создан ли клиент ботом
+    """
+    settings = json.loads(inbound.get('settings') or '{}')
+    is_shadowsocks = inbound.get('protocol') == 'shadowsocks'
+    index = {}
+    for client in settings.get('clients', []):
+        email = client.get('email') or ''
+        key = email if is_shadowsocks else client.get('id')
+        if key:
+            index[key] = email.startswith(BOT_CLIENT_PREFIX)
+    return index
+
+
+def _orphan_link_pattern(client_key: str) -> str:
+    """LIKE-шаблон ссылки подписки, которой принадлежит клиент"""
+    if '@' in client_key:
+        return f"ss://%#%{quote(client_key, safe='')}"
+    return f"vless://{client_key}@%"
+
+
+async def _restore_client(server: Dict, sub: Dict) -> bool:
+    """Повторное создание отсутствующего vless клиента с прежним UUID и сроком"""
+    if not sub['vless'].startswith('vless://') or '#' not in sub['vless']:
+        return False
+    client_id = panel_client_id(sub['vless'])
+    email = unquote(sub['vless'].split('#', 1)[1])
+    try:
+        await xui_manager.add_clients(server, server['inbound_id'], [{
+            'id': client_id,
+            'email': email,
+            'enable': True,
+            'flow': 'xtls-rprx-vision',
+            'tgId': str(sub['user_id']),
+            'totalGB': 0,
+            'expiryTime': (sub['end_ts'] or 0) * 1000,
+            'limitIp': 0,
+            'reset': 0,
+            'subId': ''
+        }])
+        return True
+    except Exception as e:
+        logger.error(f"Не удалось восстановить клиента подписки {sub['id']}: {e}")
+        return False
+
+
+async def reconcile_server(server: Dict, fix: bool = False) -> Dict:
+    """
+    Сверка подписок сервера с клиентами его inbound.
+
+    Клиенты inbound читаются с панели один раз и сворачиваются в индекс по
+    идентификатору клиента, активные подписки читаются из базы страницами
+    и вычеркивают найденных клиентов. Оставшиеся в индексе клиенты бота —
+    сироты, подписки без клиента — потерянные.
+
+    :param fix: Удалить сирот из панели и восстановить потерянных vless клиентов
+    """
+    report = {
+        'server_id': server['id'],
+        'server_name': server.get('name'),
+        'inbound_id': server['inbound_id'],
+        'panel_clients': 0,
+        'subscriptions': 0,
+        'matched': 0,
+        'missing': 0,
+        'orphans': 0,
+        'foreign_clients': 0,
+        'missing_sample': [],
+        'orphans_sample': [],
+        'restored': 0,
+        'deleted': 0,
+        'error': None
+    }
+    started = time.monotonic()
+    server = dict(server, server_id=server['id'])
+
+    try:
+        inbound = await xui_manager.get_inbound(server, server['inbound_id'])
+        index = _client_index(inbound)
+        del inbound
+    except Exception as e:
+        report['error'] = str(e)
+        logger.error(f"Сверка сервера {server['id']}: не удалось получить клиентов панели: {e}")
+        return report
+
+    report['panel_clients'] = len(index)
+    missing: List[Dict] = []
+
+    after_id = 0
+    while True:
+        page = await db.get_server_subscriptions_page(server['id'], after_id, RECONCILE_PAGE_SIZE)
+        if not page:
+            break
+        after_id = page[-1]['id']
+        report['subscriptions'] += len(page)
+        for sub in page:
+            key = panel_client_id(sub['vless'])
+            if key is not None and index.pop(key, None) is not None:
+                report['matched'] += 1
+            else:
+                report['missing'] += 1
+                if len(report['missing_sample']) < RECONCILE_SAMPLE_SIZE:
+                    report['missing_sample'].append(sub['id'])
+                if fix:
+                    missing.append(sub)
+
+    orphans = []
+    for key, is_bot_client in index.items():
+        if not is_bot_client:
+            report['foreign_clients'] += 1
+            continue
+        # Клиент мог появиться в панели раньше, чем его подписка в базе
+        if await db.has_active_subscription_link(server['id'], _orphan_link_pattern(key)):
+            continue
+        orphans.append(key)
+    index.clear()
+
+    report['orphans'] = len(orphans)
+    report['orphans_sample'] = orphans[:RECONCILE_SAMPLE_SIZE]
+
+    if fix:
+        results = await asyncio.gather(*(
+            xui_manager.delete_client(server, server['inbound_id'], key) for key in orphans
+        ))
+        report['deleted'] = sum(results)
+        results = await asyncio.gather(*(_restore_client(server, sub) for sub in missing))
+        report['restored'] = sum(results)
+
+    logger.info(f"Сверка сервера {server['id']} за {time.monotonic() - started:.1f}с: "
+                f"клиентов {report['panel_clients']}, подписок {report['subscriptions']}, "
+                f"потеряно {report['missing']}, сирот {report['orphans']}, "
+                f"восстановлено {report['restored']}, удалено {report['deleted']}")
+    return report
+
+
+async def reconcile_servers(server_ids: Optional[List[int]] = None, fix: bool = False) -> List[Dict]:
+    """Сверка нескольких (по умолчанию всех включенных) серверов параллельно"""
+    servers = await db.get_all_servers()
+    if server_ids:
+        servers = [server for server in servers if server['id'] in server_ids]
+    else:
+        servers = [server for server in servers if server.get('is_enable')]
+
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+    async def _reconcile(server: Dict) -> Dict:
+        async with semaphore:
+            return await reconcile_server(server, fix=fix)
+
+    return await asyncio.gather(*(_reconcile(server) for server in servers))
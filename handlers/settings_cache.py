@@ -0,0 +1,112 @@
+import os
+import copy
+import time
+from typing import Dict, Callable, Awaitable, Any, Hashable
+
+from loguru import logger
+
+SETTINGS_CACHE_INTERVAL = float(os.environ.get("SETTINGS_CACHE_INTERVAL", 1.0))
+
+# Таблицы настроек, изменение которых увеличивает settings_version.
+SETTINGS_TABLES = (
+    'bot_settings',
+    'bot_message',
+    'yookassa_settings',
+    'pspayments_settings',
+    'crypto_settings',
+    'server_settings',
+)
+
+
+class SettingsCache:
+    """
+    Кэш настроек бота в памяти процесса.
+
+    Любая запись в SETTINGS_TABLES (из бота, API или Flask-админки) триггером
+    увеличивает settings_version. Кэш сверяет версию не чаще раза в interval
+    секунд и сбрасывается при ее изменении. После коммита в этом же процессе
+    версия проверяется при следующем обращении.
+    """
+
+    def __init__(self, acquire: Callable, interval: float = SETTINGS_CACHE_INTERVAL):
+        self._acquire = acquire
+        self.interval = interval
+        self._values: Dict[Hashable, Any] = {}
+        self._version = None
+        self._checked_at = 0.0
+        self._generation = 0
+        self._metrics = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'version_checks': 0
+        }
+
+    def expire(self):
+        """Проверить версию настроек при следующем обращении"""
+        self._checked_at = 0.0
+
+    def discard(self, key: Hashable):
+        """Удаление одного значения из кэша"""
+        self._values.pop(key, None)
+
+    def clear(self):
+        """Сброс всех закэшированных значений"""
+        self._values.clear()
+        self._generation += 1
+        self._metrics['invalidations'] += 1
+
+    async def _read_version(self) -> int:
+        async with self._acquire() as conn:
+            async with conn.execute("SELECT version FROM settings_version WHERE id = 1") as cursor:
+                row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    async def _validate(self) -> bool:
+        """Сверка версии настроек. False, если кэшем пользоваться нельзя"""
+        now = time.monotonic()
+        if now - self._checked_at < self.interval:
+            return True
+
+        self._metrics['version_checks'] += 1
+        try:
+            version = await self._read_version()
+        except Exception as e:
+            logger.debug(f"Версия настроек недоступна, кэш отключен: {e}")
+            if self._values:
+                self.clear()
+            self._version = None
+            return False
+
+        self._checked_at = now
+        if version != self._version:
+            if self._values:
+                self.clear()
+            self._version = version
+        return True
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Получение значения из кэша или через loader.
+        Исключения loader не кэшируются и пробрасываются вызывающему.
+        """
+        valid = await self._validate()
+        if valid and key in self._values:
+            self._metrics['hits'] += 1
+            return copy.deepcopy(self._values[key])
+
+        self._metrics['misses'] += 1
+        generation = self._generation
+        value = await loader()
+        if valid and generation == self._generation:
+            self._values[key] = value
+        return copy.deepcopy(value)
+
+    def stats(self) -> Dict:
+        """Метрики кэша настроек"""
+        return {
+            **self._metrics,
+            'size': len(self._values),
+            'version': self._version,
+            'interval': self.interval
+        }
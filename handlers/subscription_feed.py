@@ -0,0 +1,131 @@
+import os
+import re
+import time
+import base64
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from loguru import logger
+
+from handlers.database import db
+
+# Внешний адрес API, по которому приложения забирают подписку (например https://sub.example.com)
+SUBSCRIPTION_BASE_URL = os.environ.get("SUBSCRIPTION_BASE_URL", "").rstrip('/')
+# Сколько подписок хранится в кэше процесса
+SUBSCRIPTION_CACHE_SIZE = int(os.environ.get("SUBSCRIPTION_CACHE_SIZE", 50000))
+# Сколько секунд расход трафика в Subscription-Userinfo считается актуальным
+SUBSCRIPTION_USERINFO_TTL = float(os.environ.get("SUBSCRIPTION_USERINFO_TTL", 600))
+# Как часто приложениям обновлять подписку, часов (Profile-Update-Interval)
+SUBSCRIPTION_UPDATE_INTERVAL = int(os.environ.get("SUBSCRIPTION_UPDATE_INTERVAL", 12))
+
+_TOKEN_RE = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+
+
+def subscription_url(token: str) -> Optional[str]:
+    """Ссылка на подписку для приложений; None, если SUBSCRIPTION_BASE_URL не задан"""
+    return f"{SUBSCRIPTION_BASE_URL}/sub/{token}" if SUBSCRIPTION_BASE_URL else None
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Сравнение If-None-Match с ETag (слабое сравнение, как требует RFC 9110 для If-None-Match)"""
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+class SubscriptionFeedCache:
+    """
+    Готовые тела подписок по токену в памяти процесса API.
+
+    На каждый запрос читается только версия подписок пользователя (поиск по
+    уникальному индексу токена). Пока версия не изменилась, отдается готовое
+    тело с тем же ETag; любое изменение подписок пользователя (покупка,
+    продление, перенос, отключение) триггером увеличивает версию, и тело
+    собирается заново. Расход трафика для Subscription-Userinfo
+    перечитывается не чаще раза в SUBSCRIPTION_USERINFO_TTL секунд.
+    """
+
+    def __init__(self, size: int = SUBSCRIPTION_CACHE_SIZE):
+        self.size = size
+        self._entries: OrderedDict = OrderedDict()
+        self._metrics = {
+            'hits': 0,
+            'builds': 0,
+            'not_found': 0
+        }
+
+    async def _build(self, user_id: int, version: int) -> Dict:
+        subscriptions = await db.get_active_subscription_links(user_id)
+        body = base64.b64encode('\n'.join(sub['vless'] for sub in subscriptions).encode('utf-8'))
+        return {
+            'user_id': user_id,
+            'version': version,
+            'body': body,
+            'etag': f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+            'subscription_ids': [sub['id'] for sub in subscriptions],
+            'expire': max((sub['end_ts'] or 0 for sub in subscriptions), default=0),
+            'userinfo': None,
+            'userinfo_at': 0.0
+        }
+
+    async def _refresh_userinfo(self, entry: Dict):
+        traffic = await db.get_traffic_usage(entry['subscription_ids'])
+        upload = sum(usage['up'] for usage in traffic.values())
+        download = sum(usage['down'] for usage in traffic.values())
+        entry['userinfo'] = f"upload={upload}; download={download}; total=0; expire={entry['expire']}"
+        entry['userinfo_at'] = time.monotonic()
+
+    async def get(self, token: str) -> Optional[Dict]:
+        """
+        Подписка по токену: body (base64), etag, userinfo.
+        None — токен неизвестен
+        """
+        if not _TOKEN_RE.match(token):
+            self._metrics['not_found'] += 1
+            return None
+
+        row = await db.get_subscription_token_version(token)
+        if row is None:
+            self._entries.pop(token, None)
+            self._metrics['not_found'] += 1
+            return None
+        user_id, version = row
+
+        entry = self._entries.get(token)
+        if entry is not None and entry['version'] == version:
+            self._entries.move_to_end(token)
+            self._metrics['hits'] += 1
+        else:
+            entry = await self._build(user_id, version)
+            self._entries[token] = entry
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            self._metrics['builds'] += 1
+
+        if time.monotonic() - entry['userinfo_at'] >= SUBSCRIPTION_USERINFO_TTL:
+            try:
+                await self._refresh_userinfo(entry)
+            except Exception as e:
+                logger.warning(f"Не удалось получить расход трафика пользователя {user_id}: {e}")
+                if entry['userinfo'] is None:
+                    entry['userinfo'] = f"upload=0; download=0; total=0; expire={entry['expire']}"
+        return entry
+
+    def stats(self) -> Dict:
+        """Метрики кэша подписок"""
+        return {
+            **self._metrics,
+            'size': len(self._entries)
+        }
+
+
+subscription_feeds = SubscriptionFeedCache()
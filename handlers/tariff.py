@@ -10,8 +10,8 @@ from aiogram.fsm.state import State, StatesGroup
 from handlers.promocode import promo_manager
 from handlers.pspayments import pspayments_manager
 from handlers.yookassa import yookassa_manager
-from handlers.buy_subscribe import subscription_manager
-from handlers.user.user_kb import get_trial_vless_keyboard, get_success_by_keyboard, get_start_keyboard
+from handlers.provisioning import enqueue_subscription, get_job_status
+from handlers.user.user_kb import get_trial_vless_keyboard, get_start_keyboard
 import os
 from aiogram.types import FSInputFile
 from aiogram.filters import Command
@@ -42,7 +42,7 @@ async def show_tariffs(callback: CallbackQuery):
                 tariffs_text += f"{tariff['server_name']}: {tariff['description']}\n"
 
         keyboard = InlineKeyboardBuilder()
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT DISTINCT s.id, s.name 
@@ -96,7 +96,7 @@ async def process_tariff_selection(callback: CallbackQuery):
         
         tariff_id = int(callback.data.split(":")[1])
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT t.*, s.name as server_name 
@@ -166,7 +166,7 @@ async def process_create_invoice(callback: CallbackQuery, state: FSMContext):
         tariff_id = int(data[2])
         promo_code = data[3] if len(data) > 3 else None
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT t.*, s.name as server_name 
@@ -182,7 +182,7 @@ async def process_create_invoice(callback: CallbackQuery, state: FSMContext):
 
         price = float(tariff['price'])
         if promo_code:
-            async with aiosqlite.connect(db.db_path) as conn:
+            async with db.acquire() as conn:
                 async with conn.execute("""
                     SELECT percentage 
                     FROM promocodes 
@@ -251,14 +251,13 @@ async def check_payment(callback: CallbackQuery, state: FSMContext):
         
         if not payment_locks[payment_id].locked():
             async with payment_locks[payment_id]:
-                async with aiosqlite.connect(db.db_path) as conn:
-                    async with conn.execute(
-                        'SELECT id FROM user_subscription WHERE payment_id = ?',
-                        (payment_id,)
-                    ) as cursor:
-                        if await cursor.fetchone():
-                            await callback.answer("Платеж уже был обработан и подписка активирована!", show_alert=True)
-                            return
+                job_status = await get_job_status(payment_id)
+                if job_status == 'done' or (job_status is None and await db.get_subscription_by_payment(payment_id)):
+                    await callback.answer("Платеж уже был обработан и подписка активирована!", show_alert=True)
+                    return
+                if job_status is not None:
+                    await callback.answer("Оплата получена, подписка активируется. Ключ придет отдельным сообщением.", show_alert=True)
+                    return
 
                 if provider == 'pspayments':
                     is_paid = await pspayments_manager.check_payment(payment_id, bot=callback.bot)
@@ -281,53 +280,26 @@ async def check_payment(callback: CallbackQuery, state: FSMContext):
                     if not success:
                         logger.warning(f"Ошибка при применении промокода после оплаты: {message_text}")
 
-                subscription = await subscription_manager.create_subscription(
-                    user_id=callback.from_user.id,
-                    tariff_id=tariff_id,
-                    payment_id=payment_id,  
-                    bot=callback.bot
-                )
-
-                if not subscription:
+                tariff = await db.get_tariff(tariff_id)
+                if not tariff:
                     await callback.message.answer("Ошибка при активации подписки. Обратитесь в поддержку.")
                     return
 
-                async with aiosqlite.connect(db.db_path) as conn:
-                    async with conn.execute(
-                        'SELECT price FROM tariff WHERE id = ?',
-                        (tariff_id,)
-                    ) as cursor:
-                        tariff = await cursor.fetchone()
-                        if tariff:
-                            await conn.execute("""
-                                INSERT INTO payments (user_id, tariff_id, price, provider)
-                                VALUES (?, ?, ?, ?)
-                            """, (
-                                callback.from_user.id,
-                                tariff_id,
-                                tariff[0],
-                                provider
-                            ))
-                            await conn.commit()
-
-                message_text = (
-                    "🎉 Поздравляем! Ваша подписка активирована!\n\n"
-                    f"<blockquote>"
-                    f"<b>Тариф:</b> {subscription['tariff']['name']}\n"
-                    f"<b>Действует до:</b> {subscription['end_date'].strftime('%d.%m.%Y')}\n"
-                    f"</blockquote>"
-                    "Для подключения используйте следующую ссылку:\n\n"
-                    "<blockquote>"
-                    f"<code>{subscription['vless']}</code>\n"
-                    "</blockquote>\n"
-                    "⚠️ Сохраните эту ссылку, она потребуется для настройки приложения.\n"
-                    "Инструкции по настройке Вы найдете в личном кабинете."
+                # Подписка создается воркером очереди (handlers/provisioning.py),
+                # ключ придет отдельным сообщением
+                await enqueue_subscription(
+                    payment_id=payment_id,
+                    user_id=callback.from_user.id,
+                    tariff_id=tariff_id,
+                    price=tariff['price'],
+                    provider=provider
                 )
 
                 await callback.message.delete()
                 await callback.message.answer(
-                    text=message_text,
-                    reply_markup=get_success_by_keyboard(),
+                    "✅ Оплата получена!\n\n"
+                    f"<b>Тариф:</b> {tariff['name']}\n"
+                    "Подписка активируется, ключ для подключения придет следующим сообщением.",
                     parse_mode="HTML"
                 )
 
@@ -398,7 +370,7 @@ async def process_promo_code(message: types.Message, state: FSMContext):
 
         data = await state.get_data()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT t.*, s.name as server_name 
@@ -511,7 +483,7 @@ async def buy_tariff(callback: CallbackQuery, state: FSMContext):
 async def show_tariffs(callback: CallbackQuery):
     """Отображение списка серверов с тарифами"""
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT DISTINCT s.id, s.name 
@@ -569,7 +541,7 @@ async def show_server_tariffs(callback: CallbackQuery):
     try:
         server_id = int(callback.data.split(":")[1])
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT t.*, s.name as server_name
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import asyncio
+from typing import Dict, Tuple
+
+from loguru import logger
+
+from handlers.database import db, TRAFFIC_DAY
+from handlers.x_ui import xui_manager, panel_client_id
+
+# Интервал между опросами панелей, минут
+TRAFFIC_COLLECT_INTERVAL = float(os.environ.get("TRAFFIC_COLLECT_INTERVAL", 10))
+# Через сколько дней часовые интервалы сворачиваются в суточные
+TRAFFIC_ROLLUP_DAYS = int(os.environ.get("TRAFFIC_ROLLUP_DAYS", 7))
+# Сколько дней хранятся суточные интервалы (0 — без ограничения)
+TRAFFIC_RETENTION_DAYS = int(os.environ.get("TRAFFIC_RETENTION_DAYS", 365))
+# Сколько серверов опрашивается одновременно
+TRAFFIC_COLLECT_CONCURRENCY = int(os.environ.get("TRAFFIC_COLLECT_CONCURRENCY", 4))
+# Сколько подписок читается из базы за один запрос
+TRAFFIC_PAGE_SIZE = 1000
+
+collector_stats = {
+    'runs': 0,
+    'last_run_at': None,
+    'last_duration': 0.0,
+    'last_subscriptions': 0,
+    'last_updated': 0,
+    'last_failed_servers': 0,
+    'last_rollup_at': None
+}
+
+
+def format_traffic(size: int) -> str:
+    """Объем трафика в читаемом виде"""
+    size = float(size or 0)
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.2f} ТБ"
+
+
+def _client_counters(inbound: Dict) -> Dict[str, Tuple[int, int]]:
+    """
+    Счетчики клиентов inbound: идентификатор клиента (UUID для vless,
+    email для Shadowsocks) -> (up, down). clientStats содержит только email,
+    UUID берется из настроек inbound.
+    """
+    is_shadowsocks = inbound.get('protocol') == 'shadowsocks'
+    ids_by_email = {}
+    if not is_shadowsocks:
+        settings = json.loads(inbound.get('settings') or '{}')
+        for client in settings.get('clients', []):
+            if client.get('email') and client.get('id'):
+                ids_by_email[client['email']] = client['id']
+
+    counters = {}
+    for stat in inbound.get('clientStats') or []:
+        email = stat.get('email')
+        key = email if is_shadowsocks else ids_by_email.get(email)
+        if key:
+            counters[key] = (int(stat.get('up') or 0), int(stat.get('down') or 0))
+    return counters
+
+
+async def collect_server_traffic(server: Dict) -> Dict:
+    """
+    Сбор трафика подписок одного сервера: один запрос inbound к панели,
+    активные подписки читаются из базы страницами и сопоставляются
+    с клиентами по идентификатору из ссылки.
+    """
+    result = {'server_id': server['id'], 'subscriptions': 0, 'updated': 0, 'error': None}
+    server = dict(server, server_id=server['id'])
+
+    try:
+        inbound = await xui_manager.get_inbound(server, server['inbound_id'])
+        counters = _client_counters(inbound)
+        del inbound
+    except Exception as e:
+        result['error'] = str(e)
+        logger.error(f"Сбор трафика сервера {server['id']}: не удалось получить статистику панели: {e}")
+        return result
+
+    now = int(time.time())
+    after_id = 0
+    while True:
+        page = await db.get_server_subscriptions_page(server['id'], after_id, TRAFFIC_PAGE_SIZE)
+        if not page:
+            break
+        after_id = page[-1]['id']
+        result['subscriptions'] += len(page)
+
+        samples = {}
+        for sub in page:
+            client_counters = counters.get(panel_client_id(sub['vless']))
+            if client_counters is not None:
+                samples[sub['id']] = client_counters
+        result['updated'] += await db.record_traffic(samples, now)
+
+    return result
+
+
+async def collect_traffic() -> Dict:
+    """Один проход сбора трафика по всем включенным серверам"""
+    started = time.monotonic()
+    servers = [server for server in await db.get_all_servers() if server.get('is_enable')]
+    semaphore = asyncio.Semaphore(TRAFFIC_COLLECT_CONCURRENCY)
+
+    async def _collect(server: Dict) -> Dict:
+        async with semaphore:
+            return await collect_server_traffic(server)
+
+    results = await asyncio.gather(*(_collect(server) for server in servers))
+    summary = {
+        'servers': len(servers),
+        'failed_servers': sum(1 for r in results if r['error']),
+        'subscriptions': sum(r['subscriptions'] for r in results),
+        'updated': sum(r['updated'] for r in results)
+    }
+
+    duration = time.monotonic() - started
+    collector_stats['runs'] += 1
+    collector_stats['last_run_at'] = time.time()
+    collector_stats['last_duration'] = round(duration, 2)
+    collector_stats['last_subscriptions'] = summary['subscriptions']
+    collector_stats['last_updated'] = summary['updated']
+    collector_stats['last_failed_servers'] = summary['failed_servers']
+
+    logger.info(f"Сбор трафика за {duration:.1f}с: серверов {summary['servers']} "
+                f"(с ошибкой {summary['failed_servers']}), подписок {summary['subscriptions']}, "
+                f"с новым трафиком {summary['updated']}")
+    return summary
+
+
+async def rollup_traffic() -> int:
+    """Свертка старых часовых интервалов в суточные и удаление устаревших"""
+    now = int(time.time())
+    retention_before = now - TRAFFIC_RETENTION_DAYS * TRAFFIC_DAY if TRAFFIC_RETENTION_DAYS > 0 else None
+    rolled_up = await db.rollup_traffic(now - TRAFFIC_ROLLUP_DAYS * TRAFFIC_DAY, retention_before)
+    collector_stats['last_rollup_at'] = time.time()
+    if rolled_up:
+        logger.info(f"Свернуто часовых интервалов трафика: {rolled_up}")
+    return rolled_up
+
+
+async def start_traffic_collector(interval_minutes: float = TRAFFIC_COLLECT_INTERVAL):
+    """Периодический сбор трафика из процесса бота, свертка раз в сутки"""
+    if interval_minutes <= 0:
+        logger.info("Сбор трафика отключен")
+        return
+
+    logger.info(f"Запуск сбора трафика каждые {interval_minutes:g} мин.")
+    last_rollup = 0.0
+    while True:
+        try:
+            await collect_traffic()
+            if time.time() - last_rollup >= TRAFFIC_DAY:
+                await rollup_traffic()
+                last_rollup = time.time()
+        except Exception as e:
+            logger.error(f"Ошибка при сборе трафика: {e}")
+        await asyncio.sleep(interval_minutes * 60)
@@ -2,6 +2,7 @@ from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, FSInputFile
 from loguru import logger
 import os
+import aiosqlite
 
 from handlers.database import db
 from handlers.user.user_kb import get_trial_keyboard, get_trial_vless_keyboard, get_no_subscriptions_keyboard
@@ -13,7 +14,8 @@ router = Router()
 
 async def get_active_trial_settings():
     """Получение активных настроек пробного периода"""
-    async with db.connect() as conn:
+    async with db.acquire() as conn:
+        conn.row_factory = aiosqlite.Row
         async with conn.execute(
             'SELECT * FROM trial_settings WHERE is_enable = 1 LIMIT 1'
         ) as cursor:
@@ -7,13 +7,14 @@ import urllib.parse
 
 from handlers.database import db
 from handlers.user.user_kb import get_back_keyboard
+from handlers.subscription_feed import SUBSCRIPTION_BASE_URL, subscription_url
 
 router = Router()
 
 async def get_merged_subscriptions(user_id: int) -> str | None:
     """Получение и кодирование всех активных подписок пользователя"""
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT vless
@@ -70,6 +71,16 @@ async def process_continue_merge(callback: CallbackQuery):
             "💡 Выберите приложение для автоматической настройки или скопируйте ключ вручную."
         )
 
+        # Токен создается, только когда ссылка на подписку показывается
+        if SUBSCRIPTION_BASE_URL:
+            feed_url = subscription_url(await db.get_subscription_token(callback.from_user.id))
+            message_text += (
+                "\n\n🔗 <b>Ссылка на подписку:</b>\n"
+                f"<code>{feed_url}</code>\n"
+                "Добавьте ее в приложение как подписку — ключи будут обновляться "
+                "автоматически после покупки, продления или смены сервера."
+            )
+
         await callback.message.answer(
             text=message_text,
             reply_markup=keyboard,
@@ -26,7 +26,7 @@ async def show_user_balance(callback: CallbackQuery):
         current_balance = await db.get_user_balance(callback.from_user.id)
         logger.info(f"Текущий баланс пользователя {callback.from_user.id}: {current_balance:.2f} руб.")
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             query = """
                 SELECT amount, type, description, created_at
@@ -9,7 +9,7 @@ import aiosqlite
 
 from handlers.database import db
 from handlers.crypto_pay import crypto_pay_manager
-from handlers.buy_subscribe import subscription_manager
+from handlers.provisioning import enqueue_subscription
 from handlers.user.user_kb import get_lk_keyboard
 router = Router()
 
@@ -24,7 +24,7 @@ async def process_crypto_payment(callback: CallbackQuery, state: FSMContext):
             await callback.answer("Оплата криптовалютой временно недоступна", show_alert=True)
             return
 
-        async with aiosqlite.connect(db.db_path) as db_conn:
+        async with db.acquire() as db_conn:
             db_conn.row_factory = aiosqlite.Row
             async with db_conn.execute('SELECT * FROM tariff WHERE id = ?', (tariff_id,)) as cursor:
                 tariff = await cursor.fetchone()
@@ -59,7 +59,7 @@ async def process_crypto_payment(callback: CallbackQuery, state: FSMContext):
             'status': 'pending'
         }
         
-        async with aiosqlite.connect(db.db_path) as db_conn:
+        async with db.acquire(write=True) as db_conn:
             await db_conn.execute("""
                 INSERT INTO crypto_payments 
                 (user_id, tariff_id, invoice_id, amount, asset, status, created_at)
@@ -110,7 +110,7 @@ async def check_crypto_payment(callback: CallbackQuery):
     try:
         invoice_id = callback.data.split(':')[1]
         
-        async with aiosqlite.connect(db.db_path) as db_conn:
+        async with db.acquire() as db_conn:
             db_conn.row_factory = aiosqlite.Row
             async with db_conn.execute('SELECT * FROM crypto_payments WHERE invoice_id = ?', (invoice_id,)) as cursor:
                 payment = await cursor.fetchone()
@@ -131,52 +131,30 @@ async def check_crypto_payment(callback: CallbackQuery):
         logger.info(f"Получен статус платежа {invoice_id}: {invoice.get('status', 'unknown')}")
         
         if invoice.get('status') == 'paid':
-            async with aiosqlite.connect(db.db_path) as db_conn:
-                await db_conn.execute(
-                    'UPDATE crypto_payments SET status = ? WHERE invoice_id = ?',
-                    ('paid', invoice_id)
-                )
-                await db_conn.execute("""
-                    INSERT INTO payments (user_id, tariff_id, price, date)
-                    VALUES (?, ?, ?, datetime('now'))
-                """, (payment['user_id'], payment['tariff_id'], payment['amount']))
-                await db_conn.commit()
-
-            subscription = await subscription_manager.create_subscription(
+            if payment['status'] == 'paid' and not await db.get_provisioning_job(f"crypto_{invoice_id}"):
+                # Счет оплачен и обработан до появления очереди
+                await callback.answer("Платеж уже был обработан и подписка активирована!", show_alert=True)
+                return
+
+            # Статус счета, запись об оплате и задание на создание подписки
+            # сохраняются одной транзакцией; повторная проверка того же счета
+            # возвращает уже созданное задание
+            job = await enqueue_subscription(
+                payment_id=f"crypto_{invoice_id}",
                 user_id=payment['user_id'],
                 tariff_id=payment['tariff_id'],
-                is_trial=False
+                price=payment['amount'],
+                provider='cryptopay',
+                crypto_invoice_id=invoice_id
             )
 
-            if not subscription:
-                logger.error("Ошибка при создании подписки в базе данных")
-                await callback.message.edit_text(
-                    "Произошла ошибка при активации подписки. Пожалуйста, обратитесь в поддержку.",
-                    reply_markup=None
-                )
+            if job['status'] == 'done':
+                await callback.answer("Платеж уже был обработан и подписка активирована!", show_alert=True)
                 return
 
-            async with aiosqlite.connect(db.db_path) as db_conn:
-                db_conn.row_factory = aiosqlite.Row
-                async with db_conn.execute('SELECT * FROM tariff WHERE id = ?', (payment['tariff_id'],)) as cursor:
-                    tariff = await cursor.fetchone()
-
-            message_text = (
-                "🎉 Поздравляем! Ваша подписка активирована!\n\n"
-                f"<blockquote>"
-                f"<b>Тариф:</b> {tariff['name']}\n"
-                f"<b>Действует до:</b> {subscription['end_date'].strftime('%d.%m.%Y')}\n"
-                f"</blockquote>"
-                "Для подключения используйте следующую ссылку:\n\n"
-                "<blockquote>"
-                f"<code>{subscription['vless']}</code>\n"
-                "</blockquote>\n"
-                "⚠️ Сохраните эту ссылку, она потребуется для настройки приложения.\n"
-                "Инструкции по настройке Вы найдете в личном кабинете."
-            )
-
             await callback.message.edit_text(
-                text=message_text,
+                "✅ Оплата получена!\n\n"
+                "Подписка активируется, ключ для подключения придет следующим сообщением.",
                 parse_mode="HTML",
                 reply_markup=get_lk_keyboard()
             )
@@ -13,7 +13,7 @@ router = Router()
 async def get_active_subscription(user_id: int) -> str | None:
     """Получение активной подписки пользователя"""
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT vless
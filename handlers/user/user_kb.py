@@ -21,7 +21,7 @@ async def get_start_keyboard(show_trial=False) -> InlineKeyboardMarkup:
     base_buttons = []
     
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             cursor = await conn.execute("""
                 SELECT name 
@@ -240,7 +240,7 @@ async def get_allocation_tickets_keyboard() -> InlineKeyboardMarkup:
         InlineKeyboardButton(text="💳 Тарифы", callback_data="start_tariffs"),
     ]
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             cursor = await conn.execute("""
                 SELECT name 
@@ -4,55 +4,31 @@ from loguru import logger
 import aiosqlite
 from datetime import datetime
 from handlers.database import db
+from handlers.traffic_collector import format_traffic
 from handlers.user.user_kb import get_trial_vless_keyboard, get_subscriptions_keyboard, get_continue_merge_keyboard, get_no_subscriptions_keyboard
 
 router = Router()
 
 @router.callback_query(F.data == "lk_my_subscriptions")
 async def show_user_subscriptions(callback: CallbackQuery):
-    """Отображение активных подписок пользователя"""
+    """
+    Отображение активных подписок пользователя. Истекшие подписки показываются
+    как истекшие и не отключаются: их отключает очистка (expiry_sweeper.py)
+    вместе с удалением клиента из панели, а до этого их можно продлить
+    """
     try:
         await callback.message.delete()
         
-        async with aiosqlite.connect(db.db_path) as conn:
-            async with conn.execute("SELECT datetime('now', 'localtime') as current_time") as cursor:
-                current_time = await cursor.fetchone()
-                logger.info(f"Текущее время: {current_time[0]}")
-
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
-            async with conn.execute("""
-                SELECT us.*, s.name as server_name
-                FROM user_subscription us
-                JOIN server_settings s ON us.server_id = s.id
-                WHERE us.user_id = ? AND us.is_active = 1
-            """, (callback.from_user.id,)) as cursor:
-                all_subs = await cursor.fetchall()
-                for sub in all_subs:
-                    logger.info(f"Подписка ID: {sub['id']}, end_date: {sub['end_date']}, is_active: {sub['is_active']}")
-
-            deactivation_query = """
-                UPDATE user_subscription 
-                SET is_active = 0 
-                WHERE user_id = ? 
-                AND is_active = 1 
-                AND datetime(end_date) < datetime('now', 'localtime')
-            """
-            logger.info(f"Выполняем запрос деактивации: {deactivation_query}")
-            await conn.execute(deactivation_query, (callback.from_user.id,))
-            await conn.commit()
-
             async with conn.execute("""
                 SELECT 
                     us.*,
                     s.name as server_name,
-                    datetime('now', 'localtime') as current_time,
-                    datetime(us.end_date) as formatted_end_date,
+                    us.end_ts < CAST(strftime('%s', 'now') AS INTEGER) as is_expired,
                     CASE 
-                        WHEN datetime(us.end_date) < datetime('now', 'localtime') THEN 0
-                        ELSE CAST(
-                            (julianday(us.end_date) - julianday('now', 'localtime')) * 24 
-                            AS INTEGER
-                        )
+                        WHEN us.end_ts < CAST(strftime('%s', 'now') AS INTEGER) THEN 0
+                        ELSE (us.end_ts - CAST(strftime('%s', 'now') AS INTEGER)) / 3600
                     END as hours_left
                 FROM user_subscription us
                 JOIN server_settings s ON us.server_id = s.id
@@ -60,15 +36,6 @@ async def show_user_subscriptions(callback: CallbackQuery):
                 ORDER BY us.end_date DESC
             """, (callback.from_user.id,)) as cursor:
                 subscriptions = await cursor.fetchall()
-                for sub in subscriptions:
-                    logger.info(
-                        f"После обновления - Подписка ID: {sub['id']}, "
-                        f"end_date: {sub['end_date']}, "
-                        f"formatted_end_date: {sub['formatted_end_date']}, "
-                        f"current_time: {sub['current_time']}, "
-                        f"hours_left: {sub['hours_left']}, "
-                        f"is_active: {sub['is_active']}"
-                    )
 
         if not subscriptions:
             await callback.message.answer(
@@ -79,8 +46,9 @@ async def show_user_subscriptions(callback: CallbackQuery):
             )
             return
 
-        message_text = "📋 <b>Ваши активные подписки:</b>\n"
-        
+        message_text = "📋 <b>Ваши подписки:</b>\n"
+        traffic = await db.get_traffic_usage([sub['id'] for sub in subscriptions])
+
         for sub in subscriptions:
             hours = sub['hours_left']
             days = hours // 24
@@ -95,6 +63,8 @@ async def show_user_subscriptions(callback: CallbackQuery):
             if minutes > 0:
                 time_parts.append(f"{minutes} мин.")
             time_str = " ".join(time_parts)
+            if sub['is_expired']:
+                time_str = "⛔ истекла, продлите в разделе Тарифы"
 
             end_date = sub['end_date'].split('.')[0]
 
@@ -103,6 +73,8 @@ async def show_user_subscriptions(callback: CallbackQuery):
                 f"<b>Сервер:</b> {sub['server_name']}\n"
                 f"<b>Действует:</b> {time_str}\n"
                 f"<b>До:</b> {end_date}\n"
+                f"<b>Трафик:</b> ↑ {format_traffic(traffic[sub['id']]['up'])} "
+                f"↓ {format_traffic(traffic[sub['id']]['down'])}\n"
                 f"<b>Ключ:</b> <code>{sub['vless']}</code>\n"
                 f"</blockquote>\n"
             )
@@ -134,7 +134,7 @@ async def confirm_payment(callback: CallbackQuery, state: FSMContext):
         
         if subscription:
             message_text = (
-                "🎉 Поздравляем! Ваша подписка активирована!\n\n"
+                f"🎉 Поздравляем! Ваша подписка {'продлена' if subscription.get('renewed') else 'активирована'}!\n\n"
                 f"<blockquote>"
                 f"<b>Тариф:</b> {tariff['name']}\n"
                 f"<b>Действует до:</b> {subscription['end_date'].strftime('%d.%m.%Y')}\n"
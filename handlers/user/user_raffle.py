@@ -13,7 +13,7 @@ router = Router()
 async def show_user_raffle(callback: CallbackQuery):
     """Отображение информации о розыгрыше и билетах пользователя"""
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             
             cursor = await conn.execute("""
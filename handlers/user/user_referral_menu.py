@@ -25,7 +25,7 @@ async def show_referral_program(callback: CallbackQuery):
             )
             return
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             async with conn.execute("""
                 SELECT username, referral_code, referral_count 
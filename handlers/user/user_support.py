@@ -57,7 +57,7 @@ async def show_support(callback: CallbackQuery, state: FSMContext):
 async def process_support_message(message: Message, state: FSMContext):
     """Обработка сообщения для техподдержки"""
     try:
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             conn.row_factory = aiosqlite.Row
             
             async with conn.execute(
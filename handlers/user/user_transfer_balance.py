@@ -6,7 +6,6 @@ from handlers.user.user_kb import get_user_balance_keyboard, get_user_success_tr
 from loguru import logger
 from aiogram.fsm.context import FSMContext
 from handlers.user.user_state import TransferState
-import aiosqlite
 
 router = Router()
 
@@ -125,7 +124,7 @@ async def process_transfer_recipient(message: Message, state: FSMContext):
         recipient_id = None
         search_query = message.text.strip()
         
-        async with aiosqlite.connect(db.db_path) as conn:
+        async with db.acquire() as conn:
             async with conn.execute(
                 "SELECT telegram_id, username FROM user WHERE telegram_id = ? OR LOWER(username) = LOWER(?)",
                 (search_query if search_query.isdigit() else -1, search_query)
@@ -180,54 +179,31 @@ async def confirm_transfer(callback: CallbackQuery, state: FSMContext):
         
         db = Database()
         
-        current_balance = await db.get_user_balance(callback.from_user.id)
-        if amount > current_balance:
+        new_balance = await db.transfer(callback.from_user.id, recipient_id, amount)
+        if new_balance is None:
             await callback.message.edit_text(
                 "❌ Недостаточно средств на балансе",
                 reply_markup=get_user_balance_keyboard()
             )
             await state.clear()
             return
-
-        async with aiosqlite.connect(db.db_path) as conn:
-            await conn.execute("BEGIN TRANSACTION")
-            try:
-                await db.update_balance(
-                    user_id=callback.from_user.id,
-                    amount=-amount,
-                    type='transfer_out',
-                    description=f"Перевод пользователю {recipient_id}"
-                )
-                
-                await db.update_balance(
-                    user_id=recipient_id,
-                    amount=amount,
-                    type='transfer_in',
-                    description=f"Перевод от пользователя {callback.from_user.id}"
-                )
-                
-                await conn.commit()
-                
-                await callback.message.edit_text(
-                    "✅ Перевод успешно выполнен!",
-                    reply_markup=get_user_balance_keyboard()
-                )
-                
-                try:
-                    await callback.bot.send_message(
-                        chat_id=recipient_id,
-                        parse_mode="HTML",
-                        text=f"🎉 Вам поступил перевод\n\n"
-                             f"💰 На сумму <b>{amount:.2f}</b> руб.\n"
-                             f"👤 От пользователя: <b>{callback.from_user.username}</b>",
-                        reply_markup=get_user_success_transfer_keyboard()
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке уведомления получателю: {e}")
-                
-            except Exception as e:
-                await conn.rollback()
-                raise e
+        
+        await callback.message.edit_text(
+            "✅ Перевод успешно выполнен!",
+            reply_markup=get_user_balance_keyboard()
+        )
+        
+        try:
+            await callback.bot.send_message(
+                chat_id=recipient_id,
+                parse_mode="HTML",
+                text=f"🎉 Вам поступил перевод\n\n"
+                     f"💰 На сумму <b>{amount:.2f}</b> руб.\n"
+                     f"👤 От пользователя: <b>{callback.from_user.username}</b>",
+                reply_markup=get_user_success_transfer_keyboard()
+            )
+        except Exception as e:
+            logger.error(f"Ошибка при отправке уведомления получателю: {e}")
                 
     except Exception as e:
         logger.error(f"Ошибка при выполнении перевода: {e}")
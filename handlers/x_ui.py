@@ -1,152 +1,216 @@
-from py3xui import Api
-from py3xui.client import Client
 from loguru import logger
-from typing import Optional, Dict, Any
-import aiohttp
+from typing import Optional, Dict, Any, List
+import asyncio
+import json
+import os
 from datetime import datetime, timedelta
 import uuid
 import random
+import re
+from urllib.parse import unquote
+
+from handlers.xui_session import panel_sessions, panel_server_id, XUIError
+from handlers.xui_inbounds import get_inbound_meta
+
+# Сколько клиентов отправляется в панель одним запросом addClient
+XUI_BATCH_SIZE = int(os.environ.get("XUI_BATCH_SIZE", 100))
+# Продлевать клиента чтением inbound и правкой только срока. Нужно, если
+# клиентам вручную задают ограничения в панели (limitIp, totalGB): без чтения
+# клиент собирается по ссылке подписки и они сбрасываются к значениям бота
+XUI_RENEW_READ_CLIENT = os.environ.get("XUI_RENEW_READ_CLIENT", "0") == "1"
+
+
+def panel_client_id(link: str) -> Optional[str]:
+    """
+    Идентификатор клиента в панели по ссылке из user_subscription.vless:
+    UUID для vless, email для Shadowsocks (delClient принимает именно его)
+    """
+    if not link:
+        return None
+    if link.startswith('vless://'):
+        match = re.match(r'vless://([^@]+)@', link)
+        return match.group(1) if match else None
+    if link.startswith('ss://') and '#' in link:
+        label = unquote(link.split('#', 1)[1])
+        return label[len('SS-2022-'):] if label.startswith('SS-2022-') else label
+    return None
+
 
 class XUIManager:
-    def __init__(self):
-        self.clients = {}  
-
-    async def get_client(self, server_settings: Dict) -> Optional[Api]:
-        """Получение или создание клиента для сервера"""
-        server_id = server_settings['id']
-        
-        if server_id in self.clients:
-            return self.clients[server_id]
-        
+    """
+    Асинхронный клиент 3x-ui для VLESS.
+
+    Запросы идут через общие сессии панелей (handlers/xui_session.py):
+    keep-alive, единая авторизация, ограничение параллелизма и таймауты.
+    """
+
+    async def _request(self, server_settings: Dict, method: str, path: str, **kwargs) -> Any:
+        return await panel_sessions.request(server_settings, method, path, **kwargs)
+
+    async def get_inbounds(self, server_settings: Dict) -> List[Dict]:
+        """Список inbounds сервера"""
+        return await self._request(server_settings, 'GET', '/panel/api/inbounds/list') or []
+
+    async def get_inbound(self, server_settings: Dict, inbound_id: int) -> Dict:
+        """Inbound сервера вместе с клиентами"""
+        return await self._request(server_settings, 'GET', f'/panel/api/inbounds/get/{inbound_id}')
+
+    async def add_clients(self, server_settings: Dict, inbound_id: int, clients: List[Dict]):
+        """Добавление клиентов в inbound одним запросом"""
+        await self._request(
+            server_settings, 'POST', '/panel/api/inbounds/addClient',
+            json={
+                'id': inbound_id,
+                'settings': json.dumps({'clients': clients}, separators=(',', ':'))
+            }
+        )
+
+    async def delete_client(self, server_settings: Dict, inbound_id: int, client_id: str) -> bool:
+        """Удаление клиента из inbound по UUID (для Shadowsocks — по email). Отсутствующий клиент считается удаленным"""
         try:
-            logger.info(f"Создание клиента для сервера {server_id}")
-            logger.info(f"URL: {server_settings['url']}")
-            logger.info(f"Port: {server_settings['port']}")
-            logger.info(f"Path: {server_settings['secret_path']}")
-            
-            url = server_settings['url']
-            if not url.startswith('http'):
-                url = f"https://{url}"
-            url = f"{url}:{server_settings['port']}/{server_settings['secret_path']}"
-            
-            logger.info(f"API URL: {url}")
-            
-            client = Api(
-                url,
-                server_settings['username'],
-                server_settings['password'],
-                use_tls_verify=False
-            )
-            
-            client.login()
-            inbounds = client.inbound.get_list()
-            logger.info(f"Подключение успешно. Найдено {len(inbounds)} inbounds")
-            
-            self.clients[server_id] = client
-            return client
-            
+            await self._request(server_settings, 'POST', f'/panel/api/inbounds/{inbound_id}/delClient/{client_id}')
+            return True
+        except XUIError as e:
+            if 'not found' in str(e).lower():
+                logger.warning(f"Клиент {client_id} уже отсутствует на сервере {panel_server_id(server_settings)}")
+                return True
+            logger.error(f"Ошибка при удалении клиента {client_id} с сервера {panel_server_id(server_settings)}: {e}")
+            return False
         except Exception as e:
-            logger.error(f"Ошибка при создании клиента X-UI для сервера {server_id}: {e}")
-            return None
+            logger.error(f"Ошибка при удалении клиента {client_id} с сервера {panel_server_id(server_settings)}: {e}")
+            return False
+
+    async def update_client(self, server_settings: Dict, inbound_id: int, client: Dict,
+                            client_id: Optional[str] = None):
+        """
+        Замена настроек клиента inbound одним запросом.
+        client_id — идентификатор клиента в панели (для Shadowsocks — email), по умолчанию client['id']
+        """
+        await self._request(
+            server_settings, 'POST', f"/panel/api/inbounds/updateClient/{client_id or client['id']}",
+            json={
+                'id': inbound_id,
+                'settings': json.dumps({'clients': [client]}, separators=(',', ':'))
+            }
+        )
+
+    async def update_client_expiry(self, server_settings: Dict, inbound_id: int, client_id: str,
+                                   end_date: datetime) -> bool:
+        """Изменение даты окончания клиента по UUID (для Shadowsocks — по email)"""
+        try:
+            inbound = await self.get_inbound(server_settings, inbound_id)
+            clients = json.loads(inbound['settings']).get('clients', [])
+            client = next((c for c in clients if client_id in (c.get('id'), c.get('email'))), None)
+            if not client:
+                logger.error(f"Клиент {client_id} не найден в inbound {inbound_id}")
+                return False
+
+            client['expiryTime'] = int(end_date.timestamp() * 1000)
+            client['enable'] = True
+            await self.update_client(server_settings, inbound_id, client, client_id=client_id)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при изменении даты окончания клиента {client_id}: {e}")
+            return False
+
+    async def extend_client(self, server_settings: Dict, inbound_id: int, link: str,
+                            telegram_id: int, end_date: datetime) -> bool:
+        """
+        Новая дата окончания клиента подписки одним запросом updateClient.
+
+        VLESS клиент собирается по ссылке подписки (UUID и email), inbound не
+        читается. Если панель отклоняет запрос (клиента с таким UUID нет),
+        срок меняется через update_client_expiry — с чтением inbound; клиент
+        заново не создается. Shadowsocks (пароль клиента известен только
+        панели) и XUI_RENEW_READ_CLIENT всегда идут через update_client_expiry.
+        """
+        client_id = panel_client_id(link)
+        if not client_id:
+            logger.error(f"Не удалось определить клиента по ссылке подписки пользователя {telegram_id}")
+            return False
+        if XUI_RENEW_READ_CLIENT or not link.startswith('vless://') or '#' not in link:
+            return await self.update_client_expiry(server_settings, inbound_id, client_id, end_date)
+
+        client = self._client_payload(telegram_id, unquote(link.split('#', 1)[1]), end_date, client_id=client_id)
+        try:
+            await self.update_client(server_settings, inbound_id, client)
+            return True
+        except XUIError as e:
+            if e.status != 200:
+                logger.error(f"Ошибка при продлении клиента {client_id}: {e}")
+                return False
+            logger.warning(f"Панель отклонила продление клиента {client_id} ({e}), читаем inbound {inbound_id}")
+            return await self.update_client_expiry(server_settings, inbound_id, client_id, end_date)
+        except Exception as e:
+            logger.error(f"Ошибка при продлении клиента {client_id}: {e}")
+            return False
+
+    @staticmethod
+    def _generate_email(telegram_id: int) -> str:
+        unique_id = ''.join([str(random.randint(0, 9)) for _ in range(5)])
+        return f"tg_{telegram_id}@{unique_id}"
+
+    @staticmethod
+    def _client_payload(telegram_id: Optional[int], email: str, end_time: Optional[datetime],
+                        client_id: Optional[str] = None) -> Dict:
+        """Описание VLESS клиента для addClient/updateClient; без telegram_id и end_time — отключенный клиент"""
+        return {
+            'id': client_id or str(uuid.uuid4()),
+            'email': email,
+            'enable': end_time is not None,
+            'flow': 'xtls-rprx-vision',
+            'tgId': str(telegram_id) if telegram_id is not None else '',
+            'totalGB': 0,
+            'expiryTime': int(end_time.timestamp() * 1000) if end_time else 0,
+            'limitIp': 0,
+            'reset': 0,
+            'subId': ''
+        }
+
+    @staticmethod
+    def _build_link(server_settings: Dict, inbound: Dict, client_id: str, email: str) -> str:
+        """Формирование vless ссылки по метаданным inbound"""
+        host = server_settings['url']
+        if not host.startswith('http'):
+            host = f"https://{host}"
+        host = host.split('://')[1]
 
-    def _find_inbound(self, inbounds: list, inbound_id: int) -> Optional[Any]:
-        """Поиск inbound по ID"""
-        return next((i for i in inbounds if i.id == inbound_id), None)
+        reality_settings = inbound['reality']
+
+        params = {
+            'type': 'tcp',
+            'security': 'reality',
+            'pbk': reality_settings['publicKey'],
+            'fp': 'chrome',
+            'sni': reality_settings['serverNames'][0],
+            'sid': reality_settings['shortIds'][0],
+            'spx': '/',
+            'flow': 'xtls-rprx-vision'
+        }
+
+        params_str = '&'.join([f"{k}={v}" for k, v in params.items()])
+
+        return f"vless://{client_id}@{host}:{inbound['port']}?{params_str}#{email}"
 
     async def create_trial_user(self, server_settings: Dict, trial_settings: Dict, telegram_id: int) -> Optional[str]:
         """Создание пользователя"""
         try:
             logger.info(f"Начало создания пользователя для telegram_id: {telegram_id}")
-            
-            client = await self.get_client(server_settings)
-            if not client:
-                logger.error(f"Не удалось получить клиента для сервера {server_settings['id']}")
-                return None
 
             end_time = datetime.now() + timedelta(days=trial_settings['left_day'])
-            
             inbound_id = server_settings.get('inbound_id', 1)
-            
-            unique_id = ''.join([str(random.randint(0, 9)) for _ in range(5)])
-            email = f"tg_{telegram_id}@{unique_id}"
-            
-            logger.info(f"Создание пользователя в inbound {inbound_id}")
-            logger.info(f"Email: {email}")
-            logger.info(f"Дата окончания: {end_time}")
-
-            inbounds = client.inbound.get_list()
-            logger.info(f"Подключение успешно. Найдено {len(inbounds)} inbounds")
-            
-            inbound = self._find_inbound(inbounds, inbound_id)
-            if not inbound:
-                logger.error(f"Inbound {inbound_id} не найден на сервере {server_settings['id']}")
-                return None
-            
-            logger.debug(f"Текущий inbound: {inbound}")
-
-            client_id = str(uuid.uuid4())
-            new_client = Client(
-                id=client_id,
-                email=email,
-                enable=True,
-                flow="xtls-rprx-vision",
-                tg_id=str(telegram_id),
-                total_gb=0,  
-                expiry_time=int(end_time.timestamp() * 1000),  
-                limit_ip=0,
-                reset=0,
-                password="",
-                method="",
-                sub_id="",
-                up=0,
-                down=0,
-                total=0,
-                inbound_id=inbound_id
-            )
-
-            success = False
-            try:
-                logger.debug("Попытка создания клиента первым способом...")
-                client.client.add(inbound_id, new_client)
-                logger.info("Клиент успешно создан первым способом")
-                success = True
-            except Exception as e:
-                logger.debug(f"Ошибка при добавлении клиента первым способом: {e}")
-                try:
-                    logger.debug("Попытка создания клиента вторым способом...")
-                    client.client.add(inbound_id, [new_client])
-                    logger.info("Клиент успешно создан вторым способом")
-                    success = True
-                except Exception as e:
-                    logger.error(f"Ошибка при добавлении клиента вторым способом: {e}")
-
-            if not success:
-                logger.error(f"Не удалось создать клиента для пользователя {telegram_id}")
-                return None
-
-            logger.debug("Начало формирования ссылки для подключения")
-            host = server_settings['url']
-            if not host.startswith('http'):
-                host = f"https://{host}"
-            host = host.split('://')[1]  
-
-            reality_settings = inbound.stream_settings.reality_settings
-            
-            params = {
-                'type': 'tcp',
-                'security': 'reality',
-                'pbk': reality_settings['settings']['publicKey'],
-                'fp': 'chrome',
-                'sni': reality_settings['serverNames'][0],
-                'sid': reality_settings['shortIds'][0],
-                'spx': '/',
-                'flow': 'xtls-rprx-vision'
-            }
-            
-            params_str = '&'.join([f"{k}={v}" for k, v in params.items()])
-            
-            link = f"vless://{client_id}@{host}:{inbound.port}?{params_str}#{email}"
-            
+            email = self._generate_email(telegram_id)
+
+            logger.info(f"Создание пользователя {email} в inbound {inbound_id}, дата окончания: {end_time}")
+
+            inbound = await get_inbound_meta(server_settings, inbound_id)
+
+            client = self._client_payload(telegram_id, email, end_time)
+            await self.add_clients(server_settings, inbound_id, [client])
+            logger.info("Клиент успешно создан")
+
+            link = self._build_link(server_settings, inbound, client['id'], email)
+
             logger.info(f"Ссылка для клиента успешно сгенерирована: {link}")
             return link
 
@@ -155,18 +219,117 @@ class XUIManager:
             logger.exception("Полный стек ошибки:")
             return None
 
+    async def create_clients(self, server_settings: Dict, items: List[Dict],
+                             chunk_size: int = XUI_BATCH_SIZE) -> List[Dict]:
+        """
+        Создание нескольких клиентов в одном inbound, по chunk_size клиентов за запрос.
+        Если панель отклоняет пачку, ее клиенты добавляются по одному,
+        чтобы ошибка одного клиента не затрагивала остальных.
+
+        Ошибка пачки не значит, что клиенты не добавлены (таймаут, обрыв
+        соединения после ответа панели), поэтому перед повтором клиенты
+        inbound перечитываются и уже добавленные не повторяются; отказ панели
+        из-за дубликата при повторе тоже считается успехом.
+
+        :param items: Словари с telegram_id и left_day (или точной датой окончания end_date)
+        :return: Для каждого элемента items: telegram_id, client_id, email, end_date
+            и link (None, если клиента создать не удалось)
+        """
+        inbound_id = server_settings.get('inbound_id', 1)
+        now = datetime.now()
+        prepared = []
+        for item in items:
+            end_time = item.get('end_date') or now + timedelta(days=item['left_day'])
+            client = self._client_payload(item['telegram_id'], self._generate_email(item['telegram_id']), end_time)
+            prepared.append((item, client, end_time))
+
+        try:
+            inbound = await get_inbound_meta(server_settings, inbound_id)
+        except Exception as e:
+            logger.error(f"Не удалось получить inbound {inbound_id} сервера {panel_server_id(server_settings)}: {e}")
+            inbound = None
+
+        results = []
+        for start in range(0, len(prepared), chunk_size):
+            chunk = prepared[start:start + chunk_size]
+            created = [False] * len(chunk)
+            if inbound:
+                try:
+                    await self.add_clients(server_settings, inbound_id, [client for _, client, _ in chunk])
+                    created = [True] * len(chunk)
+                except Exception as e:
+                    logger.warning(f"Пачка из {len(chunk)} клиентов не добавлена ({e}), добавляем по одному")
+                    existing = await self._existing_client_ids(server_settings, inbound_id)
+                    for index, (_, client, _) in enumerate(chunk):
+                        if client['id'] in existing:
+                            created[index] = True
+                            continue
+                        try:
+                            await self.add_clients(server_settings, inbound_id, [client])
+                            created[index] = True
+                        except Exception as e:
+                            if isinstance(e, XUIError) and 'duplicate' in str(e).lower():
+                                created[index] = True
+                                continue
+                            logger.error(f"Ошибка при добавлении клиента {client['email']}: {e}")
+
+            for (item, client, end_time), ok in zip(chunk, created):
+                results.append({
+                    'telegram_id': item['telegram_id'],
+                    'client_id': client['id'],
+                    'email': client['email'],
+                    'end_date': end_time,
+                    'link': self._build_link(server_settings, inbound, client['id'], client['email']) if ok else None
+                })
+
+            logger.info(f"Сервер {panel_server_id(server_settings)}, inbound {inbound_id}: "
+                        f"создано {sum(created)} из {len(chunk)} клиентов")
+        return results
+
+    async def _existing_client_ids(self, server_settings: Dict, inbound_id: int) -> set:
+        """UUID клиентов inbound; пустое множество, если inbound не прочитать"""
+        try:
+            inbound = await self.get_inbound(server_settings, inbound_id)
+            return {c.get('id') for c in json.loads(inbound['settings']).get('clients', [])}
+        except Exception as e:
+            logger.warning(f"Не удалось перечитать клиентов inbound {inbound_id} "
+                           f"сервера {panel_server_id(server_settings)}: {e}")
+            return set()
+
+    async def provision_batch(self, items: List[Dict], chunk_size: int = XUI_BATCH_SIZE) -> List[Dict]:
+        """
+        Массовое создание клиентов на нескольких серверах.
+        Клиенты группируются по серверу и inbound, группы обрабатываются
+        параллельно (в пределах лимита запросов к каждой панели).
+
+        :param items: Словари с server_settings, telegram_id и left_day (или end_date)
+        :return: Результаты create_clients в порядке items
+        """
+        groups: Dict[tuple, List[int]] = {}
+        for index, item in enumerate(items):
+            server_settings = item['server_settings']
+            key = (panel_server_id(server_settings), server_settings.get('inbound_id', 1))
+            groups.setdefault(key, []).append(index)
+
+        results: List[Optional[Dict]] = [None] * len(items)
+
+        async def _provision_group(indexes: List[int]):
+            server_settings = items[indexes[0]]['server_settings']
+            created = await self.create_clients(server_settings, [items[i] for i in indexes], chunk_size)
+            for index, result in zip(indexes, created):
+                results[index] = result
+
+        await asyncio.gather(*(_provision_group(indexes) for indexes in groups.values()))
+        return results
+
     async def delete_user(self, server_settings: Dict, telegram_id: int) -> bool:
         """Удаление пользователя"""
         try:
-            client = await self.get_client(server_settings)
-            if not client:
-                return False
-
             inbound_id = server_settings.get('inbound_id', 1)
             email = f"tg_{telegram_id}_trial"
-            
-            success = client.client.remove(inbound_id, email)
-            return success
+
+            await self._request(server_settings, 'POST', f'/panel/api/inbounds/{inbound_id}/delClient/{email}')
+            return True
 
         except Exception as e:
             logger.error(f"Ошибка при удалении пользователя {telegram_id}: {e}")
@@ -0,0 +1,71 @@
+from loguru import logger
+from typing import Dict, Optional
+import asyncio
+import json
+import os
+import time
+
+from handlers.database import db
+from handlers.xui_session import panel_sessions, panel_server_id
+
+# Сколько секунд метаданные inbound считаются актуальными
+XUI_INBOUND_CACHE_TTL = float(os.environ.get("XUI_INBOUND_CACHE_TTL", 600))
+
+_load_locks: Dict[tuple, asyncio.Lock] = {}
+
+
+def inbound_meta_key(server_id, inbound_id: int) -> tuple:
+    return ('inbound_meta', server_id, inbound_id)
+
+
+def parse_inbound_meta(inbound: Dict) -> Dict:
+    """
+    Метаданные inbound, нужные для формирования ссылок, без списка клиентов
+    """
+    stream_settings = json.loads(inbound.get('streamSettings') or '{}')
+    settings = json.loads(inbound.get('settings') or '{}')
+    reality = stream_settings.get('realitySettings')
+
+    return {
+        'port': inbound['port'],
+        'protocol': inbound.get('protocol'),
+        'reality': {
+            'publicKey': reality['settings']['publicKey'],
+            'serverNames': reality['serverNames'],
+            'shortIds': reality['shortIds']
+        } if reality else None,
+        'method': settings.get('method'),
+        'password': settings.get('password'),
+        'fetched_at': time.time()
+    }
+
+
+async def get_inbound_meta(server_settings: Dict, inbound_id: int) -> Optional[Dict]:
+    """
+    Метаданные inbound из кэша процесса.
+
+    Кэш общий с настройками бота (db.settings): изменение server_settings
+    из любого процесса сбрасывает его через settings_version, а изменения,
+    сделанные прямо в панели, подхватываются по истечении XUI_INBOUND_CACHE_TTL.
+    """
+    key = inbound_meta_key(panel_server_id(server_settings), inbound_id)
+
+    async def _load():
+        inbound = await panel_sessions.request(server_settings, 'GET', f'/panel/api/inbounds/get/{inbound_id}')
+        if not inbound:
+            raise ValueError(f"Inbound {inbound_id} не найден на сервере {key[1]}")
+        logger.debug(f"Метаданные inbound {inbound_id} сервера {key[1]} загружены с панели")
+        return parse_inbound_meta(inbound)
+
+    # Параллельные покупки на холодном кэше ждут одну загрузку
+    async with _load_locks.setdefault(key, asyncio.Lock()):
+        meta = await db.settings.get(key, _load)
+        if time.time() - meta['fetched_at'] > XUI_INBOUND_CACHE_TTL:
+            db.settings.discard(key)
+            meta = await db.settings.get(key, _load)
+    return meta
+
+
+def invalidate_inbound_meta(server_id, inbound_id: int):
+    """Сброс метаданных inbound, например, после ошибки формирования ссылки"""
+    db.settings.discard(inbound_meta_key(server_id, inbound_id))
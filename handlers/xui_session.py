@@ -0,0 +1,207 @@
+from loguru import logger
+from typing import Optional, Dict, Any
+from collections import deque
+import aiohttp
+import asyncio
+import os
+import time
+
+from handlers.circuit_breaker import circuit_breakers
+
+# Таймаут одного запроса к панели 3x-ui, секунд
+XUI_REQUEST_TIMEOUT = float(os.environ.get("XUI_REQUEST_TIMEOUT", 15))
+# Сколько запросов к одной панели выполняется одновременно
+XUI_MAX_CONCURRENCY = int(os.environ.get("XUI_MAX_CONCURRENCY", 4))
+# Сколько последних замеров задержки хранить на панель
+XUI_LATENCY_WINDOW = 200
+
+# Так панель отвечает на запросы с устаревшей или отсутствующей сессией
+REAUTH_STATUSES = (301, 302, 303, 307, 401, 403, 404)
+
+
+class XUIError(Exception):
+    """Ошибка запроса к панели 3x-ui"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        # HTTP-статус ответа; 200 — панель работает, но отклонила запрос
+        self.status = status
+
+
+class CircuitOpenError(XUIError):
+    """Панель недоступна: запрос не отправлялся, предохранитель разомкнут"""
+
+
+def panel_base_url(server_settings: Dict) -> str:
+    """Базовый URL панели: схема, хост, порт и секретный путь"""
+    base_url = server_settings['url'].rstrip('/')
+    if not base_url.startswith('http'):
+        base_url = f"https://{base_url}"
+    if base_url.count(':') < 2:
+        base_url = f"{base_url}:{server_settings['port']}"
+    secret_path = (server_settings.get('secret_path') or '').strip('/')
+    return f"{base_url}/{secret_path}" if secret_path else base_url
+
+
+def panel_server_id(server_settings: Dict) -> Any:
+    return server_settings.get('server_id', server_settings.get('id'))
+
+
+class PanelSession:
+    """Сессия одной панели: aiohttp-сессия с keep-alive, cookie авторизации и замеры задержки"""
+
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.login_lock = asyncio.Lock()
+        self.semaphore = asyncio.Semaphore(XUI_MAX_CONCURRENCY)
+        # Увеличивается при каждой успешной авторизации, чтобы
+        # параллельные запросы с протухшей сессией логинились один раз
+        self.generation = 0
+        self.latencies = deque(maxlen=XUI_LATENCY_WINDOW)
+        self.errors = 0
+
+
+class PanelSessionManager:
+    """
+    Общие сессии панелей 3x-ui для VLESS и Shadowsocks.
+
+    Авторизация выполняется один раз на панель даже при одновременных
+    запросах, а ответ панели о потерянной сессии приводит к повторной
+    авторизации и одному повтору запроса.
+    """
+
+    def __init__(self):
+        self.panels: Dict[Any, PanelSession] = {}
+
+    def _panel(self, server_settings: Dict) -> PanelSession:
+        server_id = panel_server_id(server_settings)
+        if server_id not in self.panels:
+            self.panels[server_id] = PanelSession()
+        return self.panels[server_id]
+
+    async def _login(self, panel: PanelSession, server_settings: Dict):
+        """Авторизация в панели, cookie сессии сохраняется в cookie jar"""
+        if panel.session is None or panel.session.closed:
+            panel.session = aiohttp.ClientSession(
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                connector=aiohttp.TCPConnector(ssl=False, limit=XUI_MAX_CONCURRENCY),
+                timeout=aiohttp.ClientTimeout(total=XUI_REQUEST_TIMEOUT)
+            )
+        panel.session.cookie_jar.clear()
+
+        async with panel.session.post(
+            f"{panel_base_url(server_settings)}/login",
+            data={
+                'username': server_settings['username'],
+                'password': server_settings['password']
+            }
+        ) as response:
+            data = await response.json(content_type=None)
+            if response.status != 200 or not data.get('success'):
+                raise XUIError(f"Ошибка авторизации на сервере {panel_server_id(server_settings)}: "
+                               f"{response.status} {data.get('msg', '')}")
+
+        panel.generation += 1
+        logger.info(f"Успешная авторизация на сервере {panel_server_id(server_settings)}")
+
+    async def _ensure_login(self, panel: PanelSession, server_settings: Dict, stale_generation: Optional[int] = None):
+        """
+        Авторизация с объединением параллельных попыток
+
+        :param stale_generation: Поколение сессии, на котором запрос получил отказ;
+            если за время ожидания блокировки кто-то уже авторизовался, повторно не логинимся
+        """
+        async with panel.login_lock:
+            if panel.session is not None and not panel.session.closed and panel.generation != stale_generation:
+                return
+            await self._login(panel, server_settings)
+
+    async def request(self, server_settings: Dict, method: str, path: str, **kwargs) -> Any:
+        """
+        Запрос к API панели через предохранитель сервера (handlers/circuit_breaker.py).
+        Ошибки соединения, таймауты и ответы с ошибкой HTTP размыкают его,
+        отказ панели в выполнении запроса (success: false) — нет.
+
+        :return: Поле obj ответа панели
+        :raises CircuitOpenError: Если панель недоступна и запрос не отправлялся
+        :raises XUIError: Если панель вернула ошибку
+        """
+        breaker = circuit_breakers.get(panel_server_id(server_settings))
+        if not breaker.allow():
+            raise CircuitOpenError(f"Панель сервера {panel_server_id(server_settings)} временно недоступна")
+
+        try:
+            result = await self._send(server_settings, method, path, **kwargs)
+        except XUIError as e:
+            if e.status == 200:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return result
+
+    async def _send(self, server_settings: Dict, method: str, path: str, **kwargs) -> Any:
+        panel = self._panel(server_settings)
+        url = f"{panel_base_url(server_settings)}{path}"
+
+        for attempt in range(2):
+            if panel.session is None or panel.session.closed:
+                await self._ensure_login(panel, server_settings)
+            generation = panel.generation
+
+            async with panel.semaphore:
+                started = time.monotonic()
+                try:
+                    async with panel.session.request(method, url, allow_redirects=False, **kwargs) as response:
+                        status = response.status
+                        data = await response.json(content_type=None) if status == 200 else None
+                except Exception:
+                    panel.errors += 1
+                    raise
+                finally:
+                    panel.latencies.append(time.monotonic() - started)
+
+            if status in REAUTH_STATUSES and attempt == 0:
+                logger.info(f"Сессия сервера {panel_server_id(server_settings)} недействительна ({status}), "
+                            f"повторная авторизация")
+                await self._ensure_login(panel, server_settings, stale_generation=generation)
+                continue
+
+            if status != 200 or not isinstance(data, dict) or not data.get('success'):
+                panel.errors += 1
+                msg = data.get('msg', '') if isinstance(data, dict) else ''
+                raise XUIError(f"{method} {path}: {status} {msg}", status=status)
+            return data.get('obj')
+
+    def latency_stats(self, server_id) -> Optional[Dict]:
+        """Задержка запросов к панели по последним замерам, мс"""
+        panel = self.panels.get(server_id)
+        if not panel or not panel.latencies:
+            return None
+        values = sorted(panel.latencies)
+        return {
+            'count': len(values),
+            'avg_ms': round(sum(values) / len(values) * 1000, 1),
+            'p95_ms': round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 1),
+            'errors': panel.errors
+        }
+
+    def get_latency_stats(self) -> Dict[Any, Dict]:
+        """Задержка запросов ко всем панелям"""
+        return {server_id: self.latency_stats(server_id) for server_id in self.panels if self.panels[server_id].latencies}
+
+    async def close(self):
+        """Закрытие сессий всех панелей"""
+        for panel in self.panels.values():
+            if panel.session is not None:
+                await panel.session.close()
+        self.panels.clear()
+
+panel_sessions = PanelSessionManager()
@@ -3,7 +3,6 @@ import uuid
 from loguru import logger
 from typing import Optional, Tuple
 from handlers.database import db
-import aiosqlite
 from datetime import datetime
 from handlers.admin.admin_kb import get_admin_keyboard
 
@@ -106,7 +105,7 @@ class YooKassaManager:
                     )
                 else:
                     if bot:
-                        async with aiosqlite.connect(db.db_path) as conn:
+                        async with db.acquire() as conn:
                             async with conn.execute(
                                 'SELECT pay_notify FROM bot_settings LIMIT 1'
                             ) as cursor:
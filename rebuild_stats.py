@@ -0,0 +1,27 @@
+"""
+Пересчет снимка статистики (stats_*) с нуля.
+
+Запуск: python rebuild_stats.py [путь к базе]
+Нужен после ручной правки таблиц user, payments или user_subscription
+в обход триггеров.
+"""
+import sys
+import asyncio
+
+from handlers.database import Database
+
+DEFAULT_DB_PATH = 'instance/database.db'
+
+
+async def main(db_path: str) -> bool:
+    db = Database(db_path)
+    try:
+        await db.create_statistics_snapshot()
+        return await db.rebuild_statistics()
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DB_PATH
+    sys.exit(0 if asyncio.run(main(path)) else 1)
@@ -0,0 +1,32 @@
+"""
+Сверка подписок в базе с клиентами на панелях 3x-ui.
+
+Запуск: python reconcile.py [--fix] [ID сервера ...]
+Без --fix только выводит отчет: подписки, клиентов которых нет в панели,
+и клиентов бота без активной подписки. С --fix сироты удаляются из
+панели, потерянные vless клиенты создаются заново с прежним UUID.
+"""
+import sys
+import json
+import asyncio
+
+from handlers.database import db
+from handlers.reconcile import reconcile_servers
+from handlers.xui_session import panel_sessions
+
+
+async def main(server_ids, fix: bool) -> bool:
+    try:
+        reports = await reconcile_servers(server_ids or None, fix=fix)
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+        return not any(report['error'] for report in reports)
+    finally:
+        await panel_sessions.close()
+        await db.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    fix = '--fix' in args
+    server_ids = [int(arg) for arg in args if arg != '--fix']
+    sys.exit(0 if asyncio.run(main(server_ids, fix)) else 1)